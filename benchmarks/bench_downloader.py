@@ -0,0 +1,232 @@
+"""
+Downloader (core/downloader.py) against a local HTTP server with Range
+requests, which drops the first transfer of each file halfway. Checks that
+downloads are resumed and match the served files, that the shared progress bar
+counts every file once, that a .part file and a truncated file of an older
+downloader are resumed, that a wrong checksum and a missing file return None,
+and that there are never more than per_host concurrent transfers.
+
+    python -m benchmarks.bench_downloader
+"""
+import hashlib
+import io
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tqdm import tqdm
+
+from core import downloader
+from core.utils import io_worker as iw
+
+FILE_SIZE = 3 * downloader.CHUNK_SIZE + 12345
+N_FILES = 4
+PER_HOST = 2
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    Serve files (dict of path and bytes) and their {path}.sha1 checksums, with
+    Range requests. The first transfer of each file is dropped halfway.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, files, checksums):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.files = files
+        self.checksums = checksums
+        self.dropped = set()
+        self.lock = threading.Lock()
+        self.n_active = 0
+        self.max_active = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path.endswith(".sha1"):
+            digest = self.server.checksums.get(self.path[: -len(".sha1")])
+            if digest is None:
+                self.send_error(404)
+                return
+            body = f"{digest}  {os.path.basename(self.path)[:-5]}\n".encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        start = 0
+        match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}"
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+
+        with self.server.lock:
+            self.server.n_active += 1
+            self.server.max_active = max(self.server.max_active, self.server.n_active)
+            drop = self.path not in self.server.dropped
+            self.server.dropped.add(self.path)
+        try:
+            end = start + (len(data) - start) // 2 if drop else len(data)
+            for i in range(start, end, 1 << 16):
+                self.wfile.write(data[i : min(i + (1 << 16), end)])
+                # Keep transfers long enough to overlap
+                time.sleep(0.001)
+            if drop:
+                self.close_connection = True
+        finally:
+            with self.server.lock:
+                self.server.n_active -= 1
+
+
+def get_files(n_files=N_FILES, file_size=FILE_SIZE):
+    """:return: dict of path and bytes"""
+    return {
+        f"/dumps/file{i}.tar.gz": random.Random(i).randbytes(file_size)
+        for i in range(n_files)
+    }
+
+
+def read_file(file_name):
+    with open(file_name, "rb") as f:
+        return f.read()
+
+
+def run():
+    """:return: dict of check name and True if it passed"""
+    files = get_files()
+    checksums = {path: hashlib.sha1(data).hexdigest() for path, data in files.items()}
+    # A wrong checksum, and a file without a published checksum
+    checksums["/dumps/file2.tar.gz"] = "0" * 40
+    del checksums["/dumps/file3.tar.gz"]
+
+    server = StandInServer(files, checksums)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    checks = {}
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Resumed downloads, counted once in the shared progress bar
+            p_bar = tqdm(total=0, file=io.StringIO())
+            paths = ["/dumps/file0.tar.gz", "/dumps/file1.tar.gz"]
+            for path in paths:
+                downloaded_file = downloader.download_file(
+                    server.url + path, tmp_dir, p_bar=p_bar
+                )
+                checks[f"resume {path}"] = (
+                    downloaded_file is not None
+                    and read_file(downloaded_file) == files[path]
+                )
+            checks["progress counted once"] = (
+                p_bar.n == p_bar.total == sum(len(files[path]) for path in paths)
+            )
+
+            # A .part file of an interrupted run, and a truncated final file of
+            # an older downloader
+            path = "/dumps/file0.tar.gz"
+            downloaded_file = f"{tmp_dir}/{os.path.basename(path)}"
+            for name, file_name in [
+                ("resume .part file", downloaded_file + ".part"),
+                ("repair truncated file", downloaded_file),
+            ]:
+                iw.delete_file(downloaded_file)
+                with open(file_name, "wb") as f:
+                    f.write(files[path][: FILE_SIZE // 3])
+                p_bar = tqdm(total=0, file=io.StringIO())
+                result = downloader.download_file(
+                    server.url + path, tmp_dir, p_bar=p_bar
+                )
+                checks[name] = (
+                    result == downloaded_file
+                    and read_file(downloaded_file) == files[path]
+                    and p_bar.n == p_bar.total == FILE_SIZE
+                )
+
+            # A truncated file without a published checksum is checked with
+            # the remote size
+            path = "/dumps/file3.tar.gz"
+            downloaded_file = f"{tmp_dir}/{os.path.basename(path)}"
+            with open(downloaded_file, "wb") as f:
+                f.write(files[path][: FILE_SIZE // 3])
+            downloader.download_file(server.url + path, tmp_dir)
+            checks["repair truncated file without checksum"] = (
+                read_file(downloaded_file) == files[path]
+            )
+
+            checks["wrong checksum"] = downloader.download_file(
+                server.url + "/dumps/file2.tar.gz", tmp_dir
+            ) is None and not os.path.exists(f"{tmp_dir}/file2.tar.gz")
+            checks["missing file"] = (
+                downloader.download_file(server.url + "/dumps/missing.tar.gz", tmp_dir)
+                is None
+            )
+
+        # Concurrent downloads of all files
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            server.dropped.clear()
+            server.max_active = 0
+            results = dict(
+                downloader.download_files(
+                    [server.url + path for path in files],
+                    tmp_dir,
+                    n_transfers=N_FILES,
+                    per_host=PER_HOST,
+                    progress=False,
+                )
+            )
+            checks["concurrent downloads"] = all(
+                (results[server.url + path] is None) == (path == "/dumps/file2.tar.gz")
+                for path in files
+            )
+            checks["per_host limit"] = 0 < server.max_active <= PER_HOST
+    finally:
+        server.shutdown()
+        server.server_close()
+    return checks
+
+
+def main():
+    checks = run()
+    for name, passed in checks.items():
+        iw.print_status(f"{name:<40}{'OK' if passed else 'FAIL'}")
+    if not all(checks.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
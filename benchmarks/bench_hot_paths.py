@@ -0,0 +1,201 @@
+"""
+Time the parse and render hot paths on the fixture articles (see fixtures.py):
+extract_html_tables_from_html, normalize_wikitables_css, transform_html_id_text,
+html_string2list, and html_to_img (table_layout.table_to_img for the PIL
+backend). Each fixture runs in a new process, so its peak RSS is its own.
+"""
+import multiprocessing
+import re
+import resource
+import sys
+import time
+
+import bs4
+
+from core import parse_wikitable_html, table_layout, table_tokens, wikitable_to_image
+
+# Minimum duration of a timed run, so fast functions are looped
+MIN_RUN_TIME = 0.2
+
+
+def time_calls(func, make_args, repeat=5, min_run_time=MIN_RUN_TIME):
+    """
+    Time func on a list of arguments, and keep the fastest of repeat runs. A run
+    loops over the arguments until it takes min_run_time, as timeit.autorange
+    :param make_args: return a list of argument tuples. It is called before each
+    loop, out of the timer, so func can modify its arguments
+    :return: {calls, seconds, per_call_ms}, seconds is the time of one loop
+    """
+    best = None
+    n_calls = 0
+    for _ in range(repeat):
+        run_time, n_loops = 0, 0
+        while not n_loops or run_time < min_run_time:
+            args = make_args()
+            n_calls = len(args)
+            start = time.perf_counter()
+            for arg in args:
+                func(*arg)
+            run_time += time.perf_counter() - start
+            n_loops += 1
+        loop_time = run_time / n_loops
+        best = loop_time if best is None else min(best, loop_time)
+    return {
+        "calls": n_calls,
+        "seconds": round(best, 6),
+        "per_call_ms": round(best * 1000 / n_calls, 4) if n_calls else 0,
+    }
+
+
+def get_raw_wikitables(article_html):
+    """HTML of the wikitables of an article, before normalization"""
+    soup = bs4.BeautifulSoup(article_html, "html.parser")
+    tables = soup.find_all("table", {"class": re.compile("wikitable*")})
+    return [str(table) for table in tables]
+
+
+def get_cell_htmls(table_html):
+    """Inner HTML of the non empty cells, as transform_html_id_text reads them"""
+    soup = bs4.BeautifulSoup(table_html.replace("\n", ""), "lxml")
+    return [
+        "".join(str(el) for el in td.contents)
+        for td in soup.find_all(["td", "th"])
+        if td.contents and td.text.strip()
+    ]
+
+
+def get_peak_rss_mb():
+    """
+    Peak RSS of this process. On Linux, ru_maxrss keeps the peak of the parent
+    process across the fork and exec of a spawned process, so read the peak of
+    this process image (VmHWM) instead.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak_rss /= 1024
+    return round(peak_rss / 1024, 1)
+
+
+def create_renderer(render_backend):
+    """
+    :return: (backend, driver). Fall back to the PIL backend if the browser
+    cannot start
+    """
+    if render_backend == "browser":
+        try:
+            return "browser", wikitable_to_image.create_driver()
+        except Exception as message:
+            print(
+                f"Browser unavailable, benchmark the PIL backend: {str(message).strip()}"
+            )
+    return "pil", None
+
+
+def bench_fixture(article, repeat=5, render_backend="browser"):
+    """
+    :return: results of a fixture {title, wikidata, html_size, n_tables, n_cells,
+    render_backend, pages_per_sec, tables_per_sec, peak_rss_mb, functions}
+    """
+    article_html = article["article_body"]["html"]
+    tables = parse_wikitable_html.extract_html_tables_from_html(article_html)
+    table_htmls = [table["html"] for table in tables]
+    raw_tables = get_raw_wikitables(article_html)
+    cell_htmls = [c for table_html in table_htmls for c in get_cell_htmls(table_html)]
+
+    functions = {}
+    functions["extract_html_tables_from_html"] = time_calls(
+        parse_wikitable_html.extract_html_tables_from_html,
+        lambda: [(article_html,)],
+        repeat,
+    )
+
+    def make_normalize_args():
+        args = []
+        for raw_table in raw_tables:
+            soup = bs4.BeautifulSoup(raw_table, "html.parser")
+            args.append((soup, soup.find("table")))
+        return args
+
+    functions["normalize_wikitables_css"] = time_calls(
+        parse_wikitable_html.normalize_wikitables_css, make_normalize_args, repeat
+    )
+    functions["transform_html_id_text"] = time_calls(
+        wikitable_to_image.transform_html_id_text,
+        lambda: [(table_html,) for table_html in table_htmls],
+        repeat,
+    )
+    functions["html_string2list"] = time_calls(
+        table_tokens.html_string2list,
+        lambda: [(cell_html,) for cell_html in cell_htmls],
+        repeat,
+    )
+
+    # Render the tables that transform_html_id_text accepts
+    transformed = [
+        wikitable_to_image.transform_html_id_text(table_html)
+        for table_html in table_htmls
+    ]
+    transformed = [t for t in transformed if t[0] is not None]
+    backend, driver = create_renderer(render_backend)
+    try:
+        if driver is None:
+            functions["table_to_img"] = time_calls(
+                table_layout.table_to_img,
+                lambda: [(t[0], t[2]) for t in transformed],
+                repeat,
+            )
+            render_time = functions["table_to_img"]["seconds"]
+        else:
+            functions["html_to_img"] = time_calls(
+                wikitable_to_image.html_to_img,
+                lambda: [(driver, t[1], t[3]) for t in transformed],
+                repeat,
+            )
+            render_time = functions["html_to_img"]["seconds"]
+    finally:
+        if driver is not None:
+            driver.quit()
+
+    # End to end: parse a page (pool_parse_html_source), and render its tables
+    parse = time_calls(
+        parse_wikitable_html.pool_parse_html_source, lambda: [(article,)], repeat
+    )
+    render_time += functions["transform_html_id_text"]["seconds"]
+    n_tables = len(tables)
+    return {
+        "title": article.get("name"),
+        "wikidata": article["main_entity"]["identifier"],
+        "html_size": len(article_html),
+        "n_tables": n_tables,
+        "n_cells": len(cell_htmls),
+        "render_backend": backend,
+        "pages_per_sec": round(1 / parse["seconds"], 2),
+        "tables_per_sec": {
+            "parse": round(n_tables / parse["seconds"], 2),
+            "render": round(len(transformed) / render_time, 2) if render_time else 0,
+        },
+        "peak_rss_mb": get_peak_rss_mb(),
+        "functions": functions,
+    }
+
+
+def run(fixtures, repeat=5, render_backend="browser"):
+    """
+    Benchmark each fixture in a new process
+    :param fixtures: dict of fixture name and article (see fixtures.load_fixtures)
+    :return: dict of fixture name and results (see bench_fixture)
+    """
+    results = {}
+    ctx = multiprocessing.get_context("spawn")
+    for name, article in fixtures.items():
+        with ctx.Pool(processes=1) as pool:
+            results[name] = pool.apply(bench_fixture, (article, repeat, render_backend))
+    return results
@@ -0,0 +1,112 @@
+"""
+Fast HTML backends of the parse (lxml and selectolax, see
+extract_html_tables_from_html_fast) against the bs4 backend. Checks that they
+extract the same tables from the wikitable pages of the crwiki dump, the
+fixtures, and edge cases of the serialization of bs4, and times them.
+
+    python -m benchmarks.bench_html_backends
+"""
+import sys
+
+import ujson
+
+from benchmarks import fixtures
+from benchmarks.bench_hot_paths import time_calls
+from core import parse_wikitable_html
+from core.utils import io_worker as iw
+
+HTML_BACKENDS = ["lxml", "selectolax"]
+# Pages with the cases of table_html: header rows without white spaces, comments,
+# void tags, quotes and entities in attributes, attributes of several values,
+# white space texts (and in pre), style and ruby texts, footnotes, unwrapped
+# tags, and section headings
+EDGE_CASE_PAGES = [
+    '<section><h2>A <!--c-->&amp; <span>b</span></h2><table class="wikitable" '
+    'id="t" style=\'font: "x"\' cellpadding="2"><caption> C<style>.x{}</style>'
+    "<ruby>d<rt>e</rt></ruby> </caption><tbody><tr><th>a</th></tr><tr><th>b</th>"
+    '</tr><tr><!--c--><th headers="h1   h2">c</th>  </tr><tr><td title="x">1 &gt; 0'
+    "<br>&nbsp;<sup>[1]</sup></td></tr></tbody></table></section>",
+    '<section><h2>A</h2><section><h3>B\n</h3><table class="wikitable">\n<tbody>\n'
+    '<tr>\n<th style="a&quot;b\'c">x</th>\n</tr>\n<tr><td><a href="#"><span>'
+    "<b>y</b></span></a>  \n\t<pre>  p  \n\n</pre><hr><img src=i></td>"
+    "<td> \n\n </td></tr></tbody></table></section></section>",
+]
+
+
+def get_test_pages():
+    """:return: dict of name and page HTML (crwiki pages with wikitables, fixtures)"""
+    pages = {}
+    for i, (_, line) in enumerate(iw.read_line_with_position(fixtures.FIXTURE_DUMP)):
+        if not parse_wikitable_html.is_wikitable_candidate(line):
+            continue
+        line_obj = ujson.loads(line)
+        pages[f"crwiki_{i} ({line_obj.get('name')})"] = line_obj["article_body"]["html"]
+    for name, article in fixtures.load_fixtures().items():
+        pages[name] = article["article_body"]["html"]
+    for j, page_html in enumerate(EDGE_CASE_PAGES):
+        pages[f"edge_case_{j}"] = page_html
+    return pages
+
+
+def check_parity(pages, html_backend):
+    """:return: names of pages with different tables than the bs4 backend"""
+    mismatches = []
+    for name, html_content in pages.items():
+        if parse_wikitable_html.extract_html_tables_from_html(
+            html_content, "bs4"
+        ) != parse_wikitable_html.extract_html_tables_from_html(
+            html_content, html_backend
+        ):
+            mismatches.append(name)
+    return mismatches
+
+
+def run(repeat=3):
+    """:return: {n_pages, bs4, backends: {name: {mismatches, time, speedup}}}"""
+    pages = get_test_pages()
+    args = [(html_content, "bs4") for html_content in pages.values()]
+    results = {
+        "n_pages": len(pages),
+        "bs4": time_calls(
+            parse_wikitable_html.extract_html_tables_from_html, lambda: args, repeat
+        ),
+        "backends": {},
+    }
+    for html_backend in HTML_BACKENDS:
+        backend_args = [(html_content, html_backend) for html_content in pages.values()]
+        backend_time = time_calls(
+            parse_wikitable_html.extract_html_tables_from_html,
+            lambda: backend_args,
+            repeat,
+        )
+        results["backends"][html_backend] = {
+            "mismatches": check_parity(pages, html_backend),
+            "time": backend_time,
+            "speedup": round(results["bs4"]["seconds"] / backend_time["seconds"], 2),
+        }
+    return results
+
+
+def main():
+    results = run()
+    iw.print_status(
+        f"{'Backend':<12}{'Parity':>10}{'Time (ms)':>12}{'Speedup':>10}"
+        f"  ({results['n_pages']} pages)"
+    )
+    iw.print_status(
+        f"{'bs4':<12}{'-':>10}{results['bs4']['seconds'] * 1000:>12.3f}{1:>9.2f}x"
+    )
+    for name, r in results["backends"].items():
+        parity = f"{results['n_pages'] - len(r['mismatches'])}/{results['n_pages']}"
+        iw.print_status(
+            f"{name:<12}{parity:>10}{r['time']['seconds'] * 1000:>12.3f}"
+            f"{r['speedup']:>9.2f}x"
+        )
+        for mismatch in r["mismatches"]:
+            iw.print_status(f"  Mismatch: {mismatch}")
+    if any(r["mismatches"] for r in results["backends"].values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Single-walk normalize_wikitables_css against the previous implementation, which
+swept the table once per step (findAll(True) for attributes, one findAll per
+unwrapped tag, and one for sup). Checks that both give the same HTML on the
+wikitables of the crwiki dump and the fixtures, and times them.
+
+    python -m benchmarks.bench_normalize
+"""
+import re
+import sys
+
+import bs4
+import ujson
+
+from benchmarks import fixtures
+from benchmarks.bench_hot_paths import get_raw_wikitables, time_calls
+from core import parse_wikitable_html
+from core.utils import io_worker as iw
+
+# Tables with the cases of normalization order: consecutive header rows, header
+# rows without white spaces, nested unwrapped tags, and tags in footnotes
+EDGE_CASE_TABLES = [
+    '<table class="wikitable" id="t" border="2"><tbody><tr><th>a</th></tr>'
+    "<tr><th>b</th></tr><tr><td>c</td></tr></tbody></table>",
+    '<table class="wikitable" cellpadding="3"><tbody>\n<tr><th class="x">'
+    '<a href="#"><span style="color: red">h<sup><a href="#">[1]</a></sup></span>'
+    '</a></th></tr>\n<tr><td rowspan="2" data-x="y"><div><img src="i"/>d</div>'
+    "</td></tr>\n</tbody></table>",
+]
+
+
+def normalize_wikitables_css_findall(
+    soup, table, unwrap_tags=("a", "span", "link", "img")
+):
+    """Previous implementation of normalize_wikitables_css (reference)"""
+    has_header = False
+    end_header = False
+    thead = soup.new_tag("thead")
+    for i1, tag_1 in enumerate(table):
+        if tag_1.name != "tbody":
+            continue
+        for i2, tag2 in enumerate(tag_1):
+            if tag2.name != "tr":
+                continue
+            if not end_header and all(
+                (col.name in ["th", None] and col.name not in ["td"]) for col in tag2
+            ):
+                tag2.extract()
+                thead.append(tag2)
+                has_header = True
+            else:
+                end_header = True
+    if has_header:
+        table.insert(0, thead)
+
+    def filter_attr(bs_obj, white_tags):
+        bs_obj.attrs = {
+            attr: v for attr, v in bs_obj.attrs.items() if attr in white_tags
+        }
+
+    filter_attr(table, ["border", "cellpadding", "style"])
+    for a in table.find_all(True):
+        filter_attr(a, ["colspan", "headers", "rowspan", "cellpadding", "style"])
+
+    for tag in unwrap_tags:
+        for a in table.find_all(tag):
+            a.unwrap()
+
+    for tag in ["sup"]:
+        for a in table.find_all(tag):
+            a.extract()
+
+    table.attrs["border"] = "1"
+    return table
+
+
+def get_test_tables():
+    """:return: dict of name and raw wikitable HTML (crwiki dump, fixtures, edge cases)"""
+    tables = {}
+    for i, line in enumerate(iw.read_line_from_file(fixtures.FIXTURE_DUMP)):
+        if "wikitable" not in line:
+            continue
+        article_html = ujson.loads(line)["article_body"]["html"]
+        for j, table_html in enumerate(get_raw_wikitables(article_html)):
+            tables[f"crwiki_{i}_{j}"] = table_html
+    for name, article in fixtures.load_fixtures().items():
+        for j, table_html in enumerate(
+            get_raw_wikitables(article["article_body"]["html"])
+        ):
+            tables[f"{name}_{j}"] = table_html
+    for j, table_html in enumerate(EDGE_CASE_TABLES):
+        tables[f"edge_case_{j}"] = table_html
+    return tables
+
+
+def normalize(func, table_html, unwrap_tags):
+    soup = bs4.BeautifulSoup(table_html, "html.parser")
+    table = soup.find("table", {"class": re.compile("wikitable*")})
+    return str(func(soup, table, unwrap_tags=unwrap_tags))
+
+
+def check_parity(tables):
+    """:return: names of tables normalized differently (with and without div)"""
+    mismatches = []
+    unwrap_tags = parse_wikitable_html.UNWRAP_TAGS
+    for name, table_html in tables.items():
+        # normalize_wikitables_css, and convert_html_to_pubtabnet (unwraps div)
+        for tags in [unwrap_tags, unwrap_tags + ("div",)]:
+            new = normalize(
+                parse_wikitable_html.normalize_wikitables_css, table_html, tags
+            )
+            old = normalize(normalize_wikitables_css_findall, table_html, tags)
+            if new != old:
+                mismatches.append(f"{name} (unwrap {', '.join(tags)})")
+    return mismatches
+
+
+def run(repeat=5):
+    """:return: {n_tables, mismatches, fixtures: {name: {findall, single_walk, speedup}}}"""
+    tables = get_test_tables()
+    results = {"n_tables": len(tables), "mismatches": check_parity(tables)}
+    results["fixtures"] = {}
+    for name in fixtures.FIXTURES:
+        table_htmls = [v for k, v in tables.items() if k.startswith(f"{name}_")]
+
+        def make_args():
+            args = []
+            for table_html in table_htmls:
+                soup = bs4.BeautifulSoup(table_html, "html.parser")
+                args.append((soup, soup.find("table")))
+            return args
+
+        old = time_calls(normalize_wikitables_css_findall, make_args, repeat)
+        new = time_calls(
+            parse_wikitable_html.normalize_wikitables_css, make_args, repeat
+        )
+        results["fixtures"][name] = {
+            "findall": old,
+            "single_walk": new,
+            "speedup": round(old["seconds"] / new["seconds"], 2),
+        }
+    return results
+
+
+def main():
+    results = run()
+    iw.print_status(
+        f"Parity: {results['n_tables'] - len(results['mismatches'])}"
+        f"/{results['n_tables']} tables"
+    )
+    for mismatch in results["mismatches"]:
+        iw.print_status(f"  Mismatch: {mismatch}")
+    iw.print_status(
+        f"{'Fixture':<12}{'findAll (ms)':>14}{'Single (ms)':>14}{'Speedup':>10}"
+    )
+    for name, r in results["fixtures"].items():
+        iw.print_status(
+            f"{name:<12}{r['findall']['seconds'] * 1000:>14.3f}"
+            f"{r['single_walk']['seconds'] * 1000:>14.3f}{r['speedup']:>9.2f}x"
+        )
+    if results["mismatches"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
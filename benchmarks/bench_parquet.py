@@ -0,0 +1,154 @@
+"""
+Parquet export (parquet_dump.py) against the jsonl dump: checks that the Parquet
+file reads back the same tables, and times analytics queries, which decode every
+line (with its html) of the jsonl dump, and only the needed columns of the
+Parquet file.
+
+    python -m benchmarks.bench_parquet
+"""
+import os
+import sys
+import tempfile
+import time
+
+import ujson
+
+from benchmarks import fixtures
+from core import parquet_dump, parse_wikitable_html
+from core.utils import io_worker as iw
+
+# Tables of the synthetic dump: the tables of the crwiki dump and of these
+# fixtures, repeated on pages of new wikidata IDs
+SOURCE_FIXTURES = ["tiny_stub", "long_list"]
+N_TABLES = 20000
+ROW_GROUP_SIZE = 2000
+# Every CAPTION_STEP table has a caption
+CAPTION_STEP = 10
+
+
+def get_source_tables():
+    """:return: tables of the crwiki dump and the source fixtures, with tokens"""
+    tables = []
+    for _, line in iw.read_line_with_position(fixtures.FIXTURE_DUMP):
+        if parse_wikitable_html.is_wikitable_candidate(line):
+            tables.extend(parse_wikitable_html.pool_parse_line(line, tokens=True))
+    for name, article in fixtures.load_fixtures().items():
+        if name in SOURCE_FIXTURES:
+            tables.extend(
+                parse_wikitable_html.pool_parse_html_source(article, tokens=True)
+            )
+    return tables
+
+
+def write_dump(dump_file, n_tables=N_TABLES):
+    """Write a synthetic jsonl dump of n_tables tables"""
+    source_tables = get_source_tables()
+    with iw.open_text_writer(dump_file, "w") as f:
+        for i in range(n_tables):
+            table_obj = dict(source_tables[i % len(source_tables)])
+            # Pages of 1 to 3 tables
+            table_obj["wikidata"] = f"Q{i // 3}"
+            table_obj["index"] = i % 3
+            if i % CAPTION_STEP == 0:
+                table_obj["caption"] = f"Caption {i}"
+            f.write(ujson.dumps(table_obj))
+            f.write("\n")
+
+
+def time_query(func, repeat=3):
+    """:return: result and the fastest time of repeat calls"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        run_time = time.perf_counter() - start
+        best = run_time if best is None else min(best, run_time)
+    return result, best
+
+
+def get_queries(dump_file, parquet_file):
+    """:return: dict of query name and (jsonl function, Parquet function)"""
+    wikidata = f"Q{N_TABLES // 6}"
+    return {
+        "count_captions": (
+            lambda: sum(1 for t in iw.read_json_file(dump_file) if t.get("caption")),
+            lambda: parquet_dump.count_parquet_tables(parquet_file, ["caption"]),
+        ),
+        "count_invalid": (
+            lambda: sum(
+                1 for t in iw.read_json_file(dump_file) if t.get("valid") is False
+            ),
+            lambda: parquet_dump.count_parquet_tables(parquet_file, ["valid=false"]),
+        ),
+        "select_wikidata": (
+            lambda: [
+                {"wikidata": t["wikidata"], "index": t["index"], "title": t["title"]}
+                for t in iw.read_json_file(dump_file)
+                if t["wikidata"] == wikidata
+            ],
+            lambda: list(
+                parquet_dump.read_parquet_tables(
+                    parquet_file,
+                    ["wikidata", "index", "title"],
+                    [f"wikidata={wikidata}"],
+                )
+            ),
+        ),
+    }
+
+
+def run(repeat=3):
+    """:return: {n_tables, parity, sizes, queries: {name: {jsonl, parquet, speedup}}}"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dump_file = os.path.join(tmp_dir, "bench.jsonl.bz2")
+        write_dump(dump_file)
+        parquet_file = parquet_dump.export_parquet(
+            dump_file, row_group_size=ROW_GROUP_SIZE, progress=False
+        )
+        results = {
+            "n_tables": N_TABLES,
+            "parity": list(parquet_dump.read_parquet_tables(parquet_file))
+            == list(iw.read_json_file(dump_file)),
+            "sizes": {
+                "jsonl": os.path.getsize(dump_file),
+                "parquet": os.path.getsize(parquet_file),
+            },
+            "queries": {},
+        }
+        for name, (jsonl_query, parquet_query) in get_queries(
+            dump_file, parquet_file
+        ).items():
+            jsonl_result, jsonl_time = time_query(jsonl_query, repeat)
+            parquet_result, parquet_time = time_query(parquet_query, repeat)
+            results["queries"][name] = {
+                "same_result": jsonl_result == parquet_result,
+                "jsonl": round(jsonl_time, 6),
+                "parquet": round(parquet_time, 6),
+                "speedup": round(jsonl_time / parquet_time, 2),
+            }
+    return results
+
+
+def main():
+    results = run()
+    iw.print_status(
+        f"Parity: {results['parity']} ({results['n_tables']:,} tables). Size: "
+        f"jsonl {iw.get_size_of_file(results['sizes']['jsonl'])}, "
+        f"parquet {iw.get_size_of_file(results['sizes']['parquet'])}"
+    )
+    iw.print_status(
+        f"{'Query':<18}{'Same':>6}{'jsonl (s)':>12}{'Parquet (s)':>13}{'Speedup':>10}"
+    )
+    for name, r in results["queries"].items():
+        iw.print_status(
+            f"{name:<18}{str(r['same_result']):>6}{r['jsonl']:>12.3f}"
+            f"{r['parquet']:>13.3f}{r['speedup']:>9.2f}x"
+        )
+    if not results["parity"] or not all(
+        r["same_result"] for r in results["queries"].values()
+    ):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
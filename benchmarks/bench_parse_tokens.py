@@ -0,0 +1,117 @@
+"""
+PubTabNet tokens computed by the parse (table_tokens.get_table_tokens on the
+normalized table HTML) against transform_html_id_text in the render stage.
+Checks that both give the same structure tokens, cell tokens, and validity on
+the wikitables of the crwiki dump, the fixtures, and edge cases, that the text
+runs saved in the dumps expand to the same cell tokens, and times the cost added
+to the parse and saved in the render.
+
+    python -m benchmarks.bench_parse_tokens
+"""
+import sys
+
+import bs4
+
+from benchmarks import bench_normalize
+from benchmarks.bench_hot_paths import time_calls
+from core import parse_wikitable_html, table_tokens, wikitable_to_image
+from core.utils import io_worker as iw
+
+# Tables with the cases of transform_html_id_text: spaces before </td>, line
+# breaks in cells and spans, invalid spans, nested tables, no header, and
+# unclosed tags or carriage returns that lxml reads differently from html.parser
+EDGE_CASE_TABLES = [
+    '<table class="wikitable"><tbody><tr><th>a</th><th> </th></tr>'
+    "<tr><td><b>b</b> </td><td><b>c</b>\n </td><td>d \n</td></tr></tbody></table>",
+    '<table class="wikitable"><tbody><tr><th colspan="2\n">a</th></tr>'
+    '<tr><td rowspan="2">b\nc</td><td>&lt;d&gt; </td><td>e<!--f--> </td></tr>'
+    "</tbody></table>",
+    '<table class="wikitable"><tbody><tr><th>a</th></tr>'
+    '<tr><td colspan="1">b</td></tr></tbody></table>',
+    '<table class="wikitable"><tbody><tr><th>a</th></tr>'
+    "<tr><td><table><tr><td>b</td></tr></table></td></tr></tbody></table>",
+    '<table class="wikitable"><tbody><tr><td>a</td></tr></tbody></table>',
+    '<table class="wikitable"><tbody><tr><th>a</th></tr>'
+    "<tr><td><ul><li>a<li>b</ul></td></tr></tbody></table>",
+    '<table class="wikitable"><tbody><tr><th>a</th></tr>'
+    "<tr><td><p>a<p>b</td></tr></tbody></table>",
+    '<table class="wikitable"><tbody><tr><th>a</th></tr>'
+    "<tr><td>a\r\nb</td><td>c\r</td></tr></tbody></table>",
+]
+
+
+def normalize_table(table_html):
+    soup = bs4.BeautifulSoup(table_html, "html.parser")
+    return parse_wikitable_html.normalize_wikitables_css(soup, soup.find("table"))
+
+
+def get_test_tables():
+    """:return: dict of name and normalized wikitable (bs4 tag)"""
+    tables = bench_normalize.get_test_tables()
+    for j, table_html in enumerate(EDGE_CASE_TABLES):
+        tables[f"edge_case_tokens_{j}"] = table_html
+    return {name: normalize_table(table_html) for name, table_html in tables.items()}
+
+
+def check_parity(tables):
+    """:return: names of tables with different tokens, number of valid tables"""
+    mismatches = []
+    n_valid = 0
+    for name, table in tables.items():
+        struc_tokens, _, cell_tokens, _ = wikitable_to_image.transform_html_id_text(
+            str(table)
+        )
+        parse_struc_tokens, parse_cell_tokens = table_tokens.get_table_tokens(
+            str(table)
+        )
+        if (parse_struc_tokens, parse_cell_tokens) != (struc_tokens, cell_tokens):
+            mismatches.append(name)
+        elif parse_cell_tokens is not None and cell_tokens != [
+            table_tokens.expand_cell_tokens(table_tokens.compact_cell_tokens(t))
+            for t in parse_cell_tokens
+        ]:
+            mismatches.append(f"{name} (text runs)")
+        if struc_tokens is not None:
+            n_valid += 1
+    return mismatches, n_valid
+
+
+def run(repeat=5):
+    """:return: {n_tables, n_valid, mismatches, tokens, transform, render_saving}"""
+    tables = get_test_tables()
+    mismatches, n_valid = check_parity(tables)
+    results = {"n_tables": len(tables), "n_valid": n_valid, "mismatches": mismatches}
+    table_htmls = [(str(t),) for t in tables.values()]
+    # Added to the parse: parse the table HTML again, and tokenize it
+    results["tokens"] = time_calls(
+        table_tokens.get_table_tokens, lambda: table_htmls, repeat
+    )
+    # Saved in the render: the same, and the HTML with cell ids
+    results["transform"] = time_calls(
+        wikitable_to_image.transform_html_id_text, lambda: table_htmls, repeat
+    )
+    results["render_saving"] = round(
+        results["transform"]["seconds"] / results["tokens"]["seconds"], 2
+    )
+    return results
+
+
+def main():
+    results = run()
+    iw.print_status(
+        f"Parity: {results['n_tables'] - len(results['mismatches'])}"
+        f"/{results['n_tables']} tables ({results['n_valid']} valid)"
+    )
+    for mismatch in results["mismatches"]:
+        iw.print_status(f"  Mismatch: {mismatch}")
+    iw.print_status(
+        f"Parse tokens: {results['tokens']['per_call_ms']:.3f} ms/table. "
+        f"Render transform: {results['transform']['per_call_ms']:.3f} ms/table "
+        f"(x{results['render_saving']})"
+    )
+    if results["mismatches"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Startup time of the wtabhtml.py CLI. Lightweight commands, and reading a small
+dump, must start without loading the heavy subsystems (HTML parsers, browser,
+image libraries), see the function-level imports of cli/ and core/jsonl_dump.py.
+
+    python -m benchmarks.bench_startup
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import ujson
+
+DIR_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Commands that must start fast, and the modules they must not import. {dump} is
+# a small jsonl dump (see write_dump)
+COMMANDS = [
+    ["--help"],
+    ["read", "--help"],
+    ["size", "--help"],
+    ["stats", "--help"],
+    ["parse", "--help"],
+    ["download", "--help"],
+    ["gen-images", "--help"],
+    ["export", "--help"],
+    ["read", "-i", "{dump}"],
+    ["size", "-i", "{dump}"],
+]
+HEAVY_MODULES = [
+    "selenium",
+    "cv2",
+    "PIL",
+    "numpy",
+    "bs4",
+    "lxml",
+    "requests",
+    "pyarrow",
+]
+MAX_STARTUP_TIME = 0.5
+# Number of tables of the small dump
+N_DUMP_TABLES = 100
+
+
+def write_dump(dump_file, n_tables=N_DUMP_TABLES):
+    """Write a small jsonl dump (without metadata, so size counts its lines)"""
+    from core.utils import io_worker as iw
+
+    with iw.open_text_writer(dump_file, "w") as f:
+        for i in range(n_tables):
+            table_obj = {
+                "wikidata": f"Q{i}",
+                "index": 0,
+                "title": f"Page {i}",
+                "html": "<table><tbody><tr><td>a</td></tr></tbody></table>",
+            }
+            f.write(ujson.dumps(table_obj))
+            f.write("\n")
+
+
+def get_imported_modules(args):
+    """Top-level packages imported by a CLI command (python -X importtime)"""
+    r = subprocess.run(
+        [sys.executable, "-X", "importtime", "wtabhtml.py", *args],
+        cwd=DIR_REPO,
+        capture_output=True,
+        text=True,
+    )
+    modules = set()
+    for line in r.stderr.splitlines():
+        if line.startswith("import time:") and line.count("|") == 2:
+            name = line.split("|")[2].strip()
+            modules.add(name.split(".")[0])
+    return modules
+
+
+def time_command(args, repeat=5):
+    """:return: median wall time (seconds) of a CLI command in a new process"""
+    run_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "wtabhtml.py", *args],
+            cwd=DIR_REPO,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        run_times.append(time.perf_counter() - start)
+    return statistics.median(run_times)
+
+
+def run(repeat=5, max_startup_time=MAX_STARTUP_TIME):
+    """
+    Measure the startup of the lightweight commands, and of reading a small dump
+    :return: list of results {command, seconds, heavy_modules, ok}
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dump_file = os.path.join(tmp_dir, "small.jsonl.bz2")
+        write_dump(dump_file)
+        for command in COMMANDS:
+            args = [arg.format(dump=dump_file) for arg in command]
+            run_time = time_command(args, repeat)
+            heavy = sorted(get_imported_modules(args) & set(HEAVY_MODULES))
+            results.append(
+                {
+                    "command": " ".join(command),
+                    "seconds": round(run_time, 4),
+                    "heavy_modules": heavy,
+                    "ok": run_time <= max_startup_time and not heavy,
+                }
+            )
+    return results
+
+
+def main():
+    results = run()
+    print(f"{'Command':<20}{'Time (s)':>10}  Heavy modules")
+    for r in results:
+        status = "" if r["ok"] else "  FAIL"
+        heavy = ", ".join(r["heavy_modules"]) or "-"
+        print(f"{r['command']:<20}{r['seconds']:>10.3f}  {heavy}{status}")
+    if not all(r["ok"] for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Regex html_string2list against the previous character loop. Checks that both
+give the same PubTabNet cell tokens on the cells of the fixture tables and on
+random strings of tag characters, and times them.
+
+    python -m benchmarks.bench_tokenizer
+"""
+import random
+import sys
+
+from benchmarks import fixtures
+from benchmarks.bench_hot_paths import get_cell_htmls, time_calls
+from core import parse_wikitable_html, table_tokens
+from core.utils import io_worker as iw
+
+# Characters of random strings: tags, comments, CDATA, entities, and text
+FUZZ_ALPHABET = "<<>>!!--[]/ab &;ᐃ"
+N_FUZZ_STRINGS = 20000
+
+
+def html_string2list_loop(html_string):
+    """Previous implementation of html_string2list (reference)"""
+    list_ = []
+    idx_tag = -1
+    for i, char in enumerate(html_string):
+        if char == "<":
+            idx_tag = i
+        elif idx_tag != -1 and char == ">":
+            html_tag = html_string[idx_tag : i + 1]
+
+            # ignore comment inside cell content
+            if html_tag.startswith("<!--") or html_tag.startswith("<!["):
+                idx_tag = -1
+                continue
+
+            list_.append(html_tag)
+            idx_tag = -1
+        elif idx_tag == -1:
+            list_.append(char)
+
+    return list_
+
+
+def get_fixture_cells():
+    """
+    :return: dict of fixture name and inner HTML of its table cells. The text
+    heavy case is a cell with the whole HTML of the long_list article.
+    """
+    cells = {}
+    for name, article in fixtures.load_fixtures().items():
+        tables = parse_wikitable_html.extract_html_tables_from_html(
+            article["article_body"]["html"]
+        )
+        cells[name] = [c for table in tables for c in get_cell_htmls(table["html"])]
+        if name == "long_list":
+            cells["text_heavy"] = [article["article_body"]["html"]]
+    return cells
+
+
+def get_fuzz_strings(n=N_FUZZ_STRINGS, seed=0):
+    rng = random.Random(seed)
+    return [
+        "".join(rng.choice(FUZZ_ALPHABET) for _ in range(rng.randint(0, 40)))
+        for _ in range(n)
+    ]
+
+
+def check_parity(strings):
+    """:return: strings tokenized differently"""
+    return [
+        s
+        for s in strings
+        if table_tokens.html_string2list(s) != html_string2list_loop(s)
+    ]
+
+
+def run(repeat=5):
+    """:return: {n_strings, mismatches, fixtures: {name: {loop, regex, speedup}}}"""
+    cells = get_fixture_cells()
+    strings = [c for fixture_cells in cells.values() for c in fixture_cells]
+    strings += get_fuzz_strings()
+    results = {"n_strings": len(strings), "mismatches": check_parity(strings)}
+    results["fixtures"] = {}
+    for name, fixture_cells in cells.items():
+        args = [(c,) for c in fixture_cells]
+        old = time_calls(html_string2list_loop, lambda: args, repeat)
+        new = time_calls(table_tokens.html_string2list, lambda: args, repeat)
+        results["fixtures"][name] = {
+            "loop": old,
+            "regex": new,
+            "speedup": round(old["seconds"] / new["seconds"], 2),
+        }
+    return results
+
+
+def main():
+    results = run()
+    iw.print_status(
+        f"Parity: {results['n_strings'] - len(results['mismatches'])}"
+        f"/{results['n_strings']} strings"
+    )
+    for mismatch in results["mismatches"][:10]:
+        iw.print_status(f"  Mismatch: {mismatch!r}")
+    iw.print_status(
+        f"{'Fixture':<12}{'Loop (ms)':>12}{'Regex (ms)':>12}{'Speedup':>10}"
+    )
+    for name, r in results["fixtures"].items():
+        iw.print_status(
+            f"{name:<12}{r['loop']['seconds'] * 1000:>12.3f}"
+            f"{r['regex']['seconds'] * 1000:>12.3f}{r['speedup']:>9.2f}x"
+        )
+    if results["mismatches"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Fixed benchmark articles from the bundled crwiki dump. The dump has only small
+tables, so the huge table fixture repeats the body rows of its largest table.
+"""
+import copy
+import re
+
+import bs4
+import ujson
+
+from config import config as cf
+from core.utils import io_worker as iw
+
+FIXTURE_DUMP = f"{cf.DIR_DUMPS}/crwiki-NS0-20220301-ENTERPRISE-HTML.json.tar.gz"
+
+# Fixture name: (wikidata ID of the article, number of rows of its largest table)
+FIXTURES = {
+    # Smallest article with a wikitable (Ragusa)
+    "tiny_stub": ("Q13674", 0),
+    # Largest article with a wikitable, mostly lists (ᒪᐅᓇᑕ ᐊᑯᐃᐊ)
+    "long_list": ("Q6022566", 0),
+    # The same article, with 2,000 rows in its table
+    "huge_table": ("Q6022566", 2000),
+}
+
+
+def grow_largest_table(article_html, n_rows):
+    """Repeat the last rows of the largest wikitable until it has n_rows rows"""
+    soup = bs4.BeautifulSoup(article_html, "html.parser")
+    tables = soup.find_all("table", {"class": re.compile("wikitable*")})
+    table = max(tables, key=lambda t: len(str(t)))
+    rows = table.find_all("tr")
+    body_rows = [tr for tr in rows if tr.find("td")] or rows
+    tbody = body_rows[-1].parent
+    for i in range(n_rows - len(rows)):
+        tbody.append(copy.copy(body_rows[i % len(body_rows)]))
+    return str(soup)
+
+
+def load_fixtures(dump_file=FIXTURE_DUMP):
+    """:return: dict of fixture name and article (a line of the dump)"""
+    wanted = {wikidata for wikidata, _ in FIXTURES.values()}
+    articles = {}
+    for _, line in iw.read_line_with_position(dump_file):
+        article = ujson.loads(line)
+        wikidata = (article.get("main_entity") or {}).get("identifier")
+        if wikidata in wanted:
+            articles[wikidata] = article
+        if len(articles) == len(wanted):
+            break
+
+    fixtures = {}
+    for name, (wikidata, n_rows) in FIXTURES.items():
+        if wikidata not in articles:
+            raise ValueError(f"Missing fixture article {wikidata} in {dump_file}")
+        article = copy.deepcopy(articles[wikidata])
+        if n_rows:
+            article["article_body"]["html"] = grow_largest_table(
+                article["article_body"]["html"], n_rows
+            )
+        fixtures[name] = article
+    return fixtures
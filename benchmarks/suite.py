@@ -0,0 +1,124 @@
+"""
+Benchmark suite: hot paths on the fixture articles (bench_hot_paths.py) and CLI
+startup (bench_startup.py). Results are saved as JSON with the git commit, so
+runs of two commits can be compared (see compare_results).
+
+    python wtabhtml.py bench -o before.json
+    python wtabhtml.py bench -b before.json
+"""
+import os
+import platform
+import subprocess
+from datetime import datetime
+
+from benchmarks import bench_hot_paths, bench_startup, fixtures
+from config import config as cf
+from core.utils import io_worker as iw
+
+# A function is reported as a regression if it is slower by this ratio
+REGRESSION_RATIO = 1.2
+
+
+def get_git_commit():
+    try:
+        r = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=bench_startup.DIR_REPO,
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return None
+    return r.stdout.strip() or None
+
+
+def get_default_output_file(commit):
+    name = commit or datetime.now().strftime("%Y%m%d%H%M%S")
+    return f"{cf.DIR_MODELS}/benchmarks/bench-{name}.json"
+
+
+def compare_results(baseline, results, ratio=REGRESSION_RATIO):
+    """
+    Print the time of each function of results relative to the baseline
+    :return: number of regressions (slower than baseline by ratio)
+    """
+    iw.print_status(
+        f"Compare {results.get('commit')} with baseline {baseline.get('commit')}"
+    )
+    iw.print_status(f"{'Fixture':<12}{'Function':<32}{'Base (s)':>10}{'New (s)':>10}")
+    n_regressions = 0
+    for name, fixture in results["fixtures"].items():
+        base_functions = baseline.get("fixtures", {}).get(name, {}).get("functions")
+        for func_name, stats in fixture["functions"].items():
+            base = (base_functions or {}).get(func_name)
+            if not base or not base["seconds"]:
+                continue
+            change = stats["seconds"] / base["seconds"]
+            status = ""
+            if change > ratio:
+                status = "  SLOWER"
+                n_regressions += 1
+            iw.print_status(
+                f"{name:<12}{func_name:<32}{base['seconds']:>10.4f}"
+                f"{stats['seconds']:>10.4f}  x{change:.2f}{status}"
+            )
+    return n_regressions
+
+
+def run_benchmarks(
+    output_file=None,
+    repeat=5,
+    render_backend="browser",
+    startup=True,
+    baseline_file=None,
+):
+    """
+    Run the benchmark suite, and save the results to a JSON file
+    :param output_file: default: {cf.DIR_MODELS}/benchmarks/bench-{commit}.json
+    :param repeat: keep the fastest of repeat runs of each function
+    :param startup: also time the CLI startup (see bench_startup)
+    :param baseline_file: compare the results with a previous results file
+    :return: results, number of regressions (0 without baseline)
+    """
+    commit = get_git_commit()
+    results = {
+        "commit": commit,
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "fixtures": bench_hot_paths.run(
+            fixtures.load_fixtures(), repeat=repeat, render_backend=render_backend
+        ),
+    }
+    if startup:
+        results["startup"] = bench_startup.run(repeat=repeat)
+
+    iw.print_status(
+        f"{'Fixture':<12}{'Pages/s':>10}{'Tables/s':>10}{'Render/s':>10}"
+        f"{'RSS (MB)':>10}"
+    )
+    for name, fixture in results["fixtures"].items():
+        iw.print_status(
+            f"{name:<12}{fixture['pages_per_sec']:>10,.1f}"
+            f"{fixture['tables_per_sec']['parse']:>10,.1f}"
+            f"{fixture['tables_per_sec']['render']:>10,.1f}"
+            f"{fixture['peak_rss_mb']:>10,.1f}"
+        )
+        for func_name, stats in fixture["functions"].items():
+            iw.print_status(
+                f"  {func_name:<32}{stats['calls']:>6,} calls"
+                f"{stats['per_call_ms']:>12.3f} ms/call"
+            )
+    for r in results.get("startup", []):
+        iw.print_status(f"Startup: {r['command']:<20}{r['seconds']:>8.3f}s")
+
+    if not output_file:
+        output_file = get_default_output_file(commit)
+    iw.save_json_file(output_file, results)
+    iw.print_status(f"Saved: {os.path.abspath(output_file)}")
+
+    n_regressions = 0
+    if baseline_file:
+        n_regressions = compare_results(iw.load_json_file(baseline_file), results)
+    return results, n_regressions
@@ -1,5 +1,5 @@
 import click
-from cli import downloader, parser, reader, pipeline
+from cli import bench, downloader, parser, reader, pipeline
 
 cli_wikitables = click.CommandCollection(
     sources=[
@@ -7,5 +7,6 @@ cli_wikitables = click.CommandCollection(
         reader.cli_reader,
         downloader.cli_downloader,
         pipeline.cli_pipeline,
+        bench.cli_bench,
     ]
 )
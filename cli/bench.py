@@ -0,0 +1,58 @@
+import sys
+
+import click
+from config import config as cf
+
+
+@click.group()
+def cli_bench():
+    pass
+
+
+@cli_bench.command()
+@click.option(
+    "-o",
+    "--output_file",
+    default=None,
+    help="Save the results to a JSON file (default: data/models/benchmarks/bench-{commit}.json)",
+)
+@click.option(
+    "-b",
+    "--baseline_file",
+    default=None,
+    help="Compare with the results of a previous run, exit 1 on regressions",
+)
+@click.option(
+    "-n",
+    "--repeat",
+    default=5,
+    show_default=True,
+    help="Keep the fastest of n runs of each function",
+)
+@click.option(
+    "-r",
+    "--render_backend",
+    default="browser",
+    show_default=True,
+    type=click.Choice(cf.RENDER_BACKENDS),
+    help="Benchmark html_to_img (browser) or table_layout (PIL)",
+)
+@click.option(
+    "-s",
+    "--skip_startup",
+    is_flag=True,
+    default=False,
+    help="Do not benchmark the CLI startup",
+)
+def bench(output_file, baseline_file, repeat, render_backend, skip_startup):
+    from benchmarks import suite
+
+    _, n_regressions = suite.run_benchmarks(
+        output_file=output_file,
+        repeat=repeat,
+        render_backend=render_backend,
+        startup=not skip_startup,
+        baseline_file=baseline_file,
+    )
+    if n_regressions:
+        sys.exit(1)
@@ -1,6 +1,5 @@
 import click
 from config import config as cf
-from core.downloader import download_wikipedia_html_dump
 
 
 @click.group()
@@ -21,7 +20,27 @@ def cli_downloader():
     "--language",
     default="ja",
     show_default=True,
-    help="Download the Wikipedia dump of language edition",
+    help="Download the Wikipedia dump of language edition (all: all languages)",
 )
-def download(wikipedia_version, language):
-    download_wikipedia_html_dump(wikipedia_version, language)
+@click.option(
+    "-t",
+    "--n_transfers",
+    default=4,
+    show_default=True,
+    help="Download n dumps concurrently",
+)
+@click.option(
+    "-c",
+    "--per_host",
+    default=2,
+    show_default=True,
+    help="Maximum connections to the dump server",
+)
+def download(wikipedia_version, language, n_transfers, per_host):
+    from core.downloader import download_wikipedia_html_dumps
+
+    languages = cf.LANGS if language == "all" else [language]
+    for _ in download_wikipedia_html_dumps(
+        wikipedia_version, languages, n_transfers=n_transfers, per_host=per_host
+    ):
+        pass
@@ -1,6 +1,5 @@
 import click
 from config import config as cf
-from core import parse_wikitable_html
 
 
 @click.group()
@@ -26,7 +25,106 @@ def cli_parser():
 @click.option(
     "-t", "--limit_table", default=0, show_default=True, help="Save # number of tables",
 )
-def parse(language, downloaded_file, limit_table):
+@click.option(
+    "-w",
+    "--workers",
+    default=1,
+    show_default=True,
+    help="Parse pages with # worker processes",
+)
+@click.option(
+    "-b",
+    "--html_backend",
+    default="bs4",
+    show_default=True,
+    type=click.Choice(cf.HTML_BACKENDS),
+    help="HTML parser to find and normalize wikitables. lxml and selectolax are faster, with the same output as bs4",
+)
+@click.option(
+    "-r",
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Continue from the last checkpoint of an interrupted parse",
+)
+@click.option(
+    "-p",
+    "--previous_dump",
+    default=None,
+    show_default=True,
+    help="Parsed dump of a previous version. Save only new and changed tables, and "
+    "tombstones of deleted tables",
+)
+@click.option(
+    "-d",
+    "--dedup",
+    is_flag=True,
+    default=False,
+    help="Save duplicate tables (same html) as references to the first table",
+)
+@click.option(
+    "-m",
+    "--stream",
+    is_flag=True,
+    default=False,
+    help="Parse the dump while downloading it, without storing it",
+)
+@click.option(
+    "-e",
+    "--tee",
+    is_flag=True,
+    default=False,
+    help="Also save the streamed dump to the dump folder",
+)
+@click.option(
+    "-o",
+    "--metrics_file",
+    default=None,
+    help="Save counters and time per stage to a JSON or Prometheus text (.prom) file",
+)
+@click.option(
+    "-u",
+    "--metrics_interval",
+    default=60,
+    show_default=True,
+    help="Print a metrics summary line every n seconds (0: only at the end)",
+)
+@click.option(
+    "-k",
+    "--tokens",
+    is_flag=True,
+    default=False,
+    help="Also save the PubTabNet tokens of tables, computed by parsing each table again with lxml. The PIL render backend lays them out without tokenizing the tables again. The browser backend still tokenizes them, so it only skips the invalid tables. Dump lines are about 1.7x larger",
+)
+def parse(
+    language,
+    downloaded_file,
+    limit_table,
+    workers,
+    html_backend,
+    resume,
+    previous_dump,
+    dedup,
+    stream,
+    tee,
+    metrics_file,
+    metrics_interval,
+    tokens,
+):
+    from core import parse_wikitable_html
+
     parse_wikitable_html.dump_wikitables(
-        lang=language, input_file=downloaded_file, limit=limit_table
+        lang=language,
+        input_file=downloaded_file,
+        limit=limit_table,
+        n_workers=workers,
+        html_backend=html_backend,
+        resume=resume,
+        previous_file=previous_dump,
+        dedup=dedup,
+        stream=stream,
+        tee_dir=cf.DIR_DUMPS if tee else None,
+        metrics_file=metrics_file,
+        metrics_interval=metrics_interval,
+        tokens=tokens,
     )
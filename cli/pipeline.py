@@ -1,12 +1,16 @@
+import multiprocessing
 import os
+import queue
+import threading
 from contextlib import closing
 from multiprocessing import Pool
 
 import click
 from config import config as cf
-from core import parse_wikitable_html, downloader
 from core.utils import io_worker as iw
-from core import wikitable_to_image
+
+# The core modules are imported by the functions that use them, so that the CLI
+# starts without loading parsers, browsers and image libraries
 
 
 @click.group()
@@ -15,32 +19,38 @@ def cli_pipeline():
 
 
 def pool_run_dump(args):
-    wikipedia_version, language = args
-    downloaded_file = downloader.download_wikipedia_html_dump(
-        wikipedia_version, language
-    )
-    if not downloaded_file:
-        return None
+    from core import parse_wikitable_html
+
+    language, downloaded_file = args
     dump_file = parse_wikitable_html.dump_wikitables(
         lang=language, input_file=downloaded_file, progress=True
     )
-    return dump_file
+    return language, dump_file
 
 
-def run_dump(wikipedia_version, language, n_threads):
+def run_dump(wikipedia_version, language, n_threads, n_transfers=4, per_host=2):
+    from core import downloader
+
     if language != "all":
         languages = [language]
     else:
         languages = cf.LANGS
 
-    args = [[wikipedia_version, l] for l in reversed(languages)]
+    # Dumps are parsed as soon as they are downloaded
+    downloads = downloader.download_wikipedia_html_dumps(
+        wikipedia_version,
+        list(reversed(languages)),
+        n_transfers=n_transfers,
+        per_host=per_host,
+    )
+    args = ((l, f) for l, f in downloads if f)
 
     with closing(Pool(processes=n_threads)) as p:
-        for i, dump_file in enumerate(p.imap_unordered(pool_run_dump, args)):
+        for i, (l, dump_file) in enumerate(p.imap_unordered(pool_run_dump, args)):
             if not dump_file:
                 continue
             dump_size = iw.get_size_of_file(os.path.getsize(dump_file))
-            print(f"{i + 1}. Dump {language} Saved: {dump_size} - {dump_file}: ")
+            print(f"{i + 1}. Dump {l} Saved: {dump_size} - {dump_file}: ")
 
 
 @cli_pipeline.command()
@@ -61,8 +71,219 @@ def run_dump(wikipedia_version, language, n_threads):
 @click.option(
     "-n", "--n_threads", default=1, show_default=True, help="Run n multiprocessors",
 )
-def dump_json(wikipedia_version, language, n_threads):
-    run_dump(wikipedia_version, language, n_threads)
+@click.option(
+    "-t",
+    "--n_transfers",
+    default=4,
+    show_default=True,
+    help="Download n dumps concurrently",
+)
+@click.option(
+    "-c",
+    "--per_host",
+    default=2,
+    show_default=True,
+    help="Maximum connections to the dump server",
+)
+def dump_json(wikipedia_version, language, n_threads, n_transfers, per_host):
+    run_dump(wikipedia_version, language, n_threads, n_transfers, per_host)
+
+
+def pool_parse_to_queue(
+    language,
+    input_file,
+    n_parsers,
+    table_queue,
+    stream_event=None,
+    tee_dir=None,
+    metrics_file=None,
+    metrics_interval=60,
+    tokens=False,
+):
+    from core import parse_wikitable_html
+
+    parse_wikitable_html.dump_wikitables(
+        lang=language,
+        input_file=input_file,
+        progress=False,
+        n_workers=n_parsers,
+        table_queue=table_queue,
+        stream_event=stream_event,
+        tee_dir=tee_dir,
+        metrics_file=metrics_file,
+        metrics_interval=metrics_interval,
+        tokens=tokens,
+    )
+
+
+def run_pipeline(
+    wikipedia_version,
+    language,
+    n_transfers=4,
+    per_host=2,
+    n_parsers=1,
+    n_renderers=1,
+    render_backend="browser",
+    shard_size=1 << 30,
+    incremental=False,
+    queue_size=64,
+    stream=False,
+    tee=False,
+    metrics_file=None,
+    metrics_interval=60,
+    tokens=False,
+):
+    """
+    Download, parse, and render languages as a pipeline. The stages work on
+    different languages at the same time (e.g., download C, parse B, render A),
+    and the tables of a language are rendered while the language is parsed.
+    The next language is parsed while a language is rendered: its parser does
+    not wait for rendering, the tables that do not fit in its queue are read
+    from its dump (see dump_wikitables stream_event). Its parser is started when
+    the renderer is free or busy with the previous language, so at most two
+    languages are parsed at once.
+    :param n_transfers: number of concurrent downloads
+    :param n_parsers: number of processes to parse a dump
+    :param n_renderers: number of processes to render tables
+    :param queue_size: maximum number of parsed table batches of a language
+    waiting for rendering
+    :param stream: parse the dumps while downloading them, without storing them
+    (the download and parse stages are merged)
+    :param tee: also save the streamed dumps to cf.DIR_DUMPS
+    :param metrics_file: save the metrics of each stage and language, e.g.,
+    metrics.prom -> metrics.parse.ja.prom, metrics.render.ja.prom
+    :param metrics_interval: print metrics summary lines every n seconds
+    :param tokens: compute the PubTabNet tokens of tables while parsing them
+    (see add_table_tokens). Invalid tables are not rendered, and the PIL backend
+    lays out the tokens without tokenizing the tables again. The browser backend
+    still tokenizes the tables it renders
+    """
+    from core import downloader, wikitable_to_image
+    from core.utils.metrics import get_metrics_file
+
+    if language != "all":
+        languages = [language]
+    else:
+        languages = cf.LANGS
+    languages = list(reversed(languages))
+
+    # Languages to render in order, with the queue of their parsed tables (None
+    # ends the tables) and the event set when they are rendered. One language
+    # waits while another is rendered
+    render_languages = queue.Queue(maxsize=1)
+    # Running parser processes, stopped if rendering fails
+    parsers = []
+
+    def end_tables(parser, table_queue):
+        parser.join()
+        # After all tables put by the parser
+        table_queue.put(None)
+
+    # Languages parsed by a previous run are rendered from their dumps
+    parsed = [
+        lang
+        for lang in languages
+        if os.path.exists(f"{cf.DIR_MODELS}/wikitables_html_pubtabnet/{lang}.jsonl.bz2")
+    ]
+    to_parse = [lang for lang in languages if lang not in parsed]
+    # Downloaded languages (None ends them). The downloads run in their own
+    # thread, so they do not wait while the parsed languages are rendered
+    downloaded = queue.Queue()
+
+    def download():
+        try:
+            if stream:
+                downloads = (
+                    (
+                        lang,
+                        cf.URL_WP_HTML.format(
+                            wikipedia_version=wikipedia_version, lang=lang
+                        ),
+                    )
+                    for lang in to_parse
+                )
+            else:
+                downloads = downloader.download_wikipedia_html_dumps(
+                    wikipedia_version,
+                    to_parse,
+                    n_transfers=n_transfers,
+                    per_host=per_host,
+                )
+            for lang, input_file in downloads:
+                downloaded.put((lang, input_file))
+        finally:
+            downloaded.put(None)
+
+    def download_and_parse():
+        try:
+            for lang in parsed:
+                render_languages.put((lang, None, None))
+
+            tee_dir = cf.DIR_DUMPS if stream and tee else None
+            for lang, input_file in iter(downloaded.get, None):
+                if not input_file:
+                    continue
+                table_queue = multiprocessing.Queue(maxsize=queue_size)
+                stream_event = multiprocessing.Event()
+                render_languages.put((lang, table_queue, stream_event))
+                parser = multiprocessing.Process(
+                    target=pool_parse_to_queue,
+                    args=(
+                        lang,
+                        input_file,
+                        n_parsers,
+                        table_queue,
+                        stream_event,
+                        tee_dir,
+                        get_metrics_file(metrics_file, "parse", lang),
+                        metrics_interval,
+                        tokens,
+                    ),
+                )
+                parser.start()
+                parsers.append(parser)
+                threading.Thread(
+                    target=end_tables, args=(parser, table_queue), daemon=True
+                ).start()
+        finally:
+            render_languages.put(None)
+
+    threading.Thread(target=download, daemon=True).start()
+    producer = threading.Thread(target=download_and_parse, daemon=True)
+    producer.start()
+
+    iw.print_status(f"No\tLang\tImages\tErrors\tRunTime")
+    i = 0
+    try:
+        while True:
+            item = render_languages.get()
+            if item is None:
+                break
+            lang, table_queue, stream_event = item
+            if stream_event is not None:
+                # The parser waits for the queue from now on
+                stream_event.set()
+            n_errors, n_images, run_time = wikitable_to_image.gen_images(
+                wikipedia_version=wikipedia_version,
+                lang=lang,
+                n_threads=n_renderers,
+                render_backend=render_backend,
+                shard_size=shard_size,
+                incremental=incremental,
+                table_queue=table_queue,
+                metrics_file=get_metrics_file(metrics_file, "render", lang),
+                metrics_interval=metrics_interval,
+            )
+            i += 1
+            iw.print_status(f"{i}\t{lang}\t{n_images:,}\t{n_errors:,}\t{run_time:.2f}")
+    except BaseException:
+        # Nothing renders the parsed tables anymore (e.g., the browser cannot
+        # start). Stop the parsers, they would wait for the table queues forever.
+        for parser in parsers:
+            if parser.is_alive():
+                parser.terminate()
+        raise
+    producer.join()
 
 
 @cli_pipeline.command()
@@ -81,40 +302,121 @@ def dump_json(wikipedia_version, language, n_threads):
     help="Parse the Wikipedia dump of language edition",
 )
 @click.option(
-    "-n", "--n_threads", default=1, show_default=True, help="Run n multiprocessors",
+    "-n",
+    "--n_threads",
+    default=1,
+    show_default=True,
+    help="Render tables with n processes",
+)
+@click.option(
+    "-w",
+    "--n_parsers",
+    default=1,
+    show_default=True,
+    help="Parse a dump with n processes",
+)
+@click.option(
+    "-t",
+    "--n_transfers",
+    default=4,
+    show_default=True,
+    help="Download n dumps concurrently",
 )
 @click.option(
     "-c",
-    "--compress",
-    default=False,
+    "--per_host",
+    default=2,
     show_default=True,
-    help="Compress the output dataset or not",
+    help="Maximum connections to the dump server",
 )
 @click.option(
-    "-d",
-    "--delete_org",
+    "-s",
+    "--shard_size",
+    default=1024,
+    show_default=True,
+    help="Target size (MB) of output tar shards",
+)
+@click.option(
+    "-r",
+    "--render_backend",
+    default="browser",
+    show_default=True,
+    type=click.Choice(cf.RENDER_BACKENDS),
+    help="Render tables with a browser (Firefox) or with PIL (no browser)",
+)
+@click.option(
+    "-i",
+    "--incremental",
+    is_flag=True,
     default=False,
+    help="Keep the rendered shards, and render only new and changed tables",
+)
+@click.option(
+    "-m",
+    "--stream",
+    is_flag=True,
+    default=False,
+    help="Parse the dumps while downloading them, without storing them",
+)
+@click.option(
+    "-e",
+    "--tee",
+    is_flag=True,
+    default=False,
+    help="Also save the streamed dumps to the dump folder",
+)
+@click.option(
+    "-o",
+    "--metrics_file",
+    default=None,
+    help="Save counters and time per stage to JSON or Prometheus text (.prom) files, one per stage and language",
+)
+@click.option(
+    "-u",
+    "--metrics_interval",
+    default=60,
     show_default=True,
-    help="Delete the original folder after compressing",
+    help="Print a metrics summary line every n seconds (0: only at the end)",
 )
-def gen_images(wikipedia_version, language, n_threads, compress, delete_org):
-    if language != "all":
-        languages = [language]
-    else:
-        languages = cf.LANGS
-
-    iw.print_status(f"No\tLang\tImages\tErrors\tRunTime")
-    for i, language in enumerate(reversed(languages)):
-        n_errors, n_images, run_time = wikitable_to_image.gen_images(
-            wikipedia_version=wikipedia_version,
-            lang=language,
-            n_threads=n_threads,
-            compress=compress,
-            delete_org=delete_org,
-        )
-        iw.print_status(
-            f"{i + 1}\t{language}\t{n_images:,}\t{n_errors:,}\t{run_time:.2f}"
-        )
+@click.option(
+    "-k",
+    "--tokens",
+    is_flag=True,
+    default=False,
+    help="Compute the PubTabNet tokens of tables while parsing, by parsing each table again with lxml. The PIL render backend lays them out without tokenizing the tables again. The browser backend still tokenizes them, so it only skips the invalid tables. Dump lines are about 1.7x larger",
+)
+def gen_images(
+    wikipedia_version,
+    language,
+    n_threads,
+    n_parsers,
+    n_transfers,
+    per_host,
+    shard_size,
+    render_backend,
+    incremental,
+    stream,
+    tee,
+    metrics_file,
+    metrics_interval,
+    tokens,
+):
+    run_pipeline(
+        wikipedia_version,
+        language,
+        n_transfers=n_transfers,
+        per_host=per_host,
+        n_parsers=n_parsers,
+        n_renderers=n_threads,
+        render_backend=render_backend,
+        shard_size=shard_size << 20,
+        incremental=incremental,
+        stream=stream,
+        tee=tee,
+        metrics_file=metrics_file,
+        metrics_interval=metrics_interval,
+        tokens=tokens,
+    )
 
 
 if __name__ == "__main__":
@@ -1,7 +1,5 @@
 import click
 
-from core import parse_wikitable_html
-
 
 @click.group()
 def cli_reader():
@@ -10,13 +8,61 @@ def cli_reader():
 
 @cli_reader.command()
 @click.option(
-    "--input_file", "-i", help="Read the JSON dump of Wikipedia tables",
+    "--input_file", "-i", help="Read the JSON (or Parquet) dump of Wikipedia tables",
 )
 @click.option(
     "--limit", "-l", default=0, help="Return first limit tables",
 )
-def read(input_file, limit):
-    parse_wikitable_html.read_wikitable_dumps(input_file, limit)
+@click.option(
+    "--columns",
+    "-c",
+    default=None,
+    help="Parquet dump: read only these columns, e.g., wikidata,index,caption",
+)
+@click.option(
+    "--filters",
+    "-f",
+    multiple=True,
+    help="Parquet dump: read only the tables matching all filters, e.g., -f caption "
+    "-f wikidata=Q1490 -f index>=1",
+)
+def read(input_file, limit, columns, filters):
+    if input_file.endswith(".parquet"):
+        from core import parquet_dump
+
+        columns = columns.split(",") if columns else None
+        parquet_dump.read_parquet_dump(input_file, limit, columns, filters)
+        return
+
+    if columns or filters:
+        raise click.UsageError("--columns and --filters need a Parquet dump")
+
+    from core import jsonl_dump
+
+    jsonl_dump.read_wikitable_dumps(input_file, limit)
+
+
+@cli_reader.command()
+@click.option(
+    "--input_file", "-i", help="The JSON dump of Wikipedia tables",
+)
+@click.option(
+    "--output_file",
+    "-o",
+    default=None,
+    help="Parquet file. Default: the dump file with the .parquet extension",
+)
+@click.option(
+    "--row_group_size",
+    "-g",
+    default=10000,
+    show_default=True,
+    help="Number of tables per row group",
+)
+def export(input_file, output_file, row_group_size):
+    from core import parquet_dump
+
+    parquet_dump.export_parquet(input_file, output_file, row_group_size)
 
 
 @cli_reader.command()
@@ -24,7 +70,15 @@ def read(input_file, limit):
     "--input_file", "-i", help="Read the JSON dump of Wikipedia tables",
 )
 def size(input_file):
-    print(parse_wikitable_html.get_jsonl_size(input_file))
+    if input_file.endswith(".parquet"):
+        from core import parquet_dump
+
+        print(parquet_dump.count_parquet_tables(input_file))
+        return
+
+    from core import jsonl_dump
+
+    print(jsonl_dump.get_jsonl_size(input_file))
 
 
 @cli_reader.command()
@@ -32,4 +86,6 @@ def size(input_file):
     "--input_folder", "-i", help="The folder of Wikitable JSON dumps",
 )
 def stats(input_folder):
-    parse_wikitable_html.read_wikitable_dumps(input_folder)
+    from core import jsonl_dump
+
+    jsonl_dump.read_wikitable_dumps(input_folder)
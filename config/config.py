@@ -11,11 +11,25 @@ DIR_DUMPS = f"{DIR_ROOT}/data/dump"
 DIR_MODELS = f"{DIR_ROOT}/data/models"
 DIR_CONFIG = f"{DIR_ROOT}/config"
 
-# 322 languages of Wikipedia
-LANGS = iw.read_tsv_file_first_col(f"{DIR_CONFIG}/LANGS_322.tsv", ENCODING)
-
-HTML_HEADERS = iw.read_tsv_file_first_col(
-    f"{DIR_CONFIG}/TAGS_HTML_HEADERS.tsv", ENCODING
-)
+# HTML parsers to find wikitables, and table renderers
+HTML_BACKENDS = ["bs4", "lxml", "selectolax"]
+RENDER_BACKENDS = ["browser", "pil"]
 
 URL_WP_HTML = "https://dumps.wikimedia.org/other/enterprise_html/runs/{wikipedia_version}/{lang}wiki-NS0-{wikipedia_version}-ENTERPRISE-HTML.json.tar.gz"
+
+# Constants read from config files when they are first used (see __getattr__)
+LAZY_TSV_FILES = {
+    # 322 languages of Wikipedia
+    "LANGS": "LANGS_322.tsv",
+    "HTML_HEADERS": "TAGS_HTML_HEADERS.tsv",
+}
+
+
+def __getattr__(name):
+    # Module attribute fallback (PEP 562): cf.LANGS reads LANGS_322.tsv on first use,
+    # and is a plain module attribute afterwards
+    if name not in LAZY_TSV_FILES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = iw.read_tsv_file_first_col(f"{DIR_CONFIG}/{LAZY_TSV_FILES[name]}", ENCODING)
+    globals()[name] = value
+    return value
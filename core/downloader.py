@@ -1,3 +1,11 @@
+import hashlib
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from itertools import islice
+from urllib.parse import urlparse
+
 from tqdm import tqdm
 
 from config import config as cf
@@ -5,39 +13,342 @@ import os
 from core.utils import io_worker as iw
 import requests
 
+# Read and write downloads in 1 MB chunks
+CHUNK_SIZE = 1 << 20
+TIMEOUT = 60
+CHECKSUM_ALGORITHMS = ["md5", "sha1"]
+
+
+def get_host(download_url):
+    return urlparse(download_url).netloc
+
+
+def get_published_checksum(session, download_url):
+    """
+    Get the checksum published next to a file ({url}.md5 or {url}.sha1, in the
+    md5sum format "digest  file_name")
+    :return: (algorithm, hex digest), or None if no checksum is published
+    """
+    for algorithm in CHECKSUM_ALGORITHMS:
+        try:
+            r = session.get(f"{download_url}.{algorithm}", timeout=TIMEOUT)
+        except requests.RequestException:
+            continue
+        if r.status_code != 200 or not r.text.split():
+            continue
+        digest = r.text.split()[0].lower()
+        if len(digest) == hashlib.new(algorithm).digest_size * 2:
+            return algorithm, digest
+    return None
+
+
+def hash_file(file_name, algorithm, chunk_size=CHUNK_SIZE):
+    hasher = hashlib.new(algorithm)
+    with open(file_name, "rb") as f:
+        for data in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def update_progress(p_bar, progress, total=None, n=None):
+    """
+    Set the total size and the downloaded bytes of a file in the shared progress
+    bar. progress is {"total", "n"}: what the file added to the bar so far
+    """
+    if p_bar is None:
+        return
+    with p_bar.get_lock():
+        if total is not None:
+            p_bar.total += total - progress["total"]
+            progress["total"] = total
+        if n is not None:
+            p_bar.update(n - progress["n"])
+            progress["n"] = n
+
+
+def transfer(
+    session, download_url, part_file, chunk_size=CHUNK_SIZE, p_bar=None, progress=None
+):
+    """
+    Download the rest of part_file with an HTTP Range request
+    :param progress: {"total", "n"} of the file in p_bar (see update_progress), kept
+    between the transfers of a file, so a file is counted once
+    :return: True if part_file is complete, False if the server refuses the request
+    """
+    if progress is None:
+        progress = {"total": 0, "n": 0}
+    offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    n_bytes = 0
+    with session.get(download_url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+        if r.status_code == 416:
+            # Nothing after offset: the part file is complete
+            update_progress(p_bar, progress, total=offset, n=offset)
+            return True
+        if r.status_code not in [200, 206]:
+            iw.print_status(f"Error {r.status_code}: {download_url}")
+            return False
+        if r.status_code == 200:
+            # The server ignores the range, download from the start
+            offset = 0
+        size = int(r.headers.get("content-length", 0))
+        # The bytes of the part file are downloaded
+        update_progress(p_bar, progress, total=offset + size, n=offset)
+        with open(part_file, "ab" if offset else "wb", buffering=chunk_size) as f:
+            for data in r.iter_content(chunk_size):
+                f.write(data)
+                n_bytes += len(data)
+                if p_bar is not None:
+                    p_bar.update(len(data))
+                    progress["n"] += len(data)
+    if size and n_bytes < size:
+        raise requests.ConnectionError(
+            f"Incomplete download: {n_bytes:,} / {size:,} bytes of {download_url}"
+        )
+    return True
 
-def download_file(download_url):
+
+def is_complete_file(session, file_name, download_url, checksum, chunk_size=CHUNK_SIZE):
+    """
+    Check a downloaded file with its checksum if any, otherwise with the remote
+    size (unknown sizes are not checked)
+    """
+    if checksum:
+        algorithm, digest = checksum
+        return hash_file(file_name, algorithm, chunk_size) == digest
+    try:
+        r = session.head(download_url, allow_redirects=True, timeout=TIMEOUT)
+    except requests.RequestException:
+        return True
+    size = int(r.headers.get("content-length", 0)) if r.status_code == 200 else 0
+    return not size or os.path.getsize(file_name) == size
+
+
+def download_file(
+    download_url,
+    download_dir=cf.DIR_DUMPS,
+    host_limits=None,
+    checksum=None,
+    verify=True,
+    retries=5,
+    chunk_size=CHUNK_SIZE,
+    p_bar=None,
+):
+    """
+    Download a file to download_dir. The data is written to {file}.part, and an
+    interrupted download is resumed with an HTTP Range request. The file is renamed
+    when it is complete, and its checksum matches. A file already in download_dir
+    is checked (see is_complete_file), and resumed if it is not complete, e.g., a
+    file truncated by an older version of the downloader.
+    :param host_limits: dict of host and semaphore, to limit connections per host
+    :param checksum: (algorithm, hex digest). By default, the checksum published
+    next to the file is used (see get_published_checksum), if any
+    :param verify: verify the checksum of the downloaded file, and of the file
+    already in download_dir
+    :param retries: retry a failed transfer from the end of the part file
+    :param p_bar: shared tqdm progress bar (bytes)
+    :return: downloaded file, or None
+    """
     dump_file = download_url.split("/")[-1]
-    downloaded_file = f"{cf.DIR_DUMPS}/{dump_file}"
+    downloaded_file = f"{download_dir}/{dump_file}"
 
-    if os.path.exists(downloaded_file):
+    # Downloads are renamed when they are complete
+    if os.path.exists(downloaded_file) and not verify:
         return downloaded_file
     iw.create_dir(downloaded_file)
-    r = requests.get(download_url, stream=True)
-    if r.status_code != 200:
-        return None
+    part_file = downloaded_file + ".part"
+
+    host_limit = host_limits.get(get_host(download_url)) if host_limits else None
+    with host_limit or nullcontext(), requests.Session() as session:
+        if verify and checksum is None:
+            checksum = get_published_checksum(session, download_url)
+
+        if os.path.exists(downloaded_file):
+            if is_complete_file(
+                session, downloaded_file, download_url, checksum, chunk_size
+            ):
+                return downloaded_file
+            iw.print_status(f"Incomplete file, resume the download: {downloaded_file}")
+            os.replace(downloaded_file, part_file)
+
+        is_completed = False
+        # Size and downloaded bytes of the file in p_bar, for all attempts
+        progress = {"total": 0, "n": 0}
+        for attempt in range(retries + 1):
+            try:
+                is_completed = transfer(
+                    session, download_url, part_file, chunk_size, p_bar, progress
+                )
+                break
+            except requests.RequestException as e:
+                iw.print_status(f"Download error (attempt {attempt + 1}): {e}")
+                time.sleep(min(2**attempt, 60))
+        if not is_completed:
+            return None
+
+    if verify and checksum:
+        algorithm, digest = checksum
+        if hash_file(part_file, algorithm, chunk_size) != digest:
+            iw.print_status(f"Wrong {algorithm} checksum: {download_url}")
+            iw.delete_file(part_file)
+            return None
+    os.replace(part_file, downloaded_file)
+    return downloaded_file
+
+
+def is_url(file_name):
+    return file_name.startswith(("http://", "https://"))
+
+
+def get_remote_size(download_url):
+    try:
+        r = requests.head(download_url, allow_redirects=True, timeout=TIMEOUT)
+    except requests.RequestException:
+        return 0
+    return int(r.headers.get("content-length", 0))
+
+
+class StreamReader:
+    """
+    Read an HTTP body, count the read bytes (tell), and optionally write them to a
+    file (tee)
+    """
+
+    def __init__(self, raw, tee_file=None, chunk_size=CHUNK_SIZE):
+        self.raw = raw
+        self.n_bytes = 0
+        self.tee = open(tee_file, "wb", buffering=chunk_size) if tee_file else None
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.n_bytes += len(data)
+        if self.tee:
+            self.tee.write(data)
+        return data
+
+    def tell(self):
+        return self.n_bytes
+
+    def close(self):
+        if self.tee:
+            self.tee.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_line_from_url(
+    download_url, start_member=None, start_line=0, tee_dir=None, verify=True
+):
+    """
+    Stream the lines of a dump (tar archive) from its HTTP body, without storing
+    the dump. See iw.read_line_from_tar_stream. A resumed read downloads the dump
+    from the start, and skips the members before start_member.
+    :param tee_dir: also save the dump to tee_dir. It is written to {file}.part,
+    and renamed when the whole body is read and its checksum matches (see
+    download_file)
+    :return: yield (position, line). See iw.read_line_from_tar_file
+    """
+    tee_file, downloaded_file = None, None
+    if tee_dir:
+        downloaded_file = f"{tee_dir}/{download_url.split('/')[-1]}"
+        iw.create_dir(downloaded_file)
+        tee_file = downloaded_file + ".part"
+
+    with requests.Session() as session:
+        with session.get(download_url, stream=True, timeout=TIMEOUT) as r:
+            r.raise_for_status()
+            size = int(r.headers.get("content-length", 0))
+            with StreamReader(r.raw, tee_file) as raw:
+                yield from iw.read_line_from_tar_stream(raw, start_member, start_line)
+                if tee_file:
+                    # Read the padding after the end of the tar archive
+                    while raw.read(CHUNK_SIZE):
+                        pass
+        if not tee_file or (size and raw.n_bytes != size):
+            return
+        checksum = get_published_checksum(session, download_url) if verify else None
+
+    if checksum and hash_file(tee_file, checksum[0]) != checksum[1]:
+        iw.print_status(f"Wrong {checksum[0]} checksum: {download_url}")
+        iw.delete_file(tee_file)
+        return
+    os.replace(tee_file, downloaded_file)
+
+
+def download_files(
+    download_urls,
+    download_dir=cf.DIR_DUMPS,
+    n_transfers=4,
+    per_host=2,
+    verify=True,
+    progress=True,
+):
+    """
+    Download files with n_transfers concurrent transfers, and at most per_host
+    connections to a host. See download_file. A new transfer starts when a
+    finished download is consumed, so downloads do not run ahead of the consumer.
+    :return: yield (download_url, downloaded file or None) as downloads finish
+    """
+    download_urls = iter(download_urls)
+    host_limits = {}
     p_bar = tqdm(
-        total=int(r.headers.get("content-length", 0)),
-        unit="B",
-        unit_scale=True,
-        desc=dump_file,
+        total=0, unit="B", unit_scale=True, desc="Download", disable=not progress
     )
-    with open(f"{cf.DIR_DUMPS}/{dump_file}", "wb") as f:
-        for data in r.iter_content(10240):
-            p_bar.update(len(data))
-            f.write(data)
-    p_bar.close()
-    return downloaded_file
+    with p_bar, ThreadPoolExecutor(max_workers=n_transfers) as executor:
+        futures = {}
+
+        def submit(n):
+            for download_url in islice(download_urls, n):
+                host = get_host(download_url)
+                if host not in host_limits:
+                    host_limits[host] = threading.BoundedSemaphore(per_host)
+                future = executor.submit(
+                    download_file,
+                    download_url,
+                    download_dir,
+                    host_limits=host_limits,
+                    verify=verify,
+                    p_bar=p_bar,
+                )
+                futures[future] = download_url
+
+        submit(n_transfers)
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield futures.pop(future), future.result()
+                submit(1)
+
+
+def download_wikipedia_html_dumps(
+    wikipedia_version=cf.DUMPS_VERSION_WP_HTML, langs=None, n_transfers=4, per_host=2
+):
+    """
+    Download the Wikipedia HTML dumps of languages concurrently
+    :return: yield (lang, downloaded file or None) as downloads finish
+    """
+    urls = {
+        cf.URL_WP_HTML.format(wikipedia_version=wikipedia_version, lang=lang): lang
+        for lang in langs or cf.LANGS
+    }
+    for url, downloaded_file in download_files(
+        urls, n_transfers=n_transfers, per_host=per_host
+    ):
+        if downloaded_file:
+            downloaded_size = iw.get_size_of_file(os.path.getsize(downloaded_file))
+            print(f"Downloaded: {downloaded_size} - {downloaded_file}")
+        else:
+            print(f"Error: {url}")
+        yield urls[url], downloaded_file
 
 
 def download_wikipedia_html_dump(wikipedia_version=cf.DUMPS_VERSION_WP_HTML, lang="ja"):
     # Download Wikipedia dumps
-    url = cf.URL_WP_HTML.format(wikipedia_version=wikipedia_version, lang=lang)
-    downloaded_file = download_file(url)
-
-    if downloaded_file:
-        downloaded_size = iw.get_size_of_file(os.path.getsize(downloaded_file))
-        print(f"Downloaded: {downloaded_size} - {downloaded_file}")
-    else:
-        print(f"Error: {url}")
+    [(_, downloaded_file)] = download_wikipedia_html_dumps(
+        wikipedia_version, [lang], n_transfers=1
+    )
     return downloaded_file
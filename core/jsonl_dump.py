@@ -0,0 +1,27 @@
+"""
+Readers of the jsonl dumps of wikitables (see dump_wikitables) for the
+lightweight CLI commands (read, size): they do not import the HTML parsers.
+"""
+import json
+
+from core.utils import io_worker as iw
+
+
+def read_wikitable_dumps(input_file: str, limit: int = 0):
+    for i, table_obj in enumerate(iw.read_json_file(input_file, limit)):
+        print(json.dumps(table_obj, indent=2, ensure_ascii=False))
+
+
+def get_jsonl_size(input_file: str):
+    """
+    Get the number of tables of a dump from its metadata, or its block index.
+    Otherwise, count the lines without decoding them.
+    """
+    metadata = iw.load_metadata(input_file)
+    if metadata:
+        # Tombstones of delta dumps are lines too
+        return metadata["n_tables"] + metadata.get("n_deleted", 0)
+    index = iw.load_block_index(input_file, build=False)
+    if index:
+        return sum(n_lines for _, n_lines, _, _ in index["blocks"])
+    return iw.count_lines(input_file)
@@ -0,0 +1,245 @@
+"""
+Columnar (Parquet) export of the wikitables dumps. A table is a row, a field of
+the jsonl records is a column. Tables are written in row groups, the title and
+wikidata columns are dictionary encoded, and html is the last column, without
+statistics. Reading some columns, or filtering on them, does not read the HTML.
+pyarrow is only needed by the functions of this module, and imported by them.
+"""
+import json
+import os
+import re
+
+import ujson
+from tqdm import tqdm
+
+from core.utils import io_worker as iw
+
+# Number of tables per row group
+ROW_GROUP_SIZE = 10000
+# Columns with a few distinct values in a row group (tables of the same page)
+DICTIONARY_COLUMNS = ["wikidata", "title"]
+# Large columns: no dictionary, no min/max statistics
+LARGE_COLUMNS = ["html", "pubtabnet"]
+# Key of the dump metadata (see dump_wikitables) in the Parquet metadata
+METADATA_KEY = b"wtabhtml"
+# Filter of read_parquet_tables: "column", "column=value", "column>=value", ...
+FILTER_PATTERN = re.compile(r"^\s*(\w+)\s*(?:(==|=|!=|<=|>=|<|>)(.*))?$")
+
+
+def get_parquet_schema():
+    import pyarrow as pa
+
+    string_dict = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema(
+        [
+            ("wikidata", string_dict),
+            ("index", pa.int32()),
+            ("title", string_dict),
+            ("url", pa.string()),
+            ("caption", pa.string()),
+            ("aspects", pa.list_(pa.string())),
+            ("hash", pa.string()),
+            (
+                "duplicate_of",
+                pa.struct([("wikidata", pa.string()), ("index", pa.int32())]),
+            ),
+            ("deleted", pa.bool_()),
+            ("valid", pa.bool_()),
+            (
+                "pubtabnet",
+                pa.struct(
+                    [
+                        ("structure", pa.list_(pa.string())),
+                        ("cells", pa.list_(pa.list_(pa.string()))),
+                    ]
+                ),
+            ),
+            ("html", pa.string()),
+        ]
+    )
+
+
+def table_obj_to_row(table_obj, field_names):
+    """
+    Row of a table object of a dump. Missing fields are nulls
+    :param field_names: names of the schema fields. Other fields raise a ValueError,
+    instead of being dropped
+    """
+    unknown = table_obj.keys() - field_names
+    if unknown:
+        raise ValueError(
+            f"Unknown fields of table {table_obj.get('wikidata')}/"
+            f"{table_obj.get('index')}: {', '.join(sorted(unknown))}. "
+            f"Add them to get_parquet_schema"
+        )
+    row = dict(table_obj)
+    if row.get("duplicate_of"):
+        wikidata, index = row["duplicate_of"]
+        row["duplicate_of"] = {"wikidata": wikidata, "index": index}
+    return row
+
+
+def row_to_table_obj(row):
+    """Table object of a row, as in the jsonl dump (without null fields)"""
+    table_obj = {k: v for k, v in row.items() if v is not None}
+    if table_obj.get("duplicate_of"):
+        duplicate_of = table_obj["duplicate_of"]
+        table_obj["duplicate_of"] = [duplicate_of["wikidata"], duplicate_of["index"]]
+    return table_obj
+
+
+def get_parquet_file(input_file):
+    """Parquet file of a jsonl dump, e.g., {dir}/ja.jsonl.bz2 -> {dir}/ja.parquet"""
+    return re.sub(r"\.jsonl(\.\w+)?$", "", input_file) + ".parquet"
+
+
+def export_parquet(
+    input_file, outfile=None, row_group_size=ROW_GROUP_SIZE, progress=True
+):
+    """
+    Write the tables of a jsonl dump (see dump_wikitables) to a Parquet file,
+    with the dump metadata in the Parquet metadata
+    :param outfile: default: the input file with the .parquet extension
+    :param row_group_size: number of tables per row group. Filters skip the row
+    groups without matching values (min/max statistics)
+    :return: Parquet file, or None if the dump does not exist
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if not os.path.exists(input_file):
+        iw.print_status(f"Missing dump: {input_file}")
+        return None
+    if not outfile:
+        outfile = get_parquet_file(input_file)
+    iw.create_dir(outfile)
+
+    schema = get_parquet_schema()
+    metadata = iw.load_metadata(input_file)
+    if metadata:
+        schema = schema.with_metadata({METADATA_KEY: ujson.dumps(metadata)})
+
+    # Write to a temp file, and rename it when the export is completed
+    tmp_file = iw.get_tmp_file(outfile)
+    writer = pq.ParquetWriter(
+        tmp_file,
+        schema,
+        compression="zstd",
+        use_dictionary=DICTIONARY_COLUMNS,
+        write_statistics=[n for n in schema.names if n not in LARGE_COLUMNS],
+    )
+    field_names = set(schema.names)
+    n_tables = 0
+    completed = False
+    p_bar = tqdm(desc=f"Export {os.path.basename(input_file)}", disable=not progress)
+    try:
+        for batch in iw.read_batches(iw.read_json_file(input_file), row_group_size):
+            rows = [table_obj_to_row(table_obj, field_names) for table_obj in batch]
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            n_tables += len(rows)
+            p_bar.update(len(rows))
+        completed = True
+    finally:
+        writer.close()
+        p_bar.close()
+        if not completed:
+            os.remove(tmp_file)
+    os.replace(tmp_file, outfile)
+    iw.print_status(
+        f"Exported {n_tables:,} tables: {outfile} "
+        f"({iw.get_size_of_file(os.path.getsize(outfile))})"
+    )
+    return outfile
+
+
+def load_parquet_metadata(input_file):
+    """:return: the dump metadata saved by export_parquet, or None"""
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_schema(input_file).metadata or {}
+    if METADATA_KEY not in metadata:
+        return None
+    return ujson.loads(metadata[METADATA_KEY])
+
+
+def parse_filter(text, schema):
+    """
+    Filter expression of a text "column" (not null), or "column op value" with
+    op in =, ==, !=, <, <=, >, >=. The value is converted to the column type.
+    e.g., "caption", "wikidata=Q1490", "index>=2", "valid=false"
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    match = FILTER_PATTERN.match(text)
+    if not match or match.group(1) not in schema.names:
+        raise ValueError(f"Invalid filter: {text}. Columns: {', '.join(schema.names)}")
+    name, op, value = match.groups()
+    field = ds.field(name)
+    if op is None:
+        return field.is_valid()
+
+    value = value.strip()
+    value_type = schema.field(name).type
+    if pa.types.is_dictionary(value_type):
+        value_type = value_type.value_type
+    if pa.types.is_integer(value_type):
+        value = int(value)
+    elif pa.types.is_boolean(value_type):
+        value = value.lower() in ("true", "1")
+    if op in ("=", "=="):
+        return field == value
+    if op == "!=":
+        return field != value
+    if op == "<":
+        return field < value
+    if op == "<=":
+        return field <= value
+    if op == ">":
+        return field > value
+    return field >= value
+
+
+def get_filter_expression(filters, schema):
+    """:return: expression of all filters (see parse_filter), or None"""
+    expression = None
+    for text in filters or []:
+        condition = parse_filter(text, schema)
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def read_parquet_tables(input_file, columns=None, filters=None, limit=0):
+    """
+    Read the tables of a Parquet dump (see export_parquet), row group by row group
+    :param columns: read only these columns (projection). Default: all columns
+    :param filters: filters (see parse_filter) of the tables to read, all must
+    match. Row groups are skipped with the column statistics
+    :param limit: return the first limit tables
+    :return: yield table objects, as in the jsonl dump (without null fields)
+    """
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(input_file, format="parquet")
+    expression = get_filter_expression(filters, dataset.schema)
+    i = 0
+    for batch in dataset.to_batches(columns=columns, filter=expression):
+        for row in batch.to_pylist():
+            i += 1
+            if limit and i > limit:
+                return
+            yield row_to_table_obj(row)
+
+
+def read_parquet_dump(input_file, limit=0, columns=None, filters=None):
+    """Print the tables of a Parquet dump (see read_parquet_tables)"""
+    for table_obj in read_parquet_tables(input_file, columns, filters, limit):
+        print(json.dumps(table_obj, indent=2, ensure_ascii=False))
+
+
+def count_parquet_tables(input_file, filters=None):
+    """Number of tables matching the filters, without reading other columns"""
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(input_file, format="parquet")
+    return dataset.count_rows(filter=get_filter_expression(filters, dataset.schema))
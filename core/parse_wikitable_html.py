@@ -1,18 +1,27 @@
-import bz2
-import json
+import hashlib
 import os.path
+import queue
 import re
-from collections import defaultdict
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+from functools import partial
+from multiprocessing import Pool
 
 import bs4
 import ujson
 from tqdm import tqdm
 
+from core import table_html
+from core.table_html import ELEMENT_ATTRS, EXTRACT_TAGS, TABLE_ATTRS, UNWRAP_TAGS
+from core.table_tokens import compact_cell_tokens, get_table_tokens
 from core.utils import io_worker as iw
+from core.utils.metrics import METRICS
 from config import config as cf
 
 
-def normalize_wikitables_css(soup, table):
+def move_header_rows(soup, table):
+    """Move the leading rows of <th> cells of the table body to a <thead>"""
     has_header = False
     end_header = False
     thead = soup.new_tag("thead")
@@ -34,22 +43,34 @@ def normalize_wikitables_css(soup, table):
     if has_header:
         table.insert(0, thead)
 
-    def filter_attr(bs_obj, white_tags):
-        bs_obj.attrs = {
-            attr: v for attr, v in bs_obj.attrs.items() if attr in white_tags
-        }
-
-    filter_attr(table, ["border", "cellpadding", "style"])
-    for a in table.findAll(True):
-        filter_attr(a, ["colspan", "headers", "rowspan", "cellpadding", "style"])
 
-    for tag in ["a", "span", "link", "img"]:
-        for a in table.findAll(tag):
-            a.unwrap()
+def normalize_wikitables_css(soup, table, unwrap_tags=UNWRAP_TAGS):
+    """
+    Normalize a wikitable: move the header rows to <thead>, keep only the layout
+    attributes, unwrap links, spans, and images (unwrap_tags), and remove
+    footnotes. Elements are filtered in a single walk of the table, then
+    unwrapped and removed.
+    :param unwrap_tags: tags replaced by their content
+    """
+    move_header_rows(soup, table)
 
-    for tag in ["sup"]:
-        for a in table.findAll(tag):
-            a.extract()
+    table.attrs = {attr: v for attr, v in table.attrs.items() if attr in TABLE_ATTRS}
+    to_unwrap, to_extract = [], []
+    for el in table.descendants:
+        if not isinstance(el, bs4.Tag):
+            continue
+        if el.attrs:
+            el.attrs = {
+                attr: v for attr, v in el.attrs.items() if attr in ELEMENT_ATTRS
+            }
+        if el.name in unwrap_tags:
+            to_unwrap.append(el)
+        elif el.name in EXTRACT_TAGS:
+            to_extract.append(el)
+    for el in to_unwrap:
+        el.unwrap()
+    for el in to_extract:
+        el.extract()
 
     # add css
     # table.attrs["background-color"] = "#f8f9fa"
@@ -60,13 +81,179 @@ def normalize_wikitables_css(soup, table):
     return table
 
 
-def extract_html_tables_from_html(html_content):
+HTML_BACKENDS = cf.HTML_BACKENDS
+
+
+def get_section_aspects(soup):
+    """
+    Compute the section hierarchy of an article in one pass over its sections
+    :return: dict of id(section) -> list of section headings from the outer most
+    section. None is the key of the content outside sections.
+    """
+    section_aspects = {None: []}
+    # find_all returns sections in document order, so parents come first
+    for section in soup.find_all("section"):
+        parent = section.find_parent("section")
+        aspects = section_aspects[id(parent) if parent else None]
+        section_name = section.next
+        if section_name and section_name.name in cf.HTML_HEADERS:
+            aspects = aspects + [section_name.get_text()]
+        section_aspects[id(section)] = aspects
+    return section_aspects
+
+
+def find_wikitables_lxml(html_content):
+    """
+    Find the wikitables (without wikitable inside) of an article with lxml, and
+    normalize them on the lxml tree (see table_html.normalize_wikitable)
+    :return: yield (table, caption, aspects). table is the normalized HTML,
+    caption is the caption text or None, aspects are the section headings from
+    the outer most section.
+    """
+    import lxml.html
+
+    def get_text(node):
+        return table_html.get_text((node.tag, node.attrib, node), children)
+
+    children = table_html.lxml_children
+
+    def next_node(node):
+        # The node after the start tag of node in the document (bs4 .next)
+        if node.text:
+            return None
+        if len(node):
+            return node[0]
+        while node is not None:
+            if node.tail:
+                return None
+            if node.getnext() is not None:
+                return node.getnext()
+            node = node.getparent()
+        return None
+
+    with METRICS.timer("html_parse"):
+        root = lxml.html.document_fromstring(html_content)
+
+    # Section hierarchy: one pass over sections (parents come before children)
+    section_aspects = {None: []}
+    for section in root.iter("section"):
+        parent = next(section.iterancestors("section"), None)
+        aspects = section_aspects[parent]
+        section_name = next_node(section)
+        if section_name is not None and section_name.tag in cf.HTML_HEADERS:
+            aspects = aspects + [get_text(section_name)]
+        section_aspects[section] = aspects
+
+    for html_table in root.xpath('//table[contains(@class, "wikitabl")]'):
+        METRICS.count("tables_found")
+        if html_table.xpath('.//table[contains(@class, "wikitabl")]'):
+            METRICS.count("nested_tables_dropped")
+            continue
+        caption = next(html_table.iterdescendants("caption"), None)
+        if caption is not None:
+            caption = get_text(caption)
+
+        section = next(html_table.iterancestors("section"), None)
+        with METRICS.timer("normalize"):
+            normalized_html = table_html.normalize_wikitable(
+                (html_table.tag, html_table.attrib, html_table), children
+            )
+        yield normalized_html, caption, section_aspects[section]
+
+
+def find_wikitables_selectolax(html_content):
+    """
+    Find the wikitables (without wikitable inside) of an article with selectolax
+    (lexbor), and normalize them on the lexbor tree. See find_wikitables_lxml
+    """
+    from selectolax.lexbor import LexborHTMLParser
+
+    def get_text(node):
+        return table_html.get_text((node.tag, node.attributes, node), children)
+
+    children = table_html.selectolax_children
+
+    def next_node(node):
+        if node.child is not None:
+            return node.child
+        while node is not None and node.tag != "-document":
+            if node.next is not None:
+                return node.next
+            node = node.parent
+        return None
+
+    def parent_section(node):
+        node = node.parent
+        while node is not None and node.tag != "section":
+            node = node.parent
+        return node.mem_id if node is not None else None
+
+    with METRICS.timer("html_parse"):
+        tree = LexborHTMLParser(html_content)
+
+    # Section hierarchy: one pass over sections (parents come before children)
+    section_aspects = {None: []}
+    for section in tree.css("section"):
+        aspects = section_aspects[parent_section(section)]
+        section_name = next_node(section)
+        if section_name is not None and section_name.tag in cf.HTML_HEADERS:
+            aspects = aspects + [get_text(section_name)]
+        section_aspects[section.mem_id] = aspects
+
+    selector = 'table[class*="wikitabl"]'
+    for html_table in tree.css(selector):
+        METRICS.count("tables_found")
+        # css() also matches the table itself
+        if len(html_table.css(selector)) > 1:
+            METRICS.count("nested_tables_dropped")
+            continue
+        caption = html_table.css_first("caption")
+        if caption is not None:
+            caption = get_text(caption)
+        with METRICS.timer("normalize"):
+            normalized_html = table_html.normalize_wikitable(
+                (html_table.tag, html_table.attributes, html_table), children
+            )
+        yield normalized_html, caption, section_aspects[parent_section(html_table)]
+
+
+def add_table_tokens(table):
+    """
+    Add the PubTabNet tokens of the normalized table HTML (see
+    table_tokens.get_table_tokens) to the table object: "valid", and "pubtabnet"
+    {"structure", "cells"} if valid. Cell tokens are saved as text runs (see
+    table_tokens.compact_cell_tokens). The HTML is parsed again with lxml, so the
+    tokenization moves from the render stage to the parse stage
+    """
+    with METRICS.timer("tokens"):
+        struc_tokens, cell_tokens = get_table_tokens(table["html"])
+    table["valid"] = struc_tokens is not None
+    if table["valid"]:
+        table["pubtabnet"] = {
+            "structure": struc_tokens,
+            "cells": [compact_cell_tokens(tokens) for tokens in cell_tokens],
+        }
+    else:
+        METRICS.count("tables_invalid")
+
+
+def extract_html_tables_from_html(html_content, html_backend="bs4", tokens=False):
+    """
+    :param tokens: also compute the PubTabNet tokens of the tables (see
+    add_table_tokens), so the PIL render backend does not compute them again
+    """
     results = []
     if not html_content:
         return results
 
-    soup = bs4.BeautifulSoup(html_content, "html.parser")
+    if html_backend != "bs4":
+        return extract_html_tables_from_html_fast(html_content, html_backend, tokens)
+
+    with METRICS.timer("html_parse"):
+        soup = bs4.BeautifulSoup(html_content, "html.parser")
+    section_aspects = get_section_aspects(soup)
     html_tables = soup.find_all("table", {"class": re.compile("wikitable*")})
+    METRICS.count("tables_found", len(html_tables))
     tables = []
     for i, html_table in enumerate(html_tables):
 
@@ -74,6 +261,7 @@ def extract_html_tables_from_html(html_content):
         # We ignore the nested tables, just process wikitables do not have any wikitable inside
         sub_wikitables = html_table.find("table", {"class": re.compile("wikitable*")})
         if sub_wikitables:
+            METRICS.count("nested_tables_dropped")
             continue
 
         table = {}
@@ -83,28 +271,49 @@ def extract_html_tables_from_html(html_content):
             table["caption"] = tag_caption.get_text().strip()
 
         # Get section hierarchy
-        cur = html_table
-        while True:
-            section = cur.find_parent("section")
-            if not section:
-                break
-            section_name = section.next
-            if section_name and section_name.name in cf.HTML_HEADERS:
-                if table.get("aspects") is None:
-                    table["aspects"] = []
-                table["aspects"].append(section_name.get_text())
-            cur = section
-
-        if table.get("aspects") and len(table["aspects"]) > 1:
-            table["aspects"] = table["aspects"][::-1]
-
-        html_table = normalize_wikitables_css(soup, html_table)
-        table["html"] = str(html_table)
+        section = html_table.find_parent("section")
+        aspects = section_aspects[id(section) if section else None]
+        if aspects:
+            table["aspects"] = list(aspects)
+
+        with METRICS.timer("normalize"):
+            html_table = normalize_wikitables_css(soup, html_table)
+            table["html"] = str(html_table)
+        if tokens:
+            add_table_tokens(table)
         tables.append(table)
 
     return tables
 
 
+def extract_html_tables_from_html_fast(html_content, html_backend="lxml", tokens=False):
+    """
+    Find and normalize wikitables on the tree of a fast parser (lxml or
+    selectolax), without bs4. The output is the same as the bs4 backend.
+    """
+    if html_backend == "lxml":
+        find_wikitables = find_wikitables_lxml
+    elif html_backend == "selectolax":
+        find_wikitables = find_wikitables_selectolax
+    else:
+        raise ValueError(f"Unknown HTML backend: {html_backend}")
+
+    tables = []
+    for normalized_html, caption, aspects in find_wikitables(html_content):
+        table = {}
+        if caption is not None:
+            table["caption"] = caption.strip()
+
+        if aspects:
+            table["aspects"] = list(aspects)
+
+        table["html"] = normalized_html
+        if tokens:
+            add_table_tokens(table)
+        tables.append(table)
+    return tables
+
+
 def add_css_wikitable(html_source):
     """
     Add css of wikitable to the html source
@@ -128,7 +337,38 @@ def add_css_wikitable(html_source):
     return str(html_source)
 
 
-def pool_parse_html_source(line):
+def get_table_hash(table_html):
+    """
+    Hash of the html of a table (normalized by normalize_wikitables_css). White
+    spaces are collapsed.
+    """
+    return hashlib.blake2b(
+        " ".join(table_html.split()).encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+
+def load_table_hashes(dump_file):
+    """
+    Load the hash index of a dump
+    :return: dict of (wikidata, table index): table hash
+    """
+    hash_file = iw.get_hash_index_file(dump_file)
+    if os.path.exists(hash_file):
+        return {
+            (wikidata, index): table_hash
+            for wikidata, index, table_hash in iw.read_json_file(hash_file)
+        }
+    # Dumps parsed before the hash index
+    hashes = {}
+    for table_obj in iw.read_json_file(dump_file):
+        if table_obj.get("deleted"):
+            continue
+        table_hash = table_obj.get("hash") or get_table_hash(table_obj["html"])
+        hashes[(table_obj["wikidata"], table_obj["index"])] = table_hash
+    return hashes
+
+
+def pool_parse_html_source(line, html_backend="bs4", tokens=False):
     if (
         not line
         or not line.get("article_body")
@@ -138,9 +378,12 @@ def pool_parse_html_source(line):
         return None
 
     if not line.get("main_entity") or not line["main_entity"].get("identifier"):
+        METRICS.count("errors.no_wikidata")
         return None
 
-    wikitables_html = extract_html_tables_from_html(line["article_body"]["html"])
+    wikitables_html = extract_html_tables_from_html(
+        line["article_body"]["html"], html_backend, tokens
+    )
     if not wikitables_html:
         return None
     table_objs = []
@@ -161,6 +404,11 @@ def pool_parse_html_source(line):
         update_dict("html", wikitable.get("html"))
         update_dict("caption", wikitable.get("caption"))
         update_dict("aspects", wikitable.get("aspects"))
+        if table_obj.get("html"):
+            table_obj["hash"] = get_table_hash(table_obj["html"])
+        if "valid" in wikitable:
+            table_obj["valid"] = wikitable["valid"]
+            update_dict("pubtabnet", wikitable.get("pubtabnet"))
 
         # table_obj["html"] = add_css_wikitable(table_obj["html"])
 
@@ -168,87 +416,504 @@ def pool_parse_html_source(line):
     return table_objs
 
 
-def parse_wikitables(input_file=None):
-    dump_file = iw.read_line_from_file(input_file, mode="rb")
-    for line in dump_file:
+def is_wikitable_candidate(line):
+    """
+    Check the raw line (bytes) of a dump before decoding it. Pages without
+    wikitable or wikidata ID are ignored by pool_parse_html_source anyway.
+    """
+    return b"wikitable" in line and b'"main_entity"' in line
+
+
+def get_article_fields(line_obj):
+    """
+    Keep only the fields used by pool_parse_html_source, so that the large fields
+    (e.g., wikitext) are released before parsing HTML
+    """
+    article = {"name": line_obj.get("name"), "url": line_obj.get("url")}
+    if line_obj.get("main_entity"):
+        article["main_entity"] = {
+            "identifier": line_obj["main_entity"].get("identifier")
+        }
+    if line_obj.get("article_body"):
+        article["article_body"] = {"html": line_obj["article_body"].get("html")}
+    return article
+
+
+def pool_parse_line(line, html_backend="bs4", tokens=False):
+    try:
+        with METRICS.timer("json_decode"):
+            line_obj = get_article_fields(ujson.loads(line))
+    except (ValueError, AttributeError):
+        METRICS.count("errors.json_decode")
+        return None
+    return pool_parse_html_source(line_obj, html_backend, tokens)
+
+
+def pool_parse_line_with_metrics(line, html_backend="bs4", tokens=False):
+    """Worker process: parse a line, and send the metrics of the worker with it"""
+    return pool_parse_line(line, html_backend, tokens), METRICS.pop()
+
+
+def filter_wikitable_candidates(dump_file, stats=None):
+    dump_file = iter(dump_file)
+    while True:
+        # Time to decompress and read a line
+        start = time.perf_counter()
         try:
-            line_obj = ujson.loads(line)
-            parsed_objs = pool_parse_html_source(line_obj)
-            if parsed_objs:
-                yield parsed_objs
-        except ValueError:
+            position, line = next(dump_file)
+        except StopIteration:
+            return
+        METRICS.add_time("read", time.perf_counter() - start)
+        METRICS.count("pages_read")
+        METRICS.count("bytes_in", len(line))
+        if stats is not None:
+            stats["n_lines"] += 1
+        if not is_wikitable_candidate(line):
+            METRICS.count("pages_skipped")
+            if stats is not None:
+                stats["n_skipped"] += 1
             continue
+        yield position, line
+
+
+def parse_wikitables(
+    input_file=None,
+    n_workers=1,
+    batch_size=1000,
+    stats=None,
+    html_backend="bs4",
+    start_member=None,
+    start_line=0,
+    tee_dir=None,
+    tokens=False,
+):
+    """
+    Yield the parsed tables of each article (page) in the dump, in input order.
+    :param input_file: Wikipedia HTML dump, or its URL to parse it while it is
+    downloaded (see downloader.read_line_from_url)
+    :param n_workers: parse pages with a pool of n_workers processes
+    :param batch_size: number of lines sent to the pool at once. At most two
+    batches are in flight, so memory stays bounded.
+    :param stats: a defaultdict(int) to count read lines (n_lines) and lines
+    skipped without decoding (n_skipped)
+    :param html_backend: HTML parser to find wikitables. See HTML_BACKENDS
+    :param start_member: resume from this tar member
+    :param start_line: resume from this line of start_member
+    :param tee_dir: save the downloaded dump to tee_dir (URL input_file)
+    :param tokens: also compute the PubTabNet tokens of the tables (see
+    add_table_tokens)
+    :return: yield (position, parsed_objs). See iw.read_line_with_position
+    """
+    from core import downloader
+
+    if downloader.is_url(input_file):
+        lines = downloader.read_line_from_url(
+            input_file, start_member, start_line, tee_dir
+        )
+    else:
+        lines = iw.read_line_with_position(input_file, start_member, start_line)
+    dump_file = filter_wikitable_candidates(lines, stats)
+    if n_workers <= 1:
+        for position, line in dump_file:
+            parsed_objs = pool_parse_line(line, html_backend, tokens)
+            if parsed_objs:
+                yield position, parsed_objs
+        return
+
+    # Worker metrics are added to the metrics of this process
+    parse_line = partial(
+        pool_parse_line_with_metrics, html_backend=html_backend, tokens=tokens
+    )
+    chunk_size = max(1, batch_size // (n_workers * 4))
+    with Pool(processes=n_workers, initializer=METRICS.reset) as p:
+        pending = deque()
+        for batch in iw.read_batches(dump_file, batch_size):
+            positions = [position for position, _ in batch]
+            lines = [line for _, line in batch]
+            pending.append((positions, p.map_async(parse_line, lines, chunk_size)))
+            if len(pending) < 2:
+                continue
+            positions, results = pending.popleft()
+            for position, (parsed_objs, metrics) in zip(positions, results.get()):
+                METRICS.merge(metrics)
+                if parsed_objs:
+                    yield position, parsed_objs
+        while pending:
+            positions, results = pending.popleft()
+            for position, (parsed_objs, metrics) in zip(positions, results.get()):
+                METRICS.merge(metrics)
+                if parsed_objs:
+                    yield position, parsed_objs
+
+
+# Number of tables per message of dump_wikitables table_queue
+STREAM_BATCH_SIZE = 64
 
 
 def dump_wikitables(
-    lang="ja", input_file=None, outfile=None, limit=0, step=1000, progress=True
+    lang="ja",
+    input_file=None,
+    outfile=None,
+    limit=0,
+    step=1000,
+    progress=True,
+    n_workers=1,
+    html_backend="bs4",
+    resume=False,
+    checkpoint_step=10000,
+    previous_file=None,
+    dedup=False,
+    table_queue=None,
+    stream_event=None,
+    stream=False,
+    tee_dir=None,
+    metrics_file=None,
+    metrics_interval=60,
+    tokens=False,
 ):
+    """
+    Parse the wikitables of a Wikipedia HTML dump and save them to a jsonl file.
+    The (wikidata, table index, table hash) of all tables are saved to the hash
+    index of the output file (iw.get_hash_index_file).
+    :param resume: continue from the last checkpoint of an interrupted run
+    :param checkpoint_step: save a checkpoint every checkpoint_step pages
+    :param previous_file: dump of a previous version. If given, save only the new
+    and changed tables, and a tombstone {"wikidata", "index", "deleted": true}
+    for every table of the previous dump that is not in the new dump (delta dump)
+    :param dedup: save a table with the same hash as a saved table as a reference
+    {"duplicate_of": [wikidata, index]} of the saved table, without html. Hashes are
+    kept in a DiskHashSet, so memory stays bounded.
+    :param table_queue: also put the saved tables of this run, in output order, to
+    this (bounded) multiprocessing queue as lists of table objects, e.g., to render
+    tables while parsing. Nothing is put if the output file already exists.
+    :param stream_event: multiprocessing.Event, set when the tables of table_queue
+    are rendered. Before, the parse does not wait for the queue: if it is full,
+    streaming stops, and the reader of the queue reads the other tables from the
+    output file when it is saved (see wikitable_to_image.forward_tables)
+    :param stream: parse the dump while it is downloaded from cf.URL_WP_HTML,
+    without storing it. input_file can also be a URL.
+    :param tee_dir: also save the streamed dump to tee_dir, e.g., cf.DIR_DUMPS
+    :param metrics_file: save the counters and time per stage (see
+    metrics.Metrics) to a JSON or Prometheus text (.prom) file
+    :param metrics_interval: print a metrics summary line, and update the
+    metrics file, every metrics_interval seconds. 0: only at the end
+    :param tokens: also save the PubTabNet tokens of each table (see
+    add_table_tokens): "valid" (false if the table cannot be a PubTabNet sample),
+    and "pubtabnet" {"structure": tokens, "cells": text runs of each cell} of
+    valid tables. The render stage skips the invalid tables, and the PIL backend
+    lays out the tokens without tokenizing the HTML again.
+    """
+    from core import downloader
+
     if input_file is None:
-        input_file = f"{cf.DIR_DUMPS}/{lang}wiki-NS0-{cf.DUMPS_VERSION_WP_HTML}-ENTERPRISE-HTML.json.tar.gz"
-    if not os.path.exists(input_file):
+        if stream:
+            input_file = cf.URL_WP_HTML.format(
+                wikipedia_version=cf.DUMPS_VERSION_WP_HTML, lang=lang
+            )
+        else:
+            input_file = f"{cf.DIR_DUMPS}/{lang}wiki-NS0-{cf.DUMPS_VERSION_WP_HTML}-ENTERPRISE-HTML.json.tar.gz"
+    if downloader.is_url(input_file):
+        input_size = downloader.get_remote_size(input_file)
+    elif os.path.exists(input_file):
+        input_size = os.path.getsize(input_file)
+    else:
         return
 
     if not outfile:
+        name = lang
         if limit:
-            outfile = (
-                f"{cf.DIR_MODELS}/wikitables_html_pubtabnet/{lang}_{limit}.jsonl.bz2"
-            )
-        else:
-            outfile = f"{cf.DIR_MODELS}/wikitables_html_pubtabnet/{lang}.jsonl.bz2"
+            name += f"_{limit}"
+        if previous_file:
+            name += "_delta"
+        outfile = f"{cf.DIR_MODELS}/wikitables_html_pubtabnet/{name}.jsonl.bz2"
     if os.path.exists(outfile):
         return outfile
 
+    METRICS.reset(stage="parse", lang=lang)
+
+    previous = None
+    if previous_file:
+        if not os.path.exists(previous_file):
+            iw.print_status(f"Missing previous dump: {previous_file}")
+            return
+        previous = load_table_hashes(previous_file)
+
     iw.create_dir(outfile)
 
-    if outfile.endswith(".bz2"):
-        jsonFile = bz2.open(outfile, "wt")
+    # Write to a temp file, and rename it when the dump is completed
+    tmp_file = iw.get_tmp_file(outfile)
+    codec = iw.get_compression_codec(outfile)
+    index_file = iw.get_block_index_file(outfile)
+    hash_file = iw.get_hash_index_file(outfile)
+    tmp_hash_file = iw.get_hash_index_file(tmp_file)
+    checkpoint_file = iw.get_checkpoint_file(outfile)
+    dedup_file = iw.get_dedup_file(tmp_file)
+
+    checkpoint = None
+    if resume and os.path.exists(tmp_file) and os.path.exists(checkpoint_file):
+        checkpoint = iw.load_json_file(checkpoint_file)
+        if (
+            checkpoint.get("input_file") != os.path.basename(input_file)
+            or checkpoint.get("previous_file") != previous_file
+            or checkpoint.get("dedup", False) != dedup
+            or checkpoint.get("tokens", False) != tokens
+            or not os.path.exists(tmp_hash_file)
+        ):
+            checkpoint = None
+
+    if checkpoint:
+        # Drop the tables written after the checkpoint
+        with open(tmp_file, "r+b") as f:
+            f.truncate(checkpoint["output_size"])
+        jsonFile = iw.open_text_writer(
+            tmp_file, "a", codec=codec, index_file=index_file
+        )
+        with open(tmp_hash_file, "r+b") as f:
+            f.truncate(checkpoint["hashes_size"])
+        if previous is not None:
+            # Tables parsed before the checkpoint are not deleted
+            for wikidata, index, _ in iw.read_json_file(tmp_hash_file):
+                previous.pop((wikidata, index), None)
+        hashFile = iw.open_text_writer(tmp_hash_file, "a", index=False)
+        start_member = checkpoint["member"]
+        start_line = checkpoint["line_no"] + 1
+        n = checkpoint["n_tables"]
+        i = checkpoint["n_pages"]
+        n_captions = checkpoint["n_captions"]
+        n_aspects = checkpoint["n_aspects"]
+        n_unchanged = checkpoint["n_unchanged"]
+        n_duplicates = checkpoint.get("n_duplicates", 0)
     else:
-        jsonFile = open(outfile, "w")
-
-    parser = parse_wikitables(input_file)
-    n = 0
-    i = 0
+        iw.delete_file(checkpoint_file)
+        jsonFile = iw.open_text_writer(
+            tmp_file, "w", codec=codec, index_file=index_file
+        )
+        hashFile = iw.open_text_writer(tmp_hash_file, "w", index=False)
+        start_member, start_line = None, 0
+        n, i, n_captions, n_aspects, n_unchanged = 0, 0, 0, 0, 0
+        n_duplicates = 0
+
+    dedup_set = None
+    if dedup:
+        # The hash set is rebuilt from the saved tables
+        iw.delete_file(dedup_file)
+        from core.utils.hash_set import DiskHashSet
+
+        dedup_set = DiskHashSet(dedup_file)
+        if checkpoint:
+            with iw.open_binary_reader(tmp_file, codec=codec) as f:
+                for line in f:
+                    table_obj = ujson.loads(line)
+                    if table_obj.get("html"):
+                        key = [table_obj["wikidata"], table_obj["index"]]
+                        dedup_set.add(table_obj["hash"], key)
+
+    stats = defaultdict(int)
+    parser = parse_wikitables(
+        input_file,
+        n_workers=n_workers,
+        stats=stats,
+        html_backend=html_backend,
+        start_member=start_member,
+        start_line=start_line,
+        tee_dir=tee_dir,
+        tokens=tokens,
+    )
 
     def update_desc(i):
-        return f"Parse Wikitable {lang}. Saved {n:,} tables / {i:,} pages"
+        desc = (
+            f"Parse Wikitable {lang}. Saved {n:,} tables / {i:,} pages. "
+            f"Skipped {stats['n_skipped']:,} pages"
+        )
+        if dedup:
+            desc += f". Duplicates {n_duplicates:,}"
+        return desc
 
     p_bar = None
     if progress:
-        p_bar = tqdm(desc=update_desc(0))
+        p_bar = tqdm(
+            desc=update_desc(i),
+            total=input_size or None,
+            unit="B",
+            unit_scale=True,
+        )
+
+    # Status lines are printed above the progress bar
+    write_status = tqdm.write if progress else iw.print_status
+    stream_batch = []
+    streaming = table_queue is not None
 
-    for parsed_objs in parser:
+    def put_stream_batch(batch):
+        nonlocal streaming
+        if stream_event is None or stream_event.is_set():
+            table_queue.put(batch)
+            return
+        try:
+            table_queue.put_nowait(batch)
+        except queue.Full:
+            # Nothing reads the queue yet. Tables are read from the output file
+            streaming = False
+            write_status(f"Stopped streaming the tables of {lang}: queue is full")
+
+    is_completed = True
+    for (member, line_no, n_bytes), parsed_objs in parser:
         if limit and n >= limit:
+            is_completed = False
             break
         if progress and i and i % step == 0:
-            p_bar.update(step)
+            p_bar.update(n_bytes - p_bar.n)
             p_bar.set_description(desc=update_desc(i))
         for parsed_obj in parsed_objs:
+            key = (parsed_obj["wikidata"], parsed_obj["index"])
+            hashFile.write(ujson.dumps([*key, parsed_obj["hash"]]))
+            hashFile.write("\n")
+            if previous is not None and previous.pop(key, None) == parsed_obj["hash"]:
+                n_unchanged += 1
+                METRICS.count("tables_unchanged")
+                continue
+            if dedup_set is not None:
+                duplicate_of = dedup_set.add(parsed_obj["hash"], list(key))
+                if duplicate_of:
+                    del parsed_obj["html"]
+                    parsed_obj.pop("valid", None)
+                    parsed_obj.pop("pubtabnet", None)
+                    parsed_obj["duplicate_of"] = duplicate_of
+                    n_duplicates += 1
+                    METRICS.count("tables_duplicate")
             n += 1
-            jsonString = ujson.dumps(parsed_obj)
-            jsonFile.write(jsonString)
-            jsonFile.write("\n")
+            if parsed_obj.get("caption"):
+                n_captions += 1
+            if parsed_obj.get("aspects"):
+                n_aspects += 1
+            with METRICS.timer("json_encode"):
+                jsonString = ujson.dumps(parsed_obj)
+            with METRICS.timer("write"):
+                jsonFile.write(jsonString)
+                jsonFile.write("\n")
+            METRICS.count("tables_saved")
+            METRICS.count("bytes_out", len(jsonString) + 1)
+            if streaming:
+                stream_batch.append(parsed_obj)
         i += 1
+        METRICS.report(metrics_interval, metrics_file, write=write_status)
+        if len(stream_batch) >= STREAM_BATCH_SIZE:
+            put_stream_batch(stream_batch)
+            stream_batch = []
+
+        if checkpoint_step and i % checkpoint_step == 0:
+            # Flushing the writer ends the current compressed stream, and the file
+            # size is the end of the last complete stream.
+            jsonFile.flush()
+            hashFile.flush()
+            if dedup_set is not None:
+                dedup_set.commit()
+            iw.save_json_file(
+                checkpoint_file,
+                {
+                    "input_file": os.path.basename(input_file),
+                    "previous_file": previous_file,
+                    "dedup": dedup,
+                    "tokens": tokens,
+                    "member": member,
+                    "line_no": line_no,
+                    "n_bytes": n_bytes,
+                    "n_tables": n,
+                    "n_pages": i,
+                    "n_captions": n_captions,
+                    "n_aspects": n_aspects,
+                    "n_unchanged": n_unchanged,
+                    "n_duplicates": n_duplicates,
+                    "output_size": os.path.getsize(tmp_file),
+                    "hashes_size": os.path.getsize(tmp_hash_file),
+                },
+            )
+
+    # Tables of the previous dump that are not in the new dump. Unknown if the
+    # parse is stopped by the limit.
+    n_deleted = 0
+    if previous is not None and is_completed:
+        for wikidata, index in previous:
+            tombstone = {"wikidata": wikidata, "index": index, "deleted": True}
+            jsonFile.write(ujson.dumps(tombstone))
+            jsonFile.write("\n")
+            METRICS.count("tables_deleted")
+            if streaming:
+                stream_batch.append(tombstone)
+            n_deleted += 1
+    if streaming and stream_batch:
+        put_stream_batch(stream_batch)
+
     if progress:
+        if p_bar.total and (not limit or n < limit):
+            p_bar.update(p_bar.total - p_bar.n)
         p_bar.set_description(desc=update_desc(i))
-    jsonFile.close()
+        p_bar.close()
+    with METRICS.timer("write"):
+        jsonFile.close()
+    hashFile.close()
+    if dedup_set is not None:
+        dedup_set.close(delete=True)
+    os.replace(tmp_hash_file, hash_file)
+    os.replace(tmp_file, outfile)
+    iw.delete_file(checkpoint_file)
+
+    version = re.search(r"-(\d{8})-", os.path.basename(input_file))
+    metadata = {
+        "n_tables": n,
+        "n_pages": i,
+        "n_captions": n_captions,
+        "n_aspects": n_aspects,
+        "input_file": os.path.basename(input_file),
+        "input_size": input_size,
+        "output_size": os.path.getsize(outfile),
+        "dump_version": version.group(1) if version else None,
+        "build_time": datetime.now().isoformat(timespec="seconds"),
+    }
+    if previous is not None:
+        metadata.update(
+            {
+                "previous_file": os.path.basename(previous_file),
+                "n_unchanged": n_unchanged,
+                "n_deleted": n_deleted,
+            }
+        )
+    if tokens:
+        metadata["tokens"] = True
+    if dedup:
+        metadata["n_duplicates"] = n_duplicates
+        iw.print_status(
+            f"Duplicate tables of {lang}: {n_duplicates:,} / {n:,} "
+            f"({n_duplicates / n * 100 if n else 0:.2f}%)"
+        )
+    iw.save_json_file(iw.get_metadata_file(outfile), metadata)
+    if metrics_interval:
+        iw.print_status(METRICS.summary())
+    if metrics_file:
+        METRICS.save(metrics_file)
     return outfile
 
 
 def func_modify_table_border(table_obj):
-    table_obj["html"] = table_obj["html"].replace("1px solid #a2a9b1", "1")
+    # Tombstones and references of duplicates have no html
+    if table_obj.get("html"):
+        table_obj["html"] = table_obj["html"].replace("1px solid #a2a9b1", "1")
     return table_obj
 
 
 def modify_json_dump(input_folder, func):
     dump_files = iw.get_files_from_dir(input_folder, is_sort=True, reverse=True)
     for dump_file in dump_files:
+        if iw.is_sidecar_file(dump_file):
+            continue
         file_name = os.path.basename(dump_file).split(".")[0]
-        dir_output = dump_file + ".tmp"
+        dir_output = iw.get_tmp_file(dump_file)
 
-        if dump_file.endswith(".bz2"):
-            output_file = bz2.open(dir_output, "wt")
-        else:
-            output_file = open(dir_output, "w")
+        output_file = iw.open_text_writer(
+            dir_output,
+            "w",
+            codec=iw.get_compression_codec(dump_file),
+            index_file=iw.get_block_index_file(dump_file),
+        )
 
         iter_obj = iw.read_json_file(dump_file)
         for table_obj in tqdm(iter_obj, desc=file_name):
@@ -259,18 +924,7 @@ def modify_json_dump(input_folder, func):
         output_file.close()
         iw.delete_file(dump_file)
         os.rename(dir_output, dump_file)
-
-
-def read_wikitable_dumps(input_file: str, limit: int = 0):
-    for i, table_obj in enumerate(iw.read_json_file(input_file, limit)):
-        print(json.dumps(table_obj, indent=2, ensure_ascii=False))
-
-
-def get_jsonl_size(input_file: str):
-    size = 0
-    for _ in iw.read_json_file(input_file):
-        size += 1
-    return size
+        iw.update_metadata(dump_file, output_size=os.path.getsize(dump_file))
 
 
 def analyze_wikitables(input_folder: str = cf.DIR_MODELS, limit=0, step=1000):
@@ -281,8 +935,24 @@ def analyze_wikitables(input_folder: str = cf.DIR_MODELS, limit=0, step=1000):
     stats = defaultdict()
 
     for dump_file in dump_files:
+        if iw.is_sidecar_file(dump_file):
+            continue
         file_name = os.path.basename(dump_file).split(".")[0]
 
+        metadata = iw.load_metadata(dump_file)
+        if metadata and not limit:
+            n_tables, n_pages = metadata["n_tables"], metadata["n_pages"]
+            n_caption, n_aspects = metadata["n_captions"], metadata["n_aspects"]
+            stats[file_name] = [
+                n_pages,
+                n_tables,
+                n_caption,
+                n_aspects,
+                n_caption / n_tables * 100 if n_tables else 0,
+                n_aspects / n_tables * 100 if n_tables else 0,
+            ]
+            continue
+
         n_tables, n_pages, n_caption, n_aspects = 0, 0, 0, 0
 
         def update_desc():
@@ -296,6 +966,8 @@ def analyze_wikitables(input_folder: str = cf.DIR_MODELS, limit=0, step=1000):
         try:
             iter_obj = iw.read_json_file(dump_file)
             for table_obj in iter_obj:
+                if table_obj.get("deleted"):
+                    continue
                 n_tables += 1
                 p_bar.update()
                 if pre_title != table_obj["title"]:
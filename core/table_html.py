@@ -0,0 +1,233 @@
+"""
+Normalize wikitables on the trees of the fast HTML backends (lxml, selectolax),
+without parsing them again with bs4. A table is normalized while it is
+serialized, to the same HTML as normalize_wikitables_css on the html.parser tree
+serialized by bs4 (str): sorted attributes, "<br/>" void tags, "&", "<", ">"
+escaped, except in script and style, and white space texts collapsed, except in
+pre and textarea. get_text is the text of bs4 get_text.
+
+The tree of a backend is read with a children function: it yields the children
+of a node as text (str), comments (HTMLComment), and elements (tag, attrs, node).
+"""
+
+# Attributes kept by normalize_wikitables_css on the table, and on its elements
+TABLE_ATTRS = {"border", "cellpadding", "style"}
+ELEMENT_ATTRS = {"colspan", "headers", "rowspan", "cellpadding", "style"}
+# Tags replaced by their content, and tags removed with their content
+UNWRAP_TAGS = ("a", "span", "link", "img")
+EXTRACT_TAGS = ("sup",)
+
+# Void elements of bs4, serialized as <br/>
+VOID_TAGS = frozenset(
+    [
+        "area",
+        "base",
+        "basefont",
+        "bgsound",
+        "br",
+        "col",
+        "command",
+        "embed",
+        "frame",
+        "hr",
+        "image",
+        "img",
+        "input",
+        "isindex",
+        "keygen",
+        "link",
+        "menuitem",
+        "meta",
+        "nextid",
+        "param",
+        "source",
+        "spacer",
+        "track",
+        "wbr",
+    ]
+)
+# bs4 does not escape the text of these tags
+CDATA_TAGS = ("script", "style")
+# bs4 replaces a text of these white spaces by a line break (if it has one) or a
+# space, except in these tags
+ASCII_SPACES = " \n\t\f\r"
+PRESERVE_WHITESPACE_TAGS = ("pre", "textarea")
+# The text of these tags is not in bs4 get_text
+NON_TEXT_TAGS = ("script", "style", "template", "rt", "rp")
+# Attributes of several values (bs4 cdata_list_attributes), kept by the
+# normalization. bs4 splits them on white spaces, and joins them with a space
+LIST_ATTRS = {"td": ("headers",), "th": ("headers",)}
+
+
+class HTMLComment(str):
+    """Comment yielded by the children functions"""
+
+
+def lxml_children(node):
+    """Children of an lxml element"""
+    import lxml.etree
+
+    if node.text:
+        yield node.text
+    for child in node:
+        if isinstance(child.tag, str):
+            yield child.tag, child.attrib, child
+        elif child.tag is lxml.etree.Comment:
+            yield HTMLComment(child.text or "")
+        if child.tail:
+            yield child.tail
+
+
+def selectolax_children(node):
+    """Children of a selectolax (lexbor) node"""
+    for child in node.iter(include_text=True):
+        tag = child.tag
+        if tag == "-text":
+            yield child.text_content
+        elif tag == "-comment":
+            yield HTMLComment(child.html[4:-3])
+        elif not tag.startswith("-"):
+            yield tag, child.attributes, child
+
+
+def collapse_whitespace(text):
+    if text.strip(ASCII_SPACES):
+        return text
+    return "\n" if "\n" in text else " "
+
+
+def escape_text(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def format_attrs(attrs):
+    """Attributes as bs4 serializes them: sorted, and quoted"""
+    html = []
+    for name, value in sorted(attrs.items()):
+        value = escape_text(value or "")
+        quote = '"'
+        if '"' in value:
+            if "'" in value:
+                value = value.replace('"', "&quot;")
+            else:
+                quote = "'"
+        html.append(f" {name}={quote}{value}{quote}")
+    return "".join(html)
+
+
+def filter_attrs(tag, attrs):
+    attrs = {name: value for name, value in attrs.items() if name in ELEMENT_ATTRS}
+    for name in LIST_ATTRS.get(tag, ()):
+        if name in attrs:
+            attrs[name] = " ".join((attrs[name] or "").split())
+    return attrs
+
+
+def write_element(item, children, html, unwrap_tags, preserve=False, rows=None):
+    """
+    Write a normalized element to the html list
+    :param preserve: the element is in a tag of PRESERVE_WHITESPACE_TAGS
+    :param rows: children of the element, default: children(node)
+    """
+    tag, attrs, node = item
+    if rows is None:
+        rows = children(node)
+    html.append(f"<{tag}{format_attrs(filter_attrs(tag, attrs))}>")
+    n_html = len(html)
+    preserve = preserve or tag in PRESERVE_WHITESPACE_TAGS
+    write_children(rows, tag, children, html, unwrap_tags, preserve)
+    if tag in VOID_TAGS and len(html) == n_html:
+        html[-1] = html[-1][:-1] + "/>"
+    else:
+        html.append(f"</{tag}>")
+
+
+def write_children(items, parent_tag, children, html, unwrap_tags, preserve=False):
+    for item in items:
+        if isinstance(item, HTMLComment):
+            html.append(f"<!--{item}-->")
+        elif isinstance(item, str):
+            if not preserve:
+                item = collapse_whitespace(item)
+            html.append(item if parent_tag in CDATA_TAGS else escape_text(item))
+        elif item[0] in EXTRACT_TAGS:
+            continue
+        elif item[0] in unwrap_tags:
+            # The children of an unwrapped tag are the children of its parent
+            write_children(
+                children(item[2]),
+                parent_tag,
+                children,
+                html,
+                unwrap_tags,
+                preserve or item[0] in PRESERVE_WHITESPACE_TAGS,
+            )
+        else:
+            write_element(item, children, html, unwrap_tags, preserve)
+
+
+def is_header_row(tr, children):
+    """A row of <th> cells, texts, and comments (see move_header_rows)"""
+    return all(isinstance(col, str) or col[0] == "th" for col in children(tr[2]))
+
+
+def normalize_wikitable(table, children, unwrap_tags=UNWRAP_TAGS):
+    """
+    Normalize a wikitable as normalize_wikitables_css
+    :param table: (tag, attrs, node) of the table
+    :param children: children function of the tree (e.g., lxml_children)
+    :return: normalized HTML of the table
+    """
+    items = list(children(table[2]))
+    # move_header_rows: rows of each tbody, without the rows moved to thead
+    thead_rows = []
+    tbody_rows = {}
+    end_header = False
+    for i, item in enumerate(items):
+        if isinstance(item, str) or item[0] != "tbody":
+            continue
+        rows = list(children(item[2]))
+        j = 0
+        while j < len(rows):
+            row = rows[j]
+            if not isinstance(row, str) and row[0] == "tr":
+                if not end_header and is_header_row(row, children):
+                    # bs4 removes the row from the list it iterates over, so
+                    # the item after the row is skipped
+                    thead_rows.append(rows.pop(j))
+                else:
+                    end_header = True
+            j += 1
+        tbody_rows[i] = rows
+
+    table_attrs = {name: v for name, v in table[1].items() if name in TABLE_ATTRS}
+    table_attrs["border"] = "1"
+    html = [f"<table{format_attrs(table_attrs)}>"]
+    if thead_rows:
+        html.append("<thead>")
+        write_children(thead_rows, "thead", children, html, unwrap_tags)
+        html.append("</thead>")
+    for i, item in enumerate(items):
+        if i in tbody_rows:
+            write_element(item, children, html, unwrap_tags, rows=tbody_rows[i])
+        else:
+            write_children([item], "table", children, html, unwrap_tags)
+    html.append("</table>")
+    return "".join(html)
+
+
+def get_text(item, children):
+    """Text of an element (tag, attrs, node), as bs4 get_text"""
+    text = []
+
+    def add_text(node, preserve):
+        for child in children(node):
+            if isinstance(child, HTMLComment):
+                continue
+            if isinstance(child, str):
+                text.append(child if preserve else collapse_whitespace(child))
+            elif child[0] not in NON_TEXT_TAGS:
+                add_text(child[2], preserve or child[0] in PRESERVE_WHITESPACE_TAGS)
+
+    add_text(item[2], item[0] in PRESERVE_WHITESPACE_TAGS)
+    return "".join(text)
@@ -0,0 +1,221 @@
+import html
+import math
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+FONT_SIZE = 16
+FONT_FILES = ["DejaVuSans.ttf", "Arial.ttf"]
+BOLD_FONT_FILES = ["DejaVuSans-Bold.ttf", "Arial Bold.ttf"]
+
+# Same as the stylesheet of create_style (td,th{padding:6px}) and html_to_img
+CELL_PADDING = 6
+BORDER_WIDTH = 1
+ADD_BORDER = 2
+MAX_LINE_WIDTH = 400
+
+# Tags that break the text of a cell into lines
+LINE_BREAK_TAGS = ("<br", "</p>", "</div>", "</li>", "</dd>", "</dt>")
+
+
+@lru_cache(maxsize=None)
+def load_font(bold=False, size=FONT_SIZE):
+    for font_file in BOLD_FONT_FILES if bold else FONT_FILES:
+        try:
+            return ImageFont.truetype(font_file, size)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+
+@lru_cache(maxsize=None)
+def get_line_height(font):
+    if hasattr(font, "getmetrics"):
+        ascent, descent = font.getmetrics()
+        return ascent + descent
+    _, top, _, bottom = font.getbbox("Ag")
+    return bottom - top
+
+
+def parse_structure_tokens(struc_tokens):
+    """
+    Read the PubTabNet structure tokens of a table
+    :return: list of rows. A row is a list of cells [rowspan, colspan, is_header]
+    """
+    rows = []
+    is_header = False
+    cell = None
+    for token in struc_tokens:
+        if token == "<thead>":
+            is_header = True
+        elif token == "</thead>":
+            is_header = False
+        elif token == "<tr>":
+            rows.append([])
+        elif token in ["<td>", "<td"]:
+            cell = [1, 1, is_header]
+            rows[-1].append(cell)
+        elif token.startswith(" rowspan="):
+            cell[0] = int(token.split('"')[1])
+        elif token.startswith(" colspan="):
+            cell[1] = int(token.split('"')[1])
+    return rows
+
+
+def get_cell_text(cell_tokens):
+    """Get the text lines of a cell from its tokens (see html_string2list)"""
+    text = []
+    for token in cell_tokens:
+        if len(token) > 1 and token.startswith("<"):
+            if token.startswith(LINE_BREAK_TAGS):
+                text.append("\n")
+            continue
+        text.append(token)
+    text = html.unescape("".join(text))
+    # Collapse white spaces as browsers do
+    lines = [" ".join(line.split()) for line in text.split("\n")]
+    return [line for line in lines if line]
+
+
+def wrap_line(line, font, max_width=MAX_LINE_WIDTH):
+    lines = []
+    cur = ""
+    for word in line.split(" "):
+        candidate = f"{cur} {word}" if cur else word
+        if cur and font.getlength(candidate) > max_width:
+            lines.append(cur)
+            cur = word
+        else:
+            cur = candidate
+    lines.append(cur)
+    return lines
+
+
+def place_cells(rows):
+    """
+    Place cells on the table grid (colspan and rowspan) as the HTML table model
+    :return: list of [row, col, rowspan, colspan, is_header], number of rows, and
+    number of columns
+    """
+    n_rows = len(rows)
+    occupied = set()
+    cells = []
+    for r, row in enumerate(rows):
+        c = 0
+        for rowspan, colspan, is_header in row:
+            while (r, c) in occupied:
+                c += 1
+            # Browsers clip row spans at the end of the table
+            rowspan = min(rowspan, n_rows - r)
+            for dr in range(rowspan):
+                for dc in range(colspan):
+                    occupied.add((r + dr, c + dc))
+            cells.append([r, c, rowspan, colspan, is_header])
+            c += colspan
+    n_cols = max((c + colspan for _, c, _, colspan, _ in cells), default=0)
+    return cells, n_rows, n_cols
+
+
+def fit_spans(sizes, spans):
+    """
+    Compute the sizes of grid tracks (columns or rows)
+    :param sizes: list of track sizes to update
+    :param spans: list of (start, span, size) of cells
+    """
+    for start, span, size in sorted(spans, key=lambda s: s[1]):
+        end = start + span
+        available = sum(sizes[start:end]) + (span - 1) * BORDER_WIDTH
+        if available >= size:
+            continue
+        extra = size - available
+        for k in range(start, end):
+            sizes[k] += extra // span + (1 if k - start < extra % span else 0)
+
+
+def table_to_img(struc_tokens, list_cell_contents, border_cat=0, center=False):
+    """
+    Lay out a PubTabNet table without browser, and draw it with PIL
+    :param struc_tokens: structure tokens (see transform_html_id_text)
+    :param list_cell_contents: tokens of cells, empty for empty cells
+    :param border_cat: borders as create_style. 0, 1: all cell borders (the table
+    has border="1"), 2: bottom borders, 3: left borders and header bottom borders
+    :param center: center the cell texts
+    :return: image, bounding boxes of non empty cells [lentext, txt, xmin, ymin,
+    xmax, ymax] (same as html_to_img)
+    """
+    cells, n_rows, n_cols = place_cells(parse_structure_tokens(struc_tokens))
+    if not cells or len(cells) != len(list_cell_contents):
+        return None, None
+
+    # Measure cell contents
+    col_spans, row_spans = [], []
+    for cell, cell_tokens in zip(cells, list_cell_contents):
+        r, c, rowspan, colspan, is_header = cell
+        font = load_font(bold=is_header)
+        lines = []
+        for line in get_cell_text(cell_tokens):
+            lines.extend(wrap_line(line, font))
+        text_width = math.ceil(max((font.getlength(l) for l in lines), default=0))
+        text_height = get_line_height(font) * len(lines)
+        cell.extend([font, lines, text_width, text_height])
+        col_spans.append((c, colspan, text_width + 2 * CELL_PADDING))
+        row_spans.append((r, rowspan, text_height + 2 * CELL_PADDING))
+
+    col_widths = [0] * n_cols
+    row_heights = [0] * n_rows
+    fit_spans(col_widths, col_spans)
+    fit_spans(row_heights, row_spans)
+
+    col_x = [BORDER_WIDTH]
+    for width in col_widths:
+        col_x.append(col_x[-1] + width + BORDER_WIDTH)
+    row_y = [BORDER_WIDTH]
+    for height in row_heights:
+        row_y.append(row_y[-1] + height + BORDER_WIDTH)
+
+    im = Image.new("RGB", (col_x[-1], row_y[-1]), "white")
+    draw = ImageDraw.Draw(im)
+    bboxes = []
+    for cell, cell_tokens in zip(cells, list_cell_contents):
+        r, c, rowspan, colspan, is_header, font, lines, text_width, text_height = cell
+        x0, y0 = col_x[c], row_y[r]
+        x1, y1 = col_x[c + colspan] - BORDER_WIDTH, row_y[r + rowspan] - BORDER_WIDTH
+
+        # Borders are drawn on the grid lines around the cell
+        if border_cat in [0, 1]:
+            draw.rectangle([x0 - 1, y0 - 1, x1, y1], outline="black")
+        elif border_cat == 2:
+            draw.line([x0 - 1, y1, x1, y1], fill="black")
+        elif border_cat == 3:
+            if c:
+                draw.line([x0 - 1, y0 - 1, x0 - 1, y1], fill="black")
+            if is_header:
+                draw.line([x0 - 1, y1, x1, y1], fill="black")
+
+        if not cell_tokens:
+            continue
+
+        # Text is vertically centered, and left aligned (or centered)
+        line_height = get_line_height(font)
+        tx = x0 + CELL_PADDING
+        if center or is_header:
+            tx = x0 + (x1 - x0 - text_width) // 2
+        ty = y0 + (y1 - y0 - text_height) // 2
+        for k, line in enumerate(lines):
+            lx = tx
+            if center or is_header:
+                lx = tx + (text_width - font.getlength(line)) // 2
+            draw.text((lx, ty + k * line_height), line, fill="black", font=font)
+
+        txt = "\n".join(lines)
+        bboxes.append(
+            [
+                len(txt),
+                txt,
+                tx - ADD_BORDER,
+                ty - ADD_BORDER,
+                tx + text_width + ADD_BORDER,
+                ty + text_height + ADD_BORDER,
+            ]
+        )
+    return im, bboxes
@@ -0,0 +1,140 @@
+import re
+
+from bs4 import BeautifulSoup
+
+# A tag (from "<" to the next ">", unless another "<" comes first), or text
+HTML_TOKEN_PATTERN = re.compile(r"(<[^<>]*>?)|([^<]+)")
+
+SPAN_ATTRS = ("colspan", "rowspan")
+
+
+def html_string2list(html_string):
+    """
+    this function convert string into list of char and html tag
+    Tags without ">" (before the next "<" or the end) and comments are dropped
+    """
+    list_ = []
+    for html_tag, text in HTML_TOKEN_PATTERN.findall(html_string):
+        if text:
+            list_.extend(text)
+        elif html_tag.endswith(">") and not html_tag.startswith(("<!--", "<![")):
+            # ignore comment inside cell content
+            list_.append(html_tag)
+    return list_
+
+
+def check_int_span(s):
+    # check span col/row is between 2~20
+    if not s.isdigit():
+        return False
+    if int(s) < 2 or int(s) > 20:
+        return False
+    return True
+
+
+def parse_table_html(html):
+    """
+    Parse the HTML of a table (or of a page with a table) as the render stage
+    reads it: without the space of "> </td>" and the line breaks, with lxml, and
+    with empty captions
+    """
+    html = html.replace("> </td>", "></td>")
+    html = html.replace("> </th>", "></th>")
+    html = html.replace("\n", "")
+    soup = BeautifulSoup(html, "lxml")
+    for caption in soup.find_all("caption"):
+        caption.string = ""
+    return soup
+
+
+def tokenize_table(soup, on_cell=None):
+    """
+    Compute the PubTabNet tokens of a table parsed by parse_table_html
+    :param on_cell: called with each cell (tag) that is not empty and its inner
+    HTML, in the order of the cell tokens
+    :return: structure tokens and cell tokens (empty for empty cells), or None,
+    None if the table is not a valid pattern: not one thead and one tbody, a
+    table inside a cell, or a colspan/rowspan that is not in 2~20
+    """
+    thead = soup.find_all("thead")
+    tbody = soup.find_all("tbody")
+    if len(thead) != 1 or len(tbody) != 1:
+        return None, None
+
+    struc_tokens = []
+    list_cell_contents = []
+    for tag_ in thead + tbody:
+        struc_tokens.append(f"<{tag_.name}>")
+        for tr in tag_.find_all("tr"):
+            cells = tr.find_all("td") + tr.find_all("th")
+            if not cells:
+                continue
+            struc_tokens.append("<tr>")
+            for td in cells:
+                if td.find_all("table"):
+                    # if there is a table inside the cell, then ignore this pattern
+                    return None, None
+                if not td.contents or td.text.strip() == "":
+                    list_cell_contents.append([])
+                    struc_tokens.extend(["<td>", "</td>"])
+                    continue
+                # store the content of this cell
+                cell_html = "".join(str(el) for el in td.contents)
+                list_cell_contents.append(html_string2list(cell_html))
+                if on_cell is not None:
+                    on_cell(td, cell_html)
+
+                spans = [attr for attr in SPAN_ATTRS if td.has_attr(attr)]
+                if not spans:
+                    struc_tokens.extend(["<td>", "</td>"])
+                    continue
+                struc_tokens.append("<td")
+                for attr in spans:
+                    if not check_int_span(td[attr]):
+                        return None, None
+                    struc_tokens.append(f' {attr}="{td[attr]}"')
+                struc_tokens.extend([">", "</td>"])
+            struc_tokens.append("</tr>")
+        struc_tokens.append(f"</{tag_.name}>")
+    return struc_tokens, list_cell_contents
+
+
+def get_table_tokens(table_html):
+    """
+    Compute the PubTabNet tokens of the HTML of a normalized wikitable, as
+    transform_html_id_text computes them in the render stage
+    :return: see tokenize_table
+    """
+    return tokenize_table(parse_table_html(table_html))
+
+
+def compact_cell_tokens(cell_tokens):
+    """
+    Join the characters of each text in the tokens of a cell, e.g.,
+    ["<b>", "a", "b", "</b>"] -> ["<b>", "ab", "</b>"]. Tag tokens start with
+    "<", text characters never do (see html_string2list)
+    """
+    runs = []
+    text = []
+    for token in cell_tokens:
+        if token.startswith("<"):
+            if text:
+                runs.append("".join(text))
+                text = []
+            runs.append(token)
+        else:
+            text.append(token)
+    if text:
+        runs.append("".join(text))
+    return runs
+
+
+def expand_cell_tokens(runs):
+    """Tokens of a cell compacted by compact_cell_tokens"""
+    tokens = []
+    for run in runs:
+        if run.startswith("<"):
+            tokens.append(run)
+        else:
+            tokens.extend(run)
+    return tokens
@@ -0,0 +1,100 @@
+import hashlib
+import math
+import os
+import sqlite3
+
+import numpy
+import ujson
+
+
+class BloomFilter:
+    """
+    Bloom filter of string keys. False positives happen at about error_rate when
+    it holds capacity keys, false negatives never happen.
+    """
+
+    def __init__(self, capacity=10_000_000, error_rate=0.01):
+        self.n_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self.bits = numpy.zeros((self.n_bits + 7) // 8, dtype=numpy.uint8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+
+class DiskHashSet:
+    """
+    Set of string keys with a value (e.g., a reference to the first occurrence),
+    stored in a SQLite file. A Bloom filter answers most lookups of new keys in
+    memory, the SQLite file verifies the possible duplicates exactly. Memory is
+    bounded by the Bloom filter (about 1.2 MB per million keys at error_rate 0.01)
+    and the SQLite page cache.
+    """
+
+    def __init__(self, file_name, capacity=10_000_000, error_rate=0.01):
+        self.file_name = file_name
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.db = sqlite3.connect(file_name)
+        # The set is rebuilt if the process crashes, durability is not needed
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS hash_set (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        for (key,) in self.db.execute("SELECT key FROM hash_set"):
+            self.bloom.add(key)
+        self.n_false_positives = 0
+
+    def get(self, key):
+        if key not in self.bloom:
+            return None
+        row = self.db.execute(
+            "SELECT value FROM hash_set WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.n_false_positives += 1
+            return None
+        return ujson.loads(row[0])
+
+    def add(self, key, value):
+        """
+        Add a key if it is not in the set
+        :param value: JSON serializable value, not None
+        :return: the value of the existing key, or None if the key is new
+        """
+        existing = self.get(key)
+        if existing is not None:
+            return existing
+        self.bloom.add(key)
+        self.db.execute(
+            "INSERT OR IGNORE INTO hash_set VALUES (?, ?)", (key, ujson.dumps(value))
+        )
+        return None
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self, delete=False):
+        self.db.commit()
+        self.db.close()
+        if delete and os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -2,14 +2,16 @@ import bz2
 import csv
 import fnmatch
 import gzip
+import io
 import logging
 import math
 import os
 import pickle
 import shutil
 import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-import numpy
 import ujson
 import tarfile
 
@@ -21,6 +23,10 @@ def read_tsv_file_first_col(file_name, encoding):
 
 
 def read_line_from_file(file_name, mode="r"):
+    if ".tar" in file_name:
+        for _, line in read_line_from_tar_file(file_name):
+            yield line if "b" in mode else line.decode("utf-8")
+        return
     if ".bz2" in file_name:
         reader = bz2.BZ2File(file_name, mode=mode)
     elif ".gz" in file_name:
@@ -32,6 +38,77 @@ def read_line_from_file(file_name, mode="r"):
             yield line
 
 
+def read_line_from_tar_file(file_name, start_member=None, start_line=0):
+    """
+    Stream the lines of every member of a (compressed) tar archive, e.g., the
+    *_N.ndjson members of Wikipedia Enterprise HTML dumps, without extracting it.
+    :param file_name: .tar, .tar.gz, or .tar.bz2 file
+    :param start_member: skip the members before this member name (resume)
+    :param start_line: skip the lines before this line number of start_member
+    :return: yield (position, line). position is (member name, line number,
+    number of bytes read from file_name)
+    """
+    with open(file_name, "rb") as raw:
+        yield from read_line_from_tar_stream(raw, start_member, start_line)
+
+
+def read_line_from_tar_stream(raw, start_member=None, start_line=0):
+    """
+    Stream the lines of every member of a (compressed) tar archive from a binary
+    stream with read and tell, e.g., a file or an HTTP body. See
+    read_line_from_tar_file.
+    """
+    with tarfile.open(fileobj=raw, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            if start_member:
+                if member.name != start_member:
+                    continue
+                start_member = None
+            else:
+                start_line = 0
+            member_reader = tar.extractfile(member)
+            for line_no, line in enumerate(member_reader):
+                if line_no < start_line:
+                    continue
+                yield (member.name, line_no, raw.tell()), line
+
+
+def read_line_with_position(file_name, start_member=None, start_line=0):
+    """
+    Read lines (bytes) of a dump file with their position in the file.
+    See read_line_from_tar_file. The member name of a non-tar file is its base name.
+    """
+    if ".tar" in file_name:
+        yield from read_line_from_tar_file(file_name, start_member, start_line)
+        return
+
+    member_name = os.path.basename(file_name)
+    with open(file_name, "rb") as raw:
+        if ".bz2" in file_name:
+            reader = bz2.BZ2File(raw)
+        elif ".gz" in file_name:
+            reader = gzip.GzipFile(fileobj=raw)
+        else:
+            reader = raw
+        for line_no, line in enumerate(reader):
+            if line_no < start_line:
+                continue
+            yield (member_name, line_no, raw.tell()), line
+
+
+def read_batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def print_status(message, is_screen=True, is_log=True) -> object:
     if isinstance(message, int):
         message = f"{message:,}"
@@ -154,6 +231,8 @@ def load_object_csv(file_name, encoding="utf-8", retries=2):
 
 
 def save_object_csv(file_name, rows):
+    import numpy
+
     create_dir(file_name)
     temp_file = "%s.temp" % file_name
     with open(temp_file, "w") as f:
@@ -175,17 +254,379 @@ def save_object_csv(file_name, rows):
     os.rename(temp_file, file_name)
 
 
-def read_json_file(input_file: str, limit: int = 0):
-    if input_file.endswith(".bz2"):
-        jsonFile = bz2.BZ2File(input_file)
+COMPRESSION_CODECS = {".bz2": "bz2", ".gz": "gz", ".zst": "zst"}
+
+
+def get_compression_codec(file_name):
+    for extension, codec in COMPRESSION_CODECS.items():
+        if file_name.endswith(extension):
+            return codec
+    return None
+
+
+def compress_block(data, codec, level=None):
+    if codec == "bz2":
+        return bz2.compress(data, level or 9)
+    if codec == "gz":
+        return gzip.compress(data, level or 9, mtime=0)
+    if codec == "zst":
+        import zstandard
+
+        return zstandard.ZstdCompressor(level=level or 3).compress(data)
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+class CompressedWriter:
+    """
+    Text writer that compresses independent blocks on a thread pool (bz2, gzip,
+    and zstd release the GIL) and writes them in order. Each block is a complete
+    bz2 stream, gzip member, or zstd frame, so the output is a standard
+    multi-stream file, e.g., readable by bz2.BZ2File.
+    Blocks end at line boundaries, and their line ranges and offsets are saved to
+    a block index (see load_block_index) for random access.
+    """
+
+    def __init__(
+        self,
+        file_name,
+        mode="w",
+        codec=None,
+        level=None,
+        block_size=1 << 22,
+        n_threads=None,
+        index=True,
+        index_file=None,
+    ):
+        self.codec = codec or get_compression_codec(file_name)
+        if not self.codec:
+            raise ValueError(f"Unknown compression codec of {file_name}")
+        self.level = level
+        self.block_size = block_size
+        self.n_threads = n_threads or os.cpu_count() or 1
+        self.file = open(file_name, mode.replace("t", "") + "b")
+        self.executor = ThreadPoolExecutor(max_workers=self.n_threads)
+        self.pending = deque()
+        self.buffer = []
+        self.buffer_size = 0
+
+        self.index_file = index_file or get_block_index_file(file_name)
+        self.offset = self.file.tell()
+        self.blocks = [] if index else None
+        if index and self.offset:
+            # Continue the index of the existing blocks if it covers the file
+            index = None
+            if os.path.exists(self.index_file):
+                index = load_json_file(self.index_file)
+            if index and index["codec"] == self.codec:
+                self.blocks = [
+                    block for block in index["blocks"] if sum(block[2:]) <= self.offset
+                ]
+            if not self.blocks or sum(self.blocks[-1][2:]) != self.offset:
+                self.blocks = None
+                delete_file(self.index_file)
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= self.block_size and data.endswith(b"\n"):
+            self._submit_block()
+        return len(text)
+
+    def _submit_block(self):
+        if not self.buffer:
+            return
+        data = b"".join(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+        self.pending.append(
+            (
+                data.count(b"\n"),
+                self.executor.submit(compress_block, data, self.codec, self.level),
+            )
+        )
+        # Bound the memory of compressed blocks waiting to be written
+        while len(self.pending) > self.n_threads * 2:
+            self._write_block()
+
+    def _write_block(self):
+        n_lines, future = self.pending.popleft()
+        compressed = future.result()
+        self.file.write(compressed)
+        if self.blocks is not None:
+            start_line = sum(self.blocks[-1][:2]) if self.blocks else 0
+            self.blocks.append([start_line, n_lines, self.offset, len(compressed)])
+        self.offset += len(compressed)
+
+    def flush(self):
+        """End the current block, and write all compressed blocks to the file"""
+        self._submit_block()
+        while self.pending:
+            self._write_block()
+        self.file.flush()
+        if self.blocks is not None:
+            save_json_file(
+                self.index_file,
+                {"codec": self.codec, "file_size": self.offset, "blocks": self.blocks},
+            )
+
+    def close(self):
+        if self.file.closed:
+            return
+        if not self.offset and not self.pending and not self.buffer:
+            # Write an empty stream, so that the file is a valid compressed file
+            self.buffer.append(b"")
+            self._submit_block()
+        self.flush()
+        self.executor.shutdown()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_text_writer(file_name, mode="w", codec=None, **kwargs):
+    """Open a text writer, compressed with CompressedWriter if a codec is given or
+    the file name has a compression extension (.bz2, .gz, .zst)"""
+    codec = codec or get_compression_codec(file_name)
+    if codec:
+        return CompressedWriter(file_name, mode, codec=codec, **kwargs)
+    return open(file_name, mode)
+
+
+def open_binary_reader(file_name, codec=None):
+    """Open a (compressed) file, concatenated streams are read as one file"""
+    codec = codec or get_compression_codec(file_name)
+    if codec == "bz2":
+        return bz2.BZ2File(file_name)
+    if codec == "gz":
+        return gzip.open(file_name, "rb")
+    if codec == "zst":
+        import zstandard
+
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            open(file_name, "rb"), read_across_frames=True, closefd=True
+        )
+        return io.BufferedReader(reader)
+    return open(file_name, "rb")
+
+
+# Files written next to a dump: block index, metadata, table hashes, resume
+# checkpoint, temp file of an unfinished dump, and its deduplication set
+SIDECAR_EXTENSIONS = (
+    ".index.json",
+    ".meta.json",
+    ".hashes.jsonl.bz2",
+    ".checkpoint.json",
+    ".tmp",
+    ".dedup.db",
+)
+
+
+def get_block_index_file(file_name):
+    return file_name + ".index.json"
+
+
+def get_hash_index_file(file_name):
+    return file_name + ".hashes.jsonl.bz2"
+
+
+def get_checkpoint_file(file_name):
+    return file_name + ".checkpoint.json"
+
+
+def get_tmp_file(file_name):
+    return file_name + ".tmp"
+
+
+def get_dedup_file(file_name):
+    return file_name + ".dedup.db"
+
+
+def is_sidecar_file(file_name):
+    return file_name.endswith(SIDECAR_EXTENSIONS)
+
+
+def get_metadata_file(file_name):
+    return file_name + ".meta.json"
+
+
+def load_metadata(file_name):
+    """
+    Load the metadata of a dump (e.g., number of tables, pages) if it is up to date
+    """
+    metadata_file = get_metadata_file(file_name)
+    if not os.path.exists(metadata_file):
+        return None
+    metadata = load_json_file(metadata_file)
+    if metadata.get("output_size") != os.path.getsize(file_name):
+        return None
+    return metadata
+
+
+def update_metadata(file_name, **kwargs):
+    metadata_file = get_metadata_file(file_name)
+    if not os.path.exists(metadata_file):
+        return
+    metadata = load_json_file(metadata_file)
+    metadata.update(kwargs)
+    save_json_file(metadata_file, metadata)
+
+
+def count_lines(file_name):
+    """Count the lines of a (compressed) file without decoding them"""
+    n_lines = 0
+    with open_binary_reader(file_name) as f:
+        while True:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            n_lines += data.count(b"\n")
+    return n_lines
+
+
+def get_decompressor(codec):
+    if codec == "bz2":
+        return bz2.BZ2Decompressor()
+    if codec == "gz":
+        return zlib.decompressobj(wbits=31)
+    if codec == "zst":
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+def build_block_index(file_name, block_size=1 << 22):
+    """
+    Build the block index of a file: the list of [start line, number of lines,
+    offset, size] of its blocks. A block of a compressed file is a compressed
+    stream (or consecutive streams) ending at a line boundary, so a file written
+    by a single stream has only one block.
+    """
+    codec = get_compression_codec(file_name)
+    blocks = []
+    start_line, n_lines, block_offset = 0, 0, 0
+    with open(file_name, "rb") as f:
+        if not codec:
+            while True:
+                data = f.read(block_size)
+                if not data:
+                    break
+                data += f.readline()
+                n_lines = data.count(b"\n")
+                blocks.append([start_line, n_lines, block_offset, len(data)])
+                start_line += n_lines
+                block_offset += len(data)
+        else:
+            decompressor = get_decompressor(codec)
+            offset = 0
+            last_byte = b""
+            while True:
+                data = f.read(1 << 20)
+                if not data:
+                    break
+                while data:
+                    decompressed = decompressor.decompress(data)
+                    n_lines += decompressed.count(b"\n")
+                    last_byte = decompressed[-1:] or last_byte
+                    if not decompressor.eof:
+                        offset += len(data)
+                        break
+                    stream_end = offset + len(data) - len(decompressor.unused_data)
+                    data = decompressor.unused_data
+                    offset = stream_end
+                    decompressor = get_decompressor(codec)
+                    if last_byte == b"\n":
+                        block_size = stream_end - block_offset
+                        blocks.append([start_line, n_lines, block_offset, block_size])
+                        start_line += n_lines
+                        n_lines = 0
+                        block_offset = stream_end
+    return {"codec": codec, "file_size": os.path.getsize(file_name), "blocks": blocks}
+
+
+def load_block_index(file_name, build=True):
+    """
+    Load the block index of a file (built at write time by CompressedWriter). If
+    it is missing or outdated, build it and save it next to the file.
+    """
+    index_file = get_block_index_file(file_name)
+    if os.path.exists(index_file):
+        index = load_json_file(index_file)
+        if index["file_size"] == os.path.getsize(file_name):
+            return index
+    if not build:
+        return None
+    index = build_block_index(file_name)
+    save_json_file(index_file, index)
+    return index
+
+
+def read_block_lines(f, offset, size, codec):
+    """Yield the lines of a block (see build_block_index) of an opened file"""
+    f.seek(offset)
+    decompressor = get_decompressor(codec) if codec else None
+    rest = b""
+    while size > 0:
+        data = f.read(min(size, 1 << 20))
+        if not data:
+            break
+        size -= len(data)
+        if decompressor is not None:
+            decompressed = []
+            while data:
+                decompressed.append(decompressor.decompress(data))
+                if not decompressor.eof:
+                    break
+                data = decompressor.unused_data
+                decompressor = get_decompressor(codec)
+            data = b"".join(decompressed)
+        lines = (rest + data).split(b"\n")
+        rest = lines.pop()
+        yield from lines
+    if rest:
+        yield rest
+
+
+def read_line_range(file_name, start=0, end=None):
+    """
+    Read the lines [start, end) of a file. Only the blocks covering the range are
+    read and decompressed, so workers can read disjoint ranges in parallel.
+    """
+    index = load_block_index(file_name)
+    with open(file_name, "rb") as f:
+        for start_line, n_lines, offset, size in index["blocks"]:
+            if start_line + n_lines <= start:
+                continue
+            if end is not None and start_line >= end:
+                break
+            lines = read_block_lines(f, offset, size, index["codec"])
+            for i, line in enumerate(lines, start=start_line):
+                if i < start:
+                    continue
+                if end is not None and i >= end:
+                    return
+                yield line
+
+
+def read_json_file(input_file: str, limit: int = 0, start: int = 0, end: int = None):
+    """
+    Read the JSON objects of a jsonl file
+    :param limit: return the first limit objects
+    :param start: read from line start (0-based). See read_line_range
+    :param end: read until line end (excluded)
+    """
+    if start or end is not None:
+        jsonFile = read_line_range(input_file, start, end)
     else:
-        jsonFile = open(input_file, "r")
+        jsonFile = open_binary_reader(input_file)
     i = 0
     limit = int(limit)
-    while True:
-        line = jsonFile.readline()
-        if not line:
-            break
+    for line in jsonFile:
         i += 1
         if limit and i > limit:
             break
@@ -194,6 +635,19 @@ def read_json_file(input_file: str, limit: int = 0):
     jsonFile.close()
 
 
+def save_json_file(file_name, save_object):
+    create_dir(file_name)
+    temp_file = file_name + ".temp"
+    with open(temp_file, "w") as f:
+        ujson.dump(save_object, f)
+    os.replace(temp_file, file_name)
+
+
+def load_json_file(file_name):
+    with open(file_name, "r") as f:
+        return ujson.load(f)
+
+
 def get_files_from_dir_stream(folder_path, extension="*"):
     for root, _, file_dirs in os.walk(folder_path):
         for file_dir in fnmatch.filter(file_dirs, "*.%s" % extension):
@@ -225,6 +679,85 @@ def get_files_from_dir(
     return all_file_dirs[:limit_reader]
 
 
+class TarShardWriter:
+    """
+    Write samples to a sequence of uncompressed tar shards (WebDataset layout):
+    the files of a sample are consecutive members named {key}.{extension}.
+    A shard is closed at the first flush after it reaches shard_size, so shards
+    end at flush (batch) boundaries. Shards are named
+    {prefix}-{shard_id:05d}.tar.
+    """
+
+    def __init__(self, prefix, shard_size=1 << 30):
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.shard_id = 0
+        self.tar = None
+        self.n_samples = 0
+
+    @property
+    def shard_file(self):
+        return f"{self.prefix}-{self.shard_id:05d}.tar"
+
+    def write(self, key, files):
+        """
+        :param key: sample key, it must not contain dots
+        :param files: dict of extension (e.g., "png") and bytes
+        """
+        if self.tar is None:
+            self.tar = tarfile.open(self.shard_file, "w", format=tarfile.USTAR_FORMAT)
+        for extension, data in files.items():
+            info = tarfile.TarInfo(f"{key}.{extension}")
+            info.size = len(data)
+            self.tar.addfile(info, io.BytesIO(data))
+        self.n_samples += 1
+
+    def flush(self):
+        """
+        Write the buffered data to the shard file, and close the shard if it is full
+        :return: shard file and size of its complete members, or None if no shard
+        is open
+        """
+        if self.tar is None:
+            return None
+        shard_file, offset = self.shard_file, self.tar.offset
+        if offset >= self.shard_size:
+            self._close_shard()
+        else:
+            self.tar.fileobj.flush()
+        return shard_file, offset
+
+    def _close_shard(self):
+        self.tar.close()
+        self.tar = None
+        self.shard_id += 1
+
+    def close(self):
+        if self.tar is not None:
+            self._close_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def repair_tar_shard(shard_file, offset):
+    """
+    Repair a shard of a crashed TarShardWriter: drop the members after offset (the
+    last flush), and end the archive. The shard is deleted if it has no member.
+    """
+    if not offset:
+        delete_file(shard_file)
+        return
+    with open(shard_file, "r+b") as f:
+        f.truncate(offset)
+        f.seek(offset)
+        # End of archive: two zero blocks
+        f.write(b"\0" * tarfile.BLOCKSIZE * 2)
+
+
 def compress_folder(input_folder, output_file, delete_org=False):
     if not os.path.exists(input_folder):
         return
@@ -248,14 +781,20 @@ def merge_jsonl_files(input_folder):
         return
     output_file = input_folder + ".jsonl.bz2"
 
-    file_writer = bz2.open(output_file, "wt")
+    file_writer = open_text_writer(output_file, "w")
     n = 0
     input_files = get_files_from_dir(input_folder)
     for input_file in input_files:
-        for line in read_json_file(input_file):
-            file_writer.write(ujson.dumps(line))
-            file_writer.write("\n")
-            n += 1
+        if is_sidecar_file(input_file):
+            continue
+        try:
+            for line in read_json_file(input_file):
+                file_writer.write(ujson.dumps(line))
+                file_writer.write("\n")
+                n += 1
+        except EOFError:
+            # The file of a crashed process ends with an incomplete stream
+            continue
 
     file_writer.close()
     delete_folder(input_folder)
@@ -0,0 +1,161 @@
+import os
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import ujson
+
+from core.utils import io_worker as iw
+
+# Prefix of Prometheus metric names
+METRIC_PREFIX = "wtabhtml"
+# Files with these extensions are saved in the Prometheus text format, others
+# in JSON
+PROMETHEUS_EXTENSIONS = (".prom", ".txt")
+
+
+class StageTimer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.seconds[self.stage] += time.perf_counter() - self.start
+
+
+class Metrics:
+    """
+    Counters and time per stage of a process. Recording is a dict update (and two
+    perf_counter calls for a stage), so metrics are always on. Worker processes
+    record to their own METRICS, and send it to the main process with pop(), which
+    adds it with merge().
+    Counters: errors by reason are named errors.{reason}
+    """
+
+    def __init__(self, **labels):
+        self.labels = labels
+        self.counters = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.start_time = time.time()
+        self.last_report = self.start_time
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def timer(self, stage):
+        """Time a stage: with METRICS.timer("html_parse"): ..."""
+        return StageTimer(self, stage)
+
+    def add_time(self, stage, seconds):
+        self.seconds[stage] += seconds
+
+    def reset(self, **labels):
+        self.__init__(**labels)
+
+    def pop(self):
+        """:return: counters and stage times since the last pop, and reset them"""
+        snapshot = {"counters": dict(self.counters), "seconds": dict(self.seconds)}
+        self.counters.clear()
+        self.seconds.clear()
+        return snapshot
+
+    def merge(self, snapshot):
+        if not snapshot:
+            return
+        for name, value in snapshot["counters"].items():
+            self.counters[name] += value
+        for stage, seconds in snapshot["seconds"].items():
+            self.seconds[stage] += seconds
+
+    def to_dict(self):
+        return {
+            "labels": self.labels,
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "elapsed_seconds": round(time.time() - self.start_time, 3),
+            "counters": dict(sorted(self.counters.items())),
+            "seconds": {k: round(v, 6) for k, v in sorted(self.seconds.items())},
+        }
+
+    def to_prometheus(self):
+        """Prometheus text exposition format"""
+        lines = []
+
+        def add(name, value, metric_type, **labels):
+            labels = {**self.labels, **labels}
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {metric_type}")
+            lines.append(f"{METRIC_PREFIX}_{name}{{{label_text}}} {value}")
+
+        add("elapsed_seconds", round(time.time() - self.start_time, 3), "gauge")
+        for name, value in sorted(self.counters.items()):
+            if name.startswith("errors."):
+                add("errors_total", value, "counter", reason=name[len("errors.") :])
+            else:
+                add(f"{name}_total", value, "counter")
+        for stage, seconds in sorted(self.seconds.items()):
+            add("stage_seconds_total", round(seconds, 6), "counter", step=stage)
+
+        # One TYPE line per metric name
+        seen = set()
+        text = []
+        for line in lines:
+            if line.startswith("# TYPE"):
+                if line in seen:
+                    continue
+                seen.add(line)
+            text.append(line)
+        return "\n".join(text) + "\n"
+
+    def summary(self):
+        """One line summary: elapsed time, counters, and share of time per stage"""
+        elapsed = time.time() - self.start_time
+        labels = " ".join(str(v) for v in self.labels.values())
+        counters = " ".join(
+            f"{name}={value:,}" for name, value in sorted(self.counters.items())
+        )
+        total = sum(self.seconds.values())
+        stages = " ".join(
+            f"{stage} {seconds / total * 100:.0f}%"
+            for stage, seconds in sorted(self.seconds.items(), key=lambda s: -s[1])
+            if total
+        )
+        return f"[{labels}] {elapsed:.0f}s {counters} | {stages}"
+
+    def save(self, file_name):
+        """Save to file_name, Prometheus text (.prom, .txt) or JSON"""
+        iw.create_dir(file_name)
+        tmp_file = file_name + ".tmp"
+        with open(tmp_file, "w") as f:
+            if file_name.endswith(PROMETHEUS_EXTENSIONS):
+                f.write(self.to_prometheus())
+            else:
+                ujson.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_file, file_name)
+
+    def report(self, interval=60, metrics_file=None, write=iw.print_status):
+        """
+        Write the summary line, and save the metrics file, every interval seconds
+        :param write: function to print the summary, e.g., tqdm.write
+        """
+        if not interval or time.time() - self.last_report < interval:
+            return
+        self.last_report = time.time()
+        write(self.summary())
+        if metrics_file:
+            self.save(metrics_file)
+
+
+def get_metrics_file(metrics_file, stage, lang):
+    """Metrics file of a stage and language, e.g., metrics.prom -> metrics.parse.ja.prom"""
+    if not metrics_file:
+        return None
+    root, ext = os.path.splitext(metrics_file)
+    return f"{root}.{stage}.{lang}{ext}"
+
+
+# Metrics of this process
+METRICS = Metrics()
@@ -1,101 +1,128 @@
-import bz2
+import glob
 import json
 import multiprocessing
 import os
+import queue
 import random
 import re
+import tarfile
+import threading
 import time
+import traceback
+from collections import defaultdict
 from io import BytesIO
+from itertools import islice
 
 import cv2
 import numpy as np
 import ujson
 from PIL import Image
 from bs4 import BeautifulSoup
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.firefox.options import Options
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
+from tqdm import tqdm
 
 from config import config as cf
-from core.parse_wikitable_html import get_jsonl_size
+from core import table_layout
+from core.jsonl_dump import get_jsonl_size
+from core.table_tokens import expand_cell_tokens, parse_table_html, tokenize_table
+from core.parse_wikitable_html import UNWRAP_TAGS, normalize_wikitables_css
 from core.utils import io_worker as iw
 from core.utils.io_worker import merge_jsonl_files
+from core.utils.metrics import METRICS
+
+
+# Blank document that stays open in the browser. Tables are injected into it
+# instead of loading a new page per table
+RENDER_PAGE = "data:text/html;charset=utf-8,<html><head></head><body></body></html>"
+
+# Inject the table html, then return the table element and the text and bounding
+# box of every cell in one round trip
+JS_RENDER_TABLE = """
+window.scrollTo(0, 0);
+document.documentElement.innerHTML = arguments[0];
+var table = document.getElementsByTagName("table")[0];
+if (!table) {
+    return null;
+}
+var cells = [];
+for (var i = 0; i < arguments[1]; i++) {
+    var cell = document.getElementById(String(i));
+    if (!cell) {
+        return null;
+    }
+    var rect = cell.getBoundingClientRect();
+    cells.push([cell.innerText, rect.x, rect.y, rect.width, rect.height]);
+}
+var rect = table.getBoundingClientRect();
+return [table, rect.x, rect.y, cells];
+"""
+
+# Borders of the rendered tables (see create_style), for both render backends
+BORDER_CAT = 1
+
+RENDER_BACKENDS = cf.RENDER_BACKENDS
+
+
+def create_driver():
+    """Start a headless Firefox, and open the persistent render page"""
+    from selenium import webdriver
+    from selenium.webdriver.firefox.options import Options
+
+    opts = Options()
+    opts.add_argument("--headless")
+    driver = webdriver.Firefox(options=opts)
+    driver.get(RENDER_PAGE)
+    return driver
 
 
 def html_to_img(driver, html_content, id_count):
-    """converts html to image and bounding boxes of each cell"""
-    counter = 1  # This counter is to keep track of the exceptions and stop execution after 10 exceptions have occurred
+    """
+    converts html to image and bounding boxes of each cell
+    :return: image and bounding boxes, or None, None if the table is not laid out.
+    Browser errors are raised, so the caller can check the browser
+    """
     add_border = 2
-    while True:
-        try:
-            driver.get("data:text/html;charset=utf-8," + html_content)
+    with METRICS.timer("navigate"):
+        rendered = driver.execute_script(JS_RENDER_TABLE, html_content, id_count)
+    if rendered is None:
+        return None, None
+    el, table_x, table_y, cells = rendered
 
-            el = driver.find_element_by_tag_name("table")
-            png = el.screenshot_as_png
+    with METRICS.timer("screenshot"):
+        png = el.screenshot_as_png
+        im = Image.open(BytesIO(png))
 
-            im = Image.open(BytesIO(png))
+    # Same as WebElement.location and WebElement.size
+    table_x, table_y = round(table_x), round(table_y)
+    bboxes = []
+    for txt, x, y, width, height in cells:
+        txt = txt.strip()
+        lentext = len(txt)
+        xmin = round(x) - table_x - add_border
+        ymin = round(y) - table_y - add_border
+        xmax = int(width + xmin) + add_border * 2
+        ymax = int(height + ymin) + add_border * 2
+        bboxes.append([lentext, txt, xmin, ymin, xmax, ymax])
 
-            table_loc = el.location
+    return im, bboxes
 
-            bboxes = []
-            for id in range(id_count):
-                # print(id)
-                e = WebDriverWait(driver, 3).until(
-                    EC.presence_of_element_located((By.ID, str(id)))
-                )
-                txt = e.text.strip()
-                lentext = len(txt)
-                loc = e.location
-                size_ = e.size
-                xmin = loc["x"] - table_loc["x"] - add_border
-                ymin = loc["y"] - table_loc["y"] - add_border
-                xmax = int(size_["width"] + xmin) + add_border * 2
-                ymax = int(size_["height"] + ymin) + add_border * 2
-                bboxes.append([lentext, txt, xmin, ymin, xmax, ymax])
-
-            return im, bboxes
-        except Exception as e:
-            counter += 1
-            return None, None
-            # if counter==10:
-            #     return im,None
-
-            # continue
-
-
-def html_string2list(html_string):
-    """this function convert string into list of char and html tag"""
-    list_ = []
-    idx_tag = -1
-    for i, char in enumerate(html_string):
-        if char == "<":
-            idx_tag = i
-        elif idx_tag != -1 and char == ">":
-            html_tag = html_string[idx_tag : i + 1]
-
-            # ignore comment inside cell content
-            if html_tag.startswith("<!--") or html_tag.startswith("<!["):
-                idx_tag = -1
-                continue
-
-            list_.append(html_tag)
-            idx_tag = -1
-        elif idx_tag == -1:
-            list_.append(char)
 
-    return list_
+def is_random_center():
+    """Center the cell texts of half of the tables at random"""
+    return random.randint(0, 1) == 1
 
 
-def create_style(border_cat):
-    """This function will dynamically create stylesheet of tables"""
+def create_style(border_cat, center=None):
+    """
+    This function will dynamically create stylesheet of tables
+    :param center: center the cell texts, default: at random (is_random_center)
+    """
 
     style = "<head><style>"
     style += "html{background-color: white;}table{"
 
-    # random center align
-    if random.randint(0, 1) == 1:
+    if center is None:
+        center = is_random_center()
+    if center:
         style += "text-align:center;"
 
     style += """border-collapse:collapse;}td,th{padding:6px;padding-left: 6px;padding-right: 6px;"""
@@ -136,59 +163,14 @@ def draw_matrices(img, bboxes, output_file_name):
     cv2.imwrite(img_name, im)
 
 
-def check_int_span(s):
-    # check span col/row is between 2~20
-    if not s.isdigit():
-        return False
-    if int(s) < 2 or int(s) > 20:
-        return False
-    return True
-
-
 def convert_html_to_pubtabnet(table):
     soup = BeautifulSoup(table, "html.parser")
 
     tables = soup.find_all("table", {"class": re.compile("wikitable*")})
     for table in tables:
-        has_header = False
-        end_header = False
-        thead = soup.new_tag("thead")
-        for i1, tag_1 in enumerate(table):
-            if tag_1.name != "tbody":
-                continue
-            # tbody ta
-            for i2, tag2 in enumerate(tag_1):
-                if tag2.name != "tr":
-                    continue
-                if not end_header and all(
-                    (col.name in ["th", None] and col.name not in ["td"])
-                    for col in tag2
-                ):
-                    tag2.extract()
-                    thead.append(tag2)
-                    has_header = True
-                else:
-                    end_header = True
-        if has_header:
-            table.insert(0, thead)
-        table.attrs["border"] = 1
-
-        def filter_attr(bs_obj, white_tags):
-            bs_obj.attrs = {
-                attr: v for attr, v in bs_obj.attrs.items() if attr in white_tags
-            }
-
-        filter_attr(table, ["border", "cellpadding", "style"])
-        for a in table.findAll(True):
-            filter_attr(a, ["colspan", "headers", "rowspan", "cellpadding", "style"])
-
-        for tag in ["a", "span", "link", "img", "div"]:
-            for a in table.findAll(tag):
-                a.unwrap()
-
-        for tag in ["sup"]:
-            for a in table.findAll(tag):
-                a.extract()
+        table = normalize_wikitables_css(
+            soup, table, unwrap_tags=UNWRAP_TAGS + ("div",)
+        )
         return str(table)
 
 
@@ -201,253 +183,615 @@ def transform_html_id_text(html_input):
     # html_input = convert_html_to_pubtabnet(html_input)
     # html_input = html_input.replace("1px solid #a2a9b1", "1")
     html = """<html>"""
-    html += create_style(1)
+    html += create_style(BORDER_CAT)
     html += """<body>"""
     html += html_input
     html += """</body></html>"""
 
-    html = html.replace("> </td>", "></td>")
-    html = html.replace("> </th>", "></th>")
-    html = html.replace("\n", "")
-    # html = html.replace('border="1"', '')
-
-    # print(html)
-
+    # Same parse and tokens as the parse stage (see table_tokens.get_table_tokens)
+    table_ = parse_table_html(html)
     idx_count = 0
 
-    table_ = BeautifulSoup(html, "lxml")
-
-    struc_tokens = []
-    list_cell_contents = []
+    def add_span_id(td, cell_html):
+        # add <span id=''> to content of <td> tag to generate location of cell content
+        nonlocal idx_count
+        td.string = "<span id=" + str(idx_count) + ">" + cell_html + "</span>"
+        idx_count = idx_count + 1
 
-    # ############ Remove caption ##############
-    # will be changed to remain the table title in a table image
-    caption_ = table_.find_all("caption")
-    if len(caption_) > 0:
-        for cap_ in caption_:
-            cap_.string = ""
-
-    # #################get thead and tbody#################
-    thead = table_.find_all("thead")
-    if len(thead) != 1:
+    struc_tokens, list_cell_contents = tokenize_table(table_, add_span_id)
+    if struc_tokens is None:
         return None, None, None, idx_count
 
-    tbody = table_.find_all("tbody")
-    if len(tbody) != 1:
-        return None, None, None, idx_count
-
-    thead_tbody = thead + tbody
-    for tag_ in thead_tbody:
-        if tag_.name == "thead":
-            struc_tokens.append("<thead>")
-        else:
-            struc_tokens.append("<tbody>")
-
-        #  get tr and td
-        for tr in tag_.find_all("tr"):
-            if len(tr.find_all("td") + tr.find_all("th")) == 0:
-                continue
-            struc_tokens.append("<tr>")
-
-            for td in tr.find_all("td") + tr.find_all("th"):
-                if td.find_all("table"):
-                    # if there is a table inside the cell, then ignore this pattern
-                    return None, None, None, idx_count
-                if len(td.contents) == 0:
-                    list_cell_contents.append([])
-                    struc_tokens.append("<td>")
-                    struc_tokens.append("</td>")
-                    continue
-                if td.text.strip() == "":
-                    list_cell_contents.append([])
-                    struc_tokens.append("<td>")
-                    struc_tokens.append("</td>")
-                    continue
-
-                # print(''.join(str(el) for el in td.contents))
-                # print(html_string2list(''.join(str(el) for el in td.contents)))
-
-                # store the content of this cell
-                list_cell_contents.append(
-                    html_string2list("".join(str(el) for el in td.contents))
-                )
-                # add <span id=''> to content of <td> tag to generate location of cell content
-                td.string = (
-                    "<span id="
-                    + str(idx_count)
-                    + ">"
-                    + "".join(str(el) for el in td.contents)
-                    + "</span>"
-                )
-                idx_count = idx_count + 1
-
-                if (not td.has_attr("colspan")) and (not td.has_attr("rowspan")):
-                    struc_tokens.append("<td>")
-                    struc_tokens.append("</td>")
-                else:
-                    struc_tokens.append("<td")
-                    if td.has_attr("colspan"):
-                        if not check_int_span(td["colspan"]):
-                            return None, None, None, idx_count
-
-                        struc_tokens.append(' colspan="' + td["colspan"] + '"')
-                    if td.has_attr("rowspan"):
-                        if not check_int_span(td["rowspan"]):
-                            return None, None, None, idx_count
-
-                        struc_tokens.append(' rowspan="' + td["rowspan"] + '"')
-
-                    struc_tokens.append(">")
-                    struc_tokens.append("</td>")
-
-            struc_tokens.append("</tr>")
-
-        if tag_.name == "thead":
-            struc_tokens.append("</thead>")
-        else:
-            struc_tokens.append("</tbody>")
-
     return struc_tokens, table_.prettify(formatter=None), list_cell_contents, idx_count
 
 
-def get_chunks(start_id, end_id, n_chunks=1):
-    if end_id < 0:
-        raise ValueError()
+def render_table(driver, i, table_obj, shard_writer, split_name):
+    """
+    Render table i, and write the image {key}.png and its PubTabNet annotation
+    {key}.json to the shard writer (see get_sample_key). The annotation has the
+    table hash (see get_table_hash), if any.
+    :param driver: browser to render the table. If None, the table is laid out
+    and drawn with table_layout (no browser), from the PubTabNet tokens saved by
+    the parse (see dump_wikitables tokens) if any
+    :param shard_writer: iw.TarShardWriter
+    :return: True if the table is saved, False if it is an error pattern
+    """
+    if driver is None and table_obj.get("pubtabnet"):
+        # The browser needs the HTML with cell ids of transform_html_id_text
+        struc_tokens = table_obj["pubtabnet"]["structure"]
+        # Cell tokens are saved as text runs (see table_tokens.compact_cell_tokens)
+        list_cell_contents = [
+            expand_cell_tokens(runs) for runs in table_obj["pubtabnet"]["cells"]
+        ]
+    else:
+        with METRICS.timer("transform"):
+            (
+                struc_tokens,
+                html_with_id,
+                list_cell_contents,
+                idx_count,
+            ) = transform_html_id_text(table_obj["html"])
+
+    if struc_tokens is None:
+        METRICS.count("errors.transform")
+        return False
 
-    counts = end_id - start_id + 1
-    nums_per_chunk = counts // n_chunks
-    chunks = []
-    for n in range(n_chunks):
-        if n == n_chunks - 1:
-            chunks.append([n * nums_per_chunk, end_id])
+    if driver is None:
+        with METRICS.timer("layout"):
+            # Same borders and random alignment as the browser (create_style)
+            im, bboxes = table_layout.table_to_img(
+                struc_tokens,
+                list_cell_contents,
+                border_cat=BORDER_CAT,
+                center=is_random_center(),
+            )
+    else:
+        im, bboxes = html_to_img(driver, html_with_id, idx_count)
+    if bboxes is None:
+        METRICS.count("errors.render")
+        return False
+    # Save photo
+    with METRICS.timer("png_encode"):
+        png = BytesIO()
+        im.save(png, format="PNG", dpi=(600, 600))
+
+    # Save ground truth json
+    cells = []
+    idx_ = 0
+    for cell_token_ in list_cell_contents:
+        if len(cell_token_) == 0:
+            cell_ = {"tokens": cell_token_}
         else:
-            chunks.append([n * nums_per_chunk, (n + 1) * nums_per_chunk])
-    return chunks
+            cell_ = {"tokens": cell_token_, "bbox": bboxes[idx_][2:]}
+            idx_ += 1
+
+        cells.append(cell_)
+
+    html_json = {"structure": {"tokens": struc_tokens}, "cells": cells}
+
+    # save to folder
+    key = get_sample_key(i, table_obj)
+    table_sample = {
+        "filename": key + ".png",
+        "split": split_name,
+        "imgid": i,
+        "html": html_json,
+    }
+    if table_obj.get("hash"):
+        table_sample["hash"] = table_obj["hash"]
+
+    files = {"png": png.getvalue(), "json": json.dumps(table_sample).encode()}
+    with METRICS.timer("shard_write"):
+        shard_writer.write(key, files)
+    METRICS.count("bytes_out", sum(len(data) for data in files.values()))
+
+    # # ##########debug
+    # with open('bboxes/' + str(i) + '.txt', 'w') as f:
+    #     f.write(html_with_id)
+    #     f.write(str(table_sample))
+    #
+    # img = np.asarray(im, np.int64)[:, :, 0]
+    # draw_matrices(img, np.array(bboxes), str(i) + '.jpg')
+    # # #########################
+    return True
 
 
-def parse_wiki_tables_mp(input_file, error_file, save_dir, split_name, chunks):
+def get_sample_key(i, table_obj):
     """
-        multiprocessing to parse raw data.
-        One process to do one chunk parsing.
-        :param table_chunks:
-        :return:
-        """
-    # self.read_json_tables(table_chunks[1], 1)
-
-    p = multiprocessing.Pool(len(chunks))
-    for chunk in chunks:
-        args = (input_file, error_file, save_dir, split_name, chunk)
-        p.apply_async(read_json_tables, args)
-    p.close()
-    p.join()
-
-
-def read_json_tables(input_file, error_file, save_dir, split_name, chunk):
+    Sample key of table i: {wikidata}_{index}, unique in a dump, or i for tables
+    without them. In incremental rendering, a changed table is rendered again
+    with the same key in the shards of the new run.
     """
-        Read Japanese Wikipedia tables from one table chunk.
-        :param: this_chunk
-        :param: chunks_idx
-        """
+    if table_obj.get("wikidata") and table_obj.get("index") is not None:
+        return f"{table_obj['wikidata']}_{table_obj['index']}"
+    return str(i)
 
-    opts = Options()
-    opts.add_argument("--headless")
 
-    driver = webdriver.Firefox(options=opts)
-
-    if input_file.endswith(".bz2"):
-        input_file_reader = bz2.BZ2File(input_file)
-    else:
-        input_file_reader = open(input_file, "r")
+def skip_rendered_tables(batch, rendered_hashes):
+    """
+    Replace the tables whose hash is in rendered_hashes (incremental rendering)
+    by their key and hash, without html, so workers skip them
+    """
+    if not rendered_hashes:
+        return batch
+    return [
+        {k: v for k, v in table_obj.items() if k in ("wikidata", "index", "hash")}
+        if table_obj.get("hash") in rendered_hashes
+        else table_obj
+        for table_obj in batch
+    ]
+
+
+def pool_read_tables(
+    input_file, start_id, end_id, batch_size, task_queue, rendered_hashes=None
+):
+    """
+    Reader process: stream the tables [start_id, end_id) once, and put batches of
+    (batch_start, tables) to the task queue. Table ids start from 1.
+    :param rendered_hashes: skip the tables of these hashes (see
+    skip_rendered_tables)
+    """
+    tables = iw.read_json_file(input_file, start=start_id, end=end_id)
+    for batch_start in range(start_id, end_id, batch_size):
+        batch = list(islice(tables, batch_size))
+        if not batch:
+            break
+        task_queue.put((batch_start, skip_rendered_tables(batch, rendered_hashes)))
 
-    start_id, end_id = chunk
 
-    error_file = f"{error_file}{start_id}_{end_id}.jsonl.bz2"
+def forward_tables(
+    table_queue,
+    task_queue,
+    input_file,
+    batch_size,
+    stream_state,
+    stop=None,
+    rendered_hashes=None,
+):
+    """
+    Reader thread of streamed tables (see dump_wikitables table_queue): put batches
+    of (batch_start, tables) to the task queue until receiving None. The tables
+    that are not streamed (all of them if the dump already exists, or the tables
+    after the parse stopped streaming) are then read from input_file. The number
+    of tables is saved to stream_state["end_id"].
+    :param stop: threading.Event. When it is set (rendering is aborted), streamed
+    tables are read and dropped until None, so the parser is not blocked
+    :param rendered_hashes: skip the tables of these hashes (see
+    skip_rendered_tables)
+    """
+    n_tables = 0
+
+    def put_batches(tables):
+        nonlocal n_tables
+        for batch in iw.read_batches(tables, batch_size):
+            batch = skip_rendered_tables(batch, rendered_hashes)
+            while stop is None or not stop.is_set():
+                try:
+                    task_queue.put((n_tables, batch), timeout=1)
+                    break
+                except queue.Full:
+                    continue
+            n_tables += len(batch)
+
+    def get_streamed_tables():
+        while True:
+            tables = table_queue.get()
+            if tables is None:
+                return
+            yield from tables
+
+    try:
+        put_batches(get_streamed_tables())
+        if stop is not None and stop.is_set():
+            return
+        if os.path.exists(input_file):
+            put_batches(iw.read_json_file(input_file, start=n_tables))
+    finally:
+        stream_state["end_id"] = n_tables
+
+
+def get_shard_prefix(save_dir, split_name, run_id, worker_id):
+    return f"{save_dir}{split_name}-{run_id}-w{worker_id:03d}"
+
+
+def get_rendered_hashes(save_dir):
+    """Get the table hashes of the sample annotations in the tar shards of save_dir"""
+    rendered = set()
+    for shard_file in glob.glob(f"{save_dir}*.tar"):
+        with tarfile.open(shard_file) as tar:
+            for member in tar:
+                if not member.name.endswith(".json"):
+                    continue
+                # Samples of older runs are keyed by their table hash
+                sample = ujson.load(tar.extractfile(member))
+                rendered.add(sample.get("hash") or member.name.split(".")[0])
+    return rendered
+
+
+def pool_render_tables(
+    worker_id,
+    task_queue,
+    result_queue,
+    error_file,
+    save_dir,
+    split_name,
+    run_id,
+    render_backend="browser",
+    shard_size=1 << 30,
+):
+    """
+    Worker process: keep one browser for the worker lifetime, pull batches until
+    receiving None, and report every batch to the result queue. A table raising
+    an error with a dead browser is retried once with a new browser, and is an
+    error if it fails again. The worker writes its own tar
+    shards, and reports the shard position after every batch. Tables without
+    html are skipped: tombstones, references of duplicates (see dump_wikitables
+    dedup), and already rendered tables (see skip_rendered_tables). Tables found
+    invalid by the parse (see dump_wikitables tokens) are errors, without
+    rendering them. The metrics of the worker are sent with every batch report.
+    """
+    # Metrics of the parent process are copied to the forked worker
+    METRICS.reset()
+    driver = None
+    shard_writer = iw.TarShardWriter(
+        get_shard_prefix(save_dir, split_name, run_id, worker_id),
+        shard_size=shard_size,
+    )
+    errors_file_writer = iw.open_text_writer(
+        f"{error_file}{worker_id}.jsonl.bz2", "w", n_threads=1, index=False
+    )
 
-    if error_file.endswith(".bz2"):
-        errors_file_writer = bz2.open(error_file, "wt")
+    def try_render_table(i, table_obj):
+        try:
+            return render_table(driver, i, table_obj, shard_writer, split_name)
+        except Exception:
+            METRICS.count("errors.exception")
+            return None
+
+    try:
+        # A browser that cannot start is reported as a failure of the worker
+        if render_backend == "browser":
+            driver = create_driver()
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            batch_start, batch = task
+            result_queue.put(("start", worker_id, batch_start, len(batch)))
+            n_images, n_errors, n_skipped = 0, 0, 0
+            for i, table_obj in enumerate(batch, start=batch_start + 1):
+                if not table_obj.get("html"):
+                    n_skipped += 1
+                    METRICS.count("tables_skipped")
+                    continue
+                if table_obj.get("valid") is False:
+                    METRICS.count("errors.invalid")
+                    errors_file_writer.write(ujson.dumps(table_obj))
+                    errors_file_writer.write("\n")
+                    n_errors += 1
+                    continue
+                # None: the table raised an error, False: an error pattern
+                saved = try_render_table(i, table_obj)
+                if saved is None and driver and is_driver_dead(driver):
+                    METRICS.count("browser_restarts")
+                    driver = restart_driver(driver)
+                    saved = try_render_table(i, table_obj)
+                if saved:
+                    n_images += 1
+                    METRICS.count("tables_rendered")
+                else:
+                    # save error patterns to folder
+                    errors_file_writer.write(ujson.dumps(table_obj))
+                    errors_file_writer.write("\n")
+                    n_errors += 1
+            # Keep the images and errors of finished batches if the worker crashes
+            # later
+            shard_state = shard_writer.flush()
+            errors_file_writer.flush()
+            result_queue.put(
+                (
+                    "done",
+                    worker_id,
+                    batch_start,
+                    n_images,
+                    n_errors,
+                    n_skipped,
+                    shard_state,
+                    METRICS.pop(),
+                )
+            )
+    except Exception:
+        result_queue.put(("failed", worker_id, traceback.format_exc()))
+        raise
+    finally:
+        shard_writer.close()
+        errors_file_writer.close()
+        if driver:
+            driver.quit()
+
+
+def is_driver_dead(driver):
+    try:
+        driver.execute_script("return 1;")
+        return False
+    except Exception:
+        return True
+
+
+def restart_driver(driver):
+    try:
+        driver.quit()
+    except Exception:
+        pass
+    return create_driver()
+
+
+# Default number of render workers failing in a row before rendering is aborted
+MAX_WORKER_FAILURES = 5
+
+
+def render_tables_mp(
+    input_file,
+    error_file,
+    save_dir,
+    split_name,
+    start_id,
+    end_id,
+    n_threads,
+    batch_size=16,
+    max_retries=2,
+    render_backend="browser",
+    shard_size=1 << 30,
+    rendered_hashes=None,
+    table_queue=None,
+    metrics_file=None,
+    metrics_interval=60,
+    max_worker_failures=MAX_WORKER_FAILURES,
+):
+    """
+    Render the tables [start_id, end_id) with a reader process and n_threads
+    worker processes. Workers pull small batches from a bounded queue, so a worker
+    with large tables does not hold back the others. The batches of a failed
+    worker are re-read from the dump (block index) and retried with a new worker.
+    Every worker writes the images and annotations to its own tar shards of about
+    shard_size bytes. The shards of a failed worker are cut back to its last
+    finished batch.
+    :param render_backend: "browser" (Firefox) or "pil" (table_layout)
+    :param rendered_hashes: skip the tables of these hashes (incremental
+    rendering). The reader checks them once per table (see skip_rendered_tables)
+    :param table_queue: render the tables streamed by dump_wikitables to this
+    queue (input_file is its output file) instead of [start_id, end_id). Failed
+    batches are retried when the dump is saved.
+    :param metrics_file: update this metrics file every metrics_interval seconds,
+    with the worker metrics added to METRICS (see gen_images)
+    :param max_worker_failures: abort if this number of workers fail in a row
+    without finishing a batch (e.g., the browser cannot start). The reader and
+    the workers are stopped, and RuntimeError is raised.
+    :return: number of images, number of errors, number of skipped tables
+    """
+    # Shards of previous runs are kept (incremental rendering)
+    run_id = time.strftime("%Y%m%d%H%M%S")
+    task_queue = multiprocessing.Queue(maxsize=n_threads * 4)
+    result_queue = multiprocessing.Queue()
+
+    stream_state = {}
+    stop_reader = threading.Event()
+    if table_queue is not None:
+        # The number of tables is known at the end of the stream
+        start_id, end_id = 0, None
+        reader = threading.Thread(
+            target=forward_tables,
+            args=(
+                table_queue,
+                task_queue,
+                input_file,
+                batch_size,
+                stream_state,
+                stop_reader,
+                rendered_hashes,
+            ),
+            daemon=True,
+        )
     else:
-        errors_file_writer = open(error_file, "w")
+        reader = multiprocessing.Process(
+            target=pool_read_tables,
+            args=(
+                input_file,
+                start_id,
+                end_id,
+                batch_size,
+                task_queue,
+                rendered_hashes,
+            ),
+        )
+    reader.start()
+
+    workers = {}
+    n_workers_started = 0
+
+    def start_worker():
+        nonlocal n_workers_started
+        worker_id = n_workers_started
+        n_workers_started += 1
+        worker = multiprocessing.Process(
+            target=pool_render_tables,
+            args=(
+                worker_id,
+                task_queue,
+                result_queue,
+                error_file,
+                save_dir,
+                split_name,
+                run_id,
+                render_backend,
+                shard_size,
+            ),
+        )
+        worker.start()
+        workers[worker_id] = worker
+
+    for _ in range(n_threads):
+        start_worker()
+
+    n_batches = None
+    if end_id is not None:
+        n_batches = len(range(start_id, end_id, batch_size))
+    deferred_batches = []
+    in_flight = {}
+    shard_states = {}
+    retries = defaultdict(int)
+    worker_images = defaultdict(int)
+    n_images, n_errors, n_skipped = 0, 0, 0
+    start = time.time()
+    p_bar = tqdm(
+        total=end_id - start_id if end_id is not None else None, desc="Render tables"
+    )
 
-    i = 0
-    while True:
-        line = input_file_reader.readline()
-        if not line:
-            break
-        i += 1
-        if i < chunk[0] or i >= chunk[1]:
-            continue
+    def retry_batch(batch_start, batch_len):
+        nonlocal n_errors
+        if batch_start in done_batches:
+            return
+        if not os.path.exists(input_file):
+            if n_batches is None:
+                # Streamed tables are re-read when the dump is saved
+                deferred_batches.append((batch_start, batch_len))
+                return
+            # The dump is not saved (e.g., the parse failed)
+            retries[batch_start] = max_retries
+        batch_end = batch_start + batch_len
+        retries[batch_start] += 1
+        if retries[batch_start] > max_retries:
+            iw.print_status(f"Skipped tables [{batch_start}, {batch_end})")
+            done_batches.add(batch_start)
+            n_errors += batch_len
+            p_bar.update(batch_len)
+            return
+        batch = list(iw.read_json_file(input_file, start=batch_start, end=batch_end))
+        task_queue.put((batch_start, skip_rendered_tables(batch, rendered_hashes)))
+
+    def abort():
+        stop_reader.set()
+        if isinstance(reader, multiprocessing.Process):
+            reader.terminate()
+        for worker in workers.values():
+            worker.terminate()
+        for worker in workers.values():
+            worker.join()
+        p_bar.close()
+        raise RuntimeError(
+            f"Rendering aborted: {n_failed_workers} workers failed in a row without "
+            "finishing a batch"
+        )
 
-        table_obj = ujson.loads(line)
-        # iw.print_status(
-        #     "[%d, %d] | Table:%d | WD:%s | Index:%d | URL:%s"
-        #     % (
-        #         chunk[0], chunk[1],
-        #         i,
-        #         str(table_obj.get("wikidata")),
-        #         table_obj["index"],
-        #         str(table_obj.get("url")),
-        #     ),
-        #     is_screen=False,
-        # )
-
-        (
-            struc_tokens,
-            html_with_id,
-            list_cell_contents,
-            idx_count,
-        ) = transform_html_id_text(table_obj["html"])
-
-        if struc_tokens is None:
-            # save error patterns to folder
-            errors_file_writer.write(ujson.dumps(table_obj))
-            errors_file_writer.write("\n")
-            continue
+    done_batches = set()
+    last_check = time.time()
+    n_idle_checks = 0
+    # Workers failed since the last finished batch
+    n_failed_workers = 0
+    while n_batches is None or len(done_batches) < n_batches:
+        if n_batches is None and not reader.is_alive():
+            end_id = stream_state["end_id"]
+            n_batches = len(range(start_id, end_id, batch_size))
+            p_bar.total = end_id - start_id
+            p_bar.refresh()
+            while deferred_batches:
+                retry_batch(*deferred_batches.pop())
 
-        im, bboxes = html_to_img(driver, html_with_id, idx_count)
-        if bboxes is None:
-            # save error patterns to folder
-            errors_file_writer.write(ujson.dumps(table_obj))
-            errors_file_writer.write("\n")
-            continue
-        # Save photo
-        dir_sample = f"{save_dir}/{i}"
-        im.save(f"{dir_sample}.png", dpi=(600, 600))
-
-        # Save ground truth json
-        cells = []
-        idx_ = 0
-        for cell_token_ in list_cell_contents:
-            if len(cell_token_) == 0:
-                cell_ = {"tokens": cell_token_}
+        try:
+            message = result_queue.get(timeout=1)
+        except queue.Empty:
+            message = None
+
+        if time.time() - last_check > 1:
+            # Surface dead workers, and retry their batches
+            last_check = time.time()
+            for worker_id, worker in list(workers.items()):
+                if worker.is_alive():
+                    continue
+                del workers[worker_id]
+                iw.print_status(
+                    f"Worker {worker_id} exited with code {worker.exitcode}"
+                )
+                repair_worker_shards(
+                    get_shard_prefix(save_dir, split_name, run_id, worker_id),
+                    shard_states.pop(worker_id, None),
+                )
+                if worker_id in in_flight:
+                    retry_batch(*in_flight.pop(worker_id))
+                n_failed_workers += 1
+                if n_failed_workers >= max_worker_failures:
+                    abort()
+                start_worker()
+
+            # The start message of a crashed worker can be lost. If all tables are
+            # read and no worker is busy, the unfinished batches are retried.
+            if reader.is_alive() or in_flight or not task_queue.empty():
+                n_idle_checks = 0
             else:
-                cell_ = {"tokens": cell_token_, "bbox": bboxes[idx_][2:]}
-                idx_ += 1
-
-            cells.append(cell_)
-
-        html_json = {"structure": {"tokens": struc_tokens}, "cells": cells}
-
-        # save to folder
-        table_sample = {
-            "filename": str(i) + ".png",
-            "split": split_name,
-            "imgid": i,
-            "html": html_json,
-        }
-
-        with open(f"{dir_sample}.json", "w") as s_json:
-            json.dump(table_sample, s_json)
-
-        # # ##########debug
-        # with open('bboxes/' + str(i) + '.txt', 'w') as f:
-        #     f.write(html_with_id)
-        #     f.write(str(table_sample))
-        #
-        # img = np.asarray(im, np.int64)[:, :, 0]
-        # draw_matrices(img, np.array(bboxes), str(i) + '.jpg')
-        # # #########################
-
-    driver.quit()
+                n_idle_checks += 1
+            if n_idle_checks > 2:
+                n_idle_checks = 0
+                for batch_start in range(start_id, end_id, batch_size):
+                    batch_len = min(batch_size, end_id - batch_start)
+                    retry_batch(batch_start, batch_len)
+
+        if message is None:
+            continue
+        if message[0] == "start":
+            _, worker_id, batch_start, batch_len = message
+            in_flight[worker_id] = (batch_start, batch_len)
+        elif message[0] == "done":
+            (
+                _,
+                worker_id,
+                batch_start,
+                batch_images,
+                batch_errors,
+                batch_skipped,
+                state,
+                metrics,
+            ) = message
+            METRICS.merge(metrics)
+            n_failed_workers = 0
+            in_flight.pop(worker_id, None)
+            if state:
+                shard_states[worker_id] = state
+            if batch_start in done_batches:
+                continue
+            done_batches.add(batch_start)
+            n_images += batch_images
+            n_errors += batch_errors
+            n_skipped += batch_skipped
+            worker_images[worker_id] += batch_images
+            p_bar.update(batch_images + batch_errors + batch_skipped)
+            run_time = time.time() - start
+            p_bar.set_postfix(
+                {f"w{k}": f"{v / run_time:.1f}/s" for k, v in worker_images.items()}
+            )
+            METRICS.report(metrics_interval, metrics_file, write=tqdm.write)
+        elif message[0] == "failed":
+            _, worker_id, error = message
+            iw.print_status(f"Worker {worker_id} failed:\n{error}")
+
+    for _ in workers:
+        task_queue.put(None)
+    for worker in workers.values():
+        worker.join()
+    reader.join()
+    p_bar.close()
+    return n_images, n_errors, n_skipped
+
+
+def repair_worker_shards(shard_prefix, shard_state):
+    """
+    Keep only the finished batches in the shards of a failed worker
+    :param shard_state: shard file and offset of the last finished batch, or None
+    """
+    for shard_file in sorted(glob.glob(f"{shard_prefix}-*.tar")):
+        if shard_state is None or shard_file > shard_state[0]:
+            iw.delete_file(shard_file)
+    if shard_state:
+        iw.repair_tar_shard(*shard_state)
 
 
 def gen_images(
@@ -457,12 +801,34 @@ def gen_images(
     end_id=None,
     n_threads=8,
     split_name="train",
-    compress=False,
-    delete_org=False,
+    render_backend="browser",
+    shard_size=1 << 30,
+    incremental=False,
+    input_file=None,
+    table_queue=None,
+    metrics_file=None,
+    metrics_interval=60,
 ):
+    """
+    Render the tables of a language to tar shards (WebDataset layout) in
+    {DIR_MODELS}/wikitables_images/{lang}/{split_name}/
+    :param shard_size: target size of shards in bytes
+    :param incremental: keep the shards of previous runs, and render only the
+    tables whose hash is not in these shards
+    :param input_file: parsed dump, e.g., a delta dump. Default: {lang}.jsonl.bz2
+    :param table_queue: render the tables streamed by the parse of input_file (see
+    render_tables_mp)
+    :param metrics_file: save the counters and time per stage of the workers (see
+    metrics.Metrics) to a JSON or Prometheus text (.prom) file
+    :param metrics_interval: print a metrics summary line, and update the
+    metrics file, every metrics_interval seconds. 0: only at the end
+    :return: number of errors, number of images, run time
+    """
     start = time.time()
-    input_file = f"{cf.DIR_MODELS}/wikitables_html_pubtabnet/{lang}.jsonl.bz2"
-    if not os.path.exists(input_file):
+    METRICS.reset(stage="render", lang=lang)
+    if input_file is None:
+        input_file = f"{cf.DIR_MODELS}/wikitables_html_pubtabnet/{lang}.jsonl.bz2"
+    if table_queue is None and not os.path.exists(input_file):
         iw.print_status(f"Missing jsonl file: {input_file}")
         from cli.pipeline import run_dump
 
@@ -478,34 +844,53 @@ def gen_images(
     save_errors = f"{save_lang}errors/"
     iw.create_dir(save_root)
     iw.create_dir(save_lang)
+    rendered_hashes = None
+    if incremental:
+        rendered_hashes = get_rendered_hashes(save_split_name)
+        iw.print_status(f"Rendered tables: {len(rendered_hashes):,}")
+    else:
+        # Shards of a previous run could be mixed with the new ones
+        iw.delete_folder(save_split_name)
     iw.create_dir(save_split_name)
     iw.create_dir(save_errors)
 
-    if start_id is None and end_id is None:
-        end_id = get_jsonl_size(input_file)
-        start_id = 0
+    if table_queue is None:
+        if start_id is None and end_id is None:
+            end_id = get_jsonl_size(input_file)
+            start_id = 0
 
-    chunks = get_chunks(start_id=start_id, end_id=end_id, n_chunks=n_threads)
+        # Build the block index once, before the workers read (retried) batches
+        iw.load_block_index(input_file)
 
-    parse_wiki_tables_mp(
+    render_start = time.time()
+    n_images, _, n_skipped = render_tables_mp(
         input_file=input_file,
         error_file=save_errors,
         save_dir=save_split_name,
         split_name=split_name,
-        chunks=chunks,
+        start_id=start_id,
+        end_id=end_id,
+        n_threads=n_threads,
+        render_backend=render_backend,
+        shard_size=shard_size,
+        rendered_hashes=rendered_hashes,
+        table_queue=table_queue,
+        metrics_file=metrics_file,
+        metrics_interval=metrics_interval,
     )
+    if n_skipped:
+        # Estimated with the rendering time of this run
+        render_time = time.time() - render_start
+        saved_time = n_skipped * render_time / n_images if n_images else 0
+        iw.print_status(
+            f"Skipped {n_skipped:,} tables (duplicates, already rendered, or "
+            f"deleted). Saved about {saved_time:.0f}s of rendering"
+        )
 
     n_errors = merge_jsonl_files(save_errors[:-1])
-    n_images = len(os.listdir(save_split_name)) // 2
-
-    if compress:
-        output_file_compressed = f"{save_root}{lang}.tar.bz2"
-        iw.compress_folder(
-            input_folder=save_lang,
-            output_file=output_file_compressed,
-            delete_org=delete_org,
-        )
-        iw.print_status(f"Output file: {output_file_compressed}")
-    else:
-        iw.print_status(f"Output dataset folder: {save_lang}")
+    if metrics_interval:
+        iw.print_status(METRICS.summary())
+    if metrics_file:
+        METRICS.save(metrics_file)
+    iw.print_status(f"Output dataset shards: {save_split_name}")
     return n_errors, n_images, time.time() - start